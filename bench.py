@@ -0,0 +1,75 @@
+import math, statistics, threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Callable, Iterator, Optional
+
+@dataclass(frozen=True)
+class BenchConfig:
+  warmup: int = 3          # untimed launches before measuring
+  min_reps: int = 10       # timed launches before the stopping rule is checked
+  max_reps: int = 200      # hard cap on timed launches per test
+  rel_ci: float = 0.01     # stop once the 95% CI of the median is within this fraction of it
+  trim: float = 0.1        # fraction cut from each end for the trimmed mean
+  flush_l2: bool = True    # overwrite the L2 cache before every launch
+
+DEFAULT = BenchConfig()
+
+@dataclass
+class Stats:
+  n: int
+  median: float
+  trimmed_mean: float
+  mean: float
+  stddev: float
+  ci_low: float
+  ci_high: float
+  min: float
+
+  @property
+  def rel_ci(self) -> float: return (self.ci_high - self.ci_low) / 2 / self.median if self.median > 0 else math.inf
+  def to_dict(self) -> dict: return asdict(self)
+
+def summarize(times:list[float], trim:float=DEFAULT.trim) -> Stats:
+  ts, n = sorted(times), len(times)
+  k = int(n * trim)
+  # distribution-free 95% CI of the median from order statistics
+  half = 1.96 * math.sqrt(n) / 2
+  lo, hi = max(int(math.floor(n / 2 - half)), 0), min(int(math.ceil(n / 2 + half)), n - 1)
+  return Stats(n, statistics.median(ts), statistics.fmean(ts[k:n-k] or ts), statistics.fmean(ts),
+               statistics.stdev(ts) if n > 1 else 0.0, ts[lo], ts[hi], ts[0])
+
+def benchmark(launch:Callable[[], float], flush:Optional[Callable[[], None]]=None, config:BenchConfig=DEFAULT,
+              reset:Optional[Callable[[], None]]=None) -> Stats:
+  """Time launch() repeatedly until the median is stable, launch returns the kernel time in seconds.
+  reset() runs untimed before every launch, eg. to poison the output, then flush() if the config flushes the L2."""
+  if not config.flush_l2: flush = None
+  def prepare():
+    if reset is not None: reset()
+    if flush is not None: flush()
+  for _ in range(config.warmup):
+    prepare()
+    launch()
+  times = []
+  while len(times) < config.max_reps:
+    prepare()
+    times.append(launch())
+    if len(times) >= config.min_reps and summarize(times, config.trim).rel_ci <= config.rel_ci: break
+  return summarize(times, config.trim)
+
+class Stages:
+  """Wall-clock time and bytes moved per stage of judging (upload, launch, download, verify, ...), summed over tests.
+  Stages may be timed from several threads, eg. verification runs next to the following upload."""
+  def __init__(self):
+    self.seconds, self.nbytes, self.lock = defaultdict(float), defaultdict(int), threading.Lock()
+
+  @contextmanager
+  def __call__(self, name:str, nbytes:int=0) -> Iterator[None]:
+    st = time.perf_counter()
+    try: yield
+    finally:
+      with self.lock: self.seconds[name], self.nbytes[name] = self.seconds[name] + time.perf_counter() - st, self.nbytes[name] + nbytes
+
+  def to_dict(self) -> dict:
+    return {name: {"s": s, **({"bytes": self.nbytes[name], "GB/s": self.nbytes[name] / s / 1e9 if s > 0 else None} if self.nbytes[name] else {})}
+            for name, s in self.seconds.items()}
@@ -0,0 +1,72 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+MIN_CLASS = 1 << 12         # smallest size class in bytes
+MAX_CACHED = 8 << 30        # bytes of idle buffers kept around before the pool trims itself
+POISON = 0xFF               # byte written to output buffers before each run, all-ones is NaN for every float dtype
+
+def size_class(nbytes:int) -> int:
+  """Round up to a quarter power of two, so at most 25% of a buffer is wasted."""
+  if nbytes <= MIN_CLASS: return MIN_CLASS
+  step = 1 << max((nbytes - 1).bit_length() - 3, 0)
+  return (nbytes + step - 1) // step * step
+
+class Lease:
+  """Buffers handed out for a single run, all of them go back to the pool when the lease ends."""
+  def __init__(self, pool:'BufferPool'): self.pool, self.bufs = pool, []
+  def acquire(self, nbytes:int) -> Any:
+    self.bufs.append(buf:=self.pool.acquire(nbytes))
+    return buf
+  def output(self, nbytes:int) -> Any:
+    """A buffer the kernel is expected to overwrite, poisoned so stale results from an earlier run can't pass."""
+    buf = self.acquire(nbytes)
+    self.poison(buf, nbytes)
+    return buf
+  def poison(self, buf:Any, nbytes:int):
+    """Poison an output again, eg. before every timed launch so each one has to write the result itself."""
+    if self.pool.fill is not None: self.pool.fill(buf, POISON, nbytes)
+
+class BufferPool:
+  """Size-class pool of device buffers on top of an allocator, so repeated runs stop allocating fresh memory."""
+  def __init__(self, alloc, fill:Optional[Callable[[Any, int, int], None]]=None, max_cached:int=MAX_CACHED):
+    self.alloc, self.fill, self.max_cached = alloc, fill, max_cached
+    self.idle: defaultdict[int, list[Any]] = defaultdict(list)
+    self.busy: dict[int, tuple[Any, int]] = {}  # id(buf) -> (buf, size class)
+    self.idle_bytes, self.busy_bytes = 0, 0
+
+  def acquire(self, nbytes:int) -> Any:
+    sz = size_class(nbytes)
+    if self.idle[sz]:
+      buf = self.idle[sz].pop()
+      self.idle_bytes -= sz
+    else: buf = self.alloc.alloc(sz)
+    self.busy[id(buf)] = (buf, sz)
+    self.busy_bytes += sz
+    return buf
+
+  def release(self, buf:Any):
+    _, sz = self.busy.pop(id(buf))
+    self.busy_bytes -= sz
+    self.idle[sz].append(buf)
+    self.idle_bytes += sz
+    if self.idle_bytes > self.max_cached: self.trim(self.max_cached // 2)
+
+  def trim(self, keep:int=0):
+    """Return idle buffers to the allocator, largest first, until at most keep bytes are idle."""
+    for sz in sorted(self.idle, reverse=True):
+      while self.idle[sz] and self.idle_bytes > keep:
+        self.alloc.free(self.idle[sz].pop(), sz)
+        self.idle_bytes -= sz
+    if (free_cache:=getattr(self.alloc, "free_cache", None)) is not None: free_cache()
+
+  @contextmanager
+  def lease(self) -> Iterator[Lease]:
+    lease = Lease(self)
+    try: yield lease
+    finally:
+      for buf in lease.bufs: self.release(buf)
+
+  def occupancy(self) -> dict[str, int]:
+    return {"busy": len(self.busy), "busy_bytes": self.busy_bytes,
+            "idle": sum(len(v) for v in self.idle.values()), "idle_bytes": self.idle_bytes}
@@ -0,0 +1,52 @@
+import asyncio, time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+class Cache:
+  """Bounded LRU of values computed by coroutines, each kept for at most ttl seconds. Writers invalidate the keys
+  they change, the TTL only bounds how stale a value can get when something else writes to the database.
+  Concurrent misses on a key share one computation, whose result is dropped if the key was invalidated meanwhile."""
+  def __init__(self, name:str, max_entries:int, ttl:float):
+    self.name, self.max_entries, self.ttl = name, max_entries, ttl
+    self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # key -> (expiry, value)
+    self.pending: dict[Hashable, asyncio.Future] = {}
+    self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+  async def get(self, key:Hashable, compute:Callable[[], Awaitable[Any]]) -> Any:
+    if (hit:=self.entries.get(key)) is not None:
+      if hit[0] > time.monotonic():
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return hit[1]
+      del self.entries[key]
+      self.stats["expirations"] += 1
+    self.stats["misses"] += 1
+    if (fut:=self.pending.get(key)) is None:
+      self.pending[key] = fut = asyncio.ensure_future(compute())
+      fut.add_done_callback(lambda f: self._store(key, f))
+    return await asyncio.shield(fut)
+
+  def _store(self, key:Hashable, fut:asyncio.Future):
+    if self.pending.get(key) is not fut: return  # invalidated while computing
+    del self.pending[key]
+    if fut.cancelled() or fut.exception() is not None: return
+    self.entries[key] = (time.monotonic() + self.ttl, fut.result())
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+      self.stats["evictions"] += 1
+
+  def invalidate(self, key:Hashable):
+    self.stats["invalidations"] += 1
+    self.entries.pop(key, None)
+    self.pending.pop(key, None)
+
+  def clear(self):
+    self.stats["invalidations"] += 1
+    self.entries.clear()
+    self.pending.clear()
+
+  @property
+  def hit_rate(self) -> float: return self.stats["hits"] / max(self.stats["hits"] + self.stats["misses"], 1)
+
+  def __repr__(self): return f"<Cache {self.name}: {len(self.entries)}/{self.max_entries} entries, {self.hit_rate:.1%} hits, {self.stats}>"
@@ -5,3 +5,4 @@ from cogs.delete import DeleteCog
 from cogs.show_db import ShowDBCog
 from cogs.show_submissions import ShowSubmissionsCog
 from cogs.delete_user import DeleteUserCog
+from cogs.rescore import RescoreCog
@@ -1,14 +1,18 @@
+import json
 import discord
 import numpy as np
 from discord.app_commands import Choice, autocomplete, command
 from discord.ext.commands import Cog
+from typing import Optional
 
-from utils import check_user, convert_literals, active_chals, fmt_time
+import compare
+from layouts import ROW, normalize
+from utils import check_user, convert_literals, ktype_ac, active_chals, challenges_updated, fmt_time, try_edit
 from db import db, Perm
-from run import cc, gen_tests, ktypes, ktype_ac
+from jobs import QueueFull
+from run import CompileError, make_tests, ktypes, rand_fns
 
 dtypes = {"double":np.dtype("float64"),"single":np.dtype("float32"),"half":np.dtype("float16")}
-rand_fns = {"rand":np.random.rand,"randn":np.random.randn,"randint":np.random.randint}
 
 class CreateCog(Cog):
   async def dtype_ac(self, _, curr): return [Choice(name=dt, value=dt) for dt in dtypes.keys() if curr.lower() in dt]
@@ -20,35 +24,40 @@ class CreateCog(Cog):
   @convert_literals
   async def create(self, interaction: discord.Interaction, name:str, desc:str, ktype:str, input_shapes:list[tuple[int,...]],
                    output_shape:tuple[int,...], global_size:tuple[int,int,int], local_size:tuple[int,int,int], dtype:str, rand_fn:str,
-                   num_tests:int, reference_code:discord.Attachment):
+                   num_tests:int, reference_code:discord.Attachment, store_inputs:bool=False,
+                   rtol:Optional[float]=None, atol:Optional[float]=None, ulps:Optional[int]=None, layouts:str=ROW):
     """Create a new challenge"""
     assert isinstance(interaction.channel, discord.TextChannel)
     # verify arguments
-    if name in active_chals(): return await interaction.response.send_message(f"challenge with name {name} already exists", ephemeral=True)
+    if name in await active_chals(): return await interaction.response.send_message(f"challenge with name {name} already exists", ephemeral=True)
     if ktype not in ktypes: return await interaction.response.send_message("invalid ktype", ephemeral=True)
     if dtype not in dtypes: return await interaction.response.send_message(f"invalid dtype {dtype}", ephemeral=True)
     if rand_fn not in rand_fns: return await interaction.response.send_message(f"invalid rand function {rand_fn}", ephemeral=True)
-    # download and compile program
+    # comma-separated input layouts submitters may choose from, eg. "row,col,pad32"
+    try: offered = list(dict.fromkeys([ROW] + [normalize(l) for l in layouts.split(",") if l.strip()]))
+    except ValueError as e: return await interaction.response.send_message(str(e), ephemeral=True)
+    tol = compare.custom_tolerance(dtypes[dtype], rtol, atol, ulps)
+    # download reference code and generate tests on a runner
     await interaction.response.send_message("loading reference code...", ephemeral=True)
-    try: prog = cc((await reference_code.read()).decode('utf-8'), ktype, name)
-    except Exception as e:
-      return await interaction.edit_original_response(content=f"failed to load reference code: {e}")
-    # generate tests
-    await interaction.edit_original_response(content="generating tests...")
-    try: tests, tm = gen_tests(prog, global_size, local_size, input_shapes, output_shape, dtypes[dtype], rand_fns[rand_fn], num_tests)
+    src = (await reference_code.read()).decode('utf-8')
+    jobs = interaction.client.jobs
+    try: job = jobs.submit(make_tests, src, ktype, name, global_size, local_size, input_shapes, output_shape, dtypes[dtype].name,
+                           rand_fn, num_tests, not store_inputs, user_id=interaction.user.id)
+    except QueueFull as e: return await interaction.edit_original_response(content=f"failed to queue test generation: {e}")
+    try: tests, tm = await jobs.wait(job, lambda job: interaction.edit_original_response(content=f"generating tests, {jobs.status(job)}"))
+    except CompileError as e: return await try_edit(interaction, f"failed to load reference code: {e}")
     except Exception as e:
       import traceback
       print(traceback.format_exc())
-      return await interaction.edit_original_response(content=f"failed to generate tests: {e}")
-    await interaction.edit_original_response(content="creating challenge...")
-    db.execute("INSERT INTO challenges (name, desc, creator_id, tests, timing) VALUES (?, ?, ?, ?, ?);",
-               (name, desc, interaction.user.id, tests, tm))
-    db.commit()
-    active_chals.cache_clear()
-    await interaction.delete_original_response()
+      return await try_edit(interaction, f"failed to generate tests: {e}")
+    await try_edit(interaction, "creating challenge...")
+    await db.execute("INSERT INTO challenges (name, desc, creator_id, tests, timing, tolerance, layouts) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                     (name, desc, interaction.user.id, tests, tm, json.dumps(tol.to_dict()) if tol else None, json.dumps(offered)))
+    challenges_updated()
+    await try_edit(interaction, delete=True)
     await interaction.channel.send(content=f"""# New Challenge: `{name}`
 Author: {interaction.user.mention}
-Input Shapes: `{input_shapes}`, Output Shape: `{output_shape}` Dtype: `{dtype}`
+Input Shapes: `{input_shapes}`, Output Shape: `{output_shape}` Dtype: `{dtype}` Layouts: `{', '.join(offered)}`
 Baseline time: {fmt_time(tm)}
 
 {desc}
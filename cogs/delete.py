@@ -3,8 +3,9 @@ import discord
 from discord.app_commands import autocomplete, command
 from discord.ext.commands import Cog
 
-from utils import challenge_ac
-from db import db, Perm
+from utils import challenge_ac, challenge_updated, challenges_updated
+from db import db, Perm, sweep_tests
+from ranking import rankings
 from utils import check_user
 
 class DeleteCog(Cog):
@@ -17,7 +18,7 @@ class DeleteCog(Cog):
           await interaction.response.send_message("Please specify a challenge to delete.", ephemeral=True)
           return
           
-      challenge_data = db.execute("SELECT id FROM challenges WHERE name = ?", (challenge,)).fetchone()
+      challenge_data = await db.fetchone("SELECT id FROM challenges WHERE name = ?", (challenge,))
       if not challenge_data:
           await interaction.response.send_message(f"Challenge `{challenge}` not found.", ephemeral=True)
           return
@@ -25,13 +26,14 @@ class DeleteCog(Cog):
       challenge_id = challenge_data[0]
       
       try:
-          db.execute("BEGIN TRANSACTION")
-          # Use comp_id instead of challenge to reference the challenge
-          db.execute("DELETE FROM submissions WHERE comp_id = ?", (challenge_id,))
-          db.execute("DELETE FROM challenges WHERE name = ?", (challenge,))
-          db.execute("COMMIT")
+          # submissions go with it (ON DELETE CASCADE)
+          await db.execute("DELETE FROM challenges WHERE id = ?", (challenge_id,))
+          interaction.client.jobs.invalidate(challenge_id)
+          rankings.drop(challenge_id)
+          challenge_updated(challenge_id)
+          challenges_updated()
+          await db.read(sweep_tests)  # its test file, unless another challenge shares it
           
           await interaction.response.send_message(f"Challenge `{challenge}` and all associated submissions have been deleted.", ephemeral=True)
       except Exception as e:
-          db.execute("ROLLBACK")
           await interaction.response.send_message(f"Error deleting challenge: {str(e)}", ephemeral=True)
\ No newline at end of file
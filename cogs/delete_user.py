@@ -2,27 +2,28 @@ from typing import Optional
 import discord
 from discord.app_commands import autocomplete, command, Choice
 from discord.ext.commands import Cog
-from utils import check_user
+from utils import check_user, challenge_updated, challenges_updated
 from db import db, Perm
+from ranking import rankings
 import asyncio
 
 async def user_id_autocomplete(interaction: discord.Interaction, current: str) -> list[Choice[str]]:
     """Autocomplete for all user IDs in the system (both registered users and submission creators)"""
     query = f"%{current}%" if current else "%"
     
-    registered_users = db.execute(
+    registered_users = await db.fetchall(
         """SELECT id, username, 'registered' as type FROM users 
            WHERE CAST(id AS TEXT) LIKE ?""", 
         (query,)
-    ).fetchall()
+    )
     
-    unregistered_users = db.execute(
+    unregistered_users = await db.fetchall(
         """SELECT DISTINCT s.user_id as id, 'unregistered' as type
            FROM submissions s
            LEFT JOIN users u ON s.user_id = u.id
            WHERE u.id IS NULL AND CAST(s.user_id AS TEXT) LIKE ?""",
         (query,)
-    ).fetchall()
+    )
     
     choices = []
     
@@ -34,6 +35,24 @@ async def user_id_autocomplete(interaction: discord.Interaction, current: str) -
     
     return choices[:25]
 
+def delete_user_data(conn, discord_id: int, registered: bool):
+    """Delete a user's submissions and, if they are registered, the user and the challenges they created"""
+    deleted_submissions = conn.execute(
+        "DELETE FROM submissions WHERE user_id = ? RETURNING comp_id, name", 
+        (discord_id,)
+    ).fetchall()
+    
+    challenges = []
+    if registered:  # Only check for challenges if the user is registered
+        # their submissions go with them (ON DELETE CASCADE)
+        challenges = conn.execute(
+            "DELETE FROM challenges WHERE creator_id = ? RETURNING id, name", 
+            (discord_id,)
+        ).fetchall()
+        conn.execute("DELETE FROM users WHERE id = ?", (discord_id,))
+    
+    return deleted_submissions, challenges
+
 class DeleteUserCog(Cog):
     @command()
     @check_user(Perm.ADMIN)  # Only admins can delete users
@@ -50,11 +69,11 @@ class DeleteUserCog(Cog):
             await interaction.response.send_message("Invalid user ID format. Please provide a numeric Discord ID.", ephemeral=True)
             return
             
-        user_data = db.execute("SELECT id, username FROM users WHERE id = ?", (user_id_int,)).fetchone()
+        user_data = await db.fetchone("SELECT id, username FROM users WHERE id = ?", (user_id_int,))
         
-        submission_count = db.execute(
+        submission_count = (await db.fetchone(
             "SELECT COUNT(*) FROM submissions WHERE user_id = ?", (user_id_int,)
-        ).fetchone()[0]
+        ))[0]
         
         if not user_data and submission_count == 0:
             await interaction.response.send_message(
@@ -86,52 +105,32 @@ class DeleteUserCog(Cog):
             await interaction.client.wait_for('message', check=check, timeout=30.0)
             
             try:
-                db.execute("BEGIN TRANSACTION")
-                
-                deleted_submissions = db.execute(
-                    "DELETE FROM submissions WHERE user_id = ? RETURNING comp_id, name", 
-                    (discord_id,)
-                ).fetchall()
+                # the whole deletion is one write, so nothing is held open while waiting on discord
+                deleted_submissions, challenges = await db.write(delete_user_data, discord_id, bool(user_data))
+                for challenge_id, _ in challenges:
+                    interaction.client.jobs.invalidate(challenge_id)
+                    rankings.drop(challenge_id)
+                rankings.drop_user(discord_id)
+                for challenge_id in {comp_id for comp_id, _ in deleted_submissions} | {challenge_id for challenge_id, _ in challenges}:
+                    challenge_updated(challenge_id)
+                if challenges: challenges_updated()
                 
                 submission_info = ""
                 if deleted_submissions:
                     submission_names = [sub[1] for sub in deleted_submissions]
                     submission_info = f"Deleted submissions: {', '.join(submission_names)}"
                 
-                challenges = []
-                if user_data:  # Only check for challenges if the user is registered
-                    challenges = db.execute(
-                        "SELECT id, name FROM challenges WHERE creator_id = ?", 
-                        (discord_id,)
-                    ).fetchall()
-                
                 if challenges:
                     challenge_names = [challenge[1] for challenge in challenges]
-                    challenge_ids = [challenge[0] for challenge in challenges]
-                    
-                    for challenge_id in challenge_ids:
-                        db.execute(
-                            "DELETE FROM submissions WHERE comp_id = ?", 
-                            (challenge_id,)
-                        )
-                    
-                    db.execute(
-                        "DELETE FROM challenges WHERE creator_id = ?", 
-                        (discord_id,)
-                    )
-                    
                     challenge_message = f"Deleted {len(challenges)} challenges created by the user: {', '.join(challenge_names)}"
                 else:
                     challenge_message = "No challenges were created by this user."
                 
                 if user_data:
-                    db.execute("DELETE FROM users WHERE id = ?", (discord_id,))
                     user_message = f"User {user_info} has been deleted from the database."
                 else:
                     user_message = f"Unregistered user <@{discord_id}>'s submissions have been deleted."
                 
-                db.execute("COMMIT")
-                
                 response = f"{user_message}\n"
                 response += f"Removed {len(deleted_submissions)} submissions from the leaderboard.\n"
                 if submission_info:
@@ -140,7 +139,6 @@ class DeleteUserCog(Cog):
                 
                 await interaction.followup.send(response, ephemeral=True)
             except Exception as e:
-                db.execute("ROLLBACK")
                 await interaction.followup.send(
                     f"Error deleting user: {str(e)}", 
                     ephemeral=True
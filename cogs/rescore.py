@@ -0,0 +1,192 @@
+import asyncio, itertools, json, sqlite3, time
+from dataclasses import dataclass, field
+from typing import Optional
+import discord
+from discord.app_commands import autocomplete, command, describe
+from discord.ext.commands import Cog
+
+from db import db, Perm
+from jobs import QueueFull
+from ranking import rankings
+from run import CompileError, WrongAnswer, fingerprint, judge
+from utils import challenge_ac, challenge_updated, check_user, fmt_time, logger
+
+PROGRESS_INTERVAL = 30.0  # seconds between progress updates
+RETRY_INTERVAL = 5.0      # seconds to wait for room in a full queue
+MAX_RETRIES = 120         # the rescore stops if the queue stays full for this many retries, ie. 10 minutes
+RESCORE_USER = 0          # queue user id of rescore jobs, not a discord id
+
+COUNT_QUERY = "SELECT count(*), count(global_size) FROM submissions WHERE ?1 IS NULL OR comp_id = ?1"
+# submissions still to replay with a fingerprint, so a rescore that was interrupted picks up where it stopped.
+# submissions from before v11 didn't record their launch configuration and can't be replayed
+TODO_QUERY = """
+    SELECT id FROM submissions
+    WHERE (?1 IS NULL OR comp_id = ?1) AND global_size IS NOT NULL AND fingerprint IS NOT ?2
+      AND id NOT IN (SELECT submission_id FROM rescores WHERE fingerprint = ?2)
+    ORDER BY id
+"""
+REPLAY_QUERY = """
+    SELECT s.source, s.type, s.name, s.global_size, s.local_size, s.layouts, s.comp_id, c.tests, c.tolerance
+    FROM submissions s JOIN challenges c ON c.id = s.comp_id WHERE s.id = ?
+"""
+SAVE_QUERY = """
+    INSERT INTO rescores (fingerprint, submission_id, timing, stats, error) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT DO UPDATE SET timing = excluded.timing, stats = excluded.stats, error = excluded.error, created_at = CURRENT_TIMESTAMP
+"""
+# the triggers in db.py keep best_submissions and the changelog up to date, submissions that no longer pass keep their old timing
+PROMOTE_QUERY = """
+    UPDATE submissions SET timing = r.timing, stats = r.stats, fingerprint = r.fingerprint
+    FROM rescores r WHERE r.submission_id = submissions.id AND r.fingerprint = ?2 AND r.timing IS NOT NULL
+      AND (?1 IS NULL OR submissions.comp_id = ?1) AND submissions.fingerprint IS NOT ?2
+    RETURNING submissions.comp_id
+"""
+
+@dataclass
+class Progress:
+    fingerprint: str
+    challenge: Optional[str]
+    total: int       # submissions in scope
+    replayable: int  # of those with a recorded launch configuration
+    todo: int        # of those not replayed with this fingerprint yet
+    timed: int = 0
+    failed: int = 0  # no longer compile or pass the tests
+    errors: int = 0  # eg. timeouts or lost runners, not recorded so the next rescore retries them
+    other: int = 0   # judged on a device with another fingerprint, eg. a runner with a different driver
+    promoted: Optional[int] = None
+    error: Optional[str] = None
+    started: float = field(default_factory=time.monotonic)
+    finished: bool = False
+    touched: set = field(default_factory=set)  # challenges with new rescores since the last refresh
+
+    @property
+    def done(self) -> int: return self.timed + self.failed + self.errors + self.other
+
+    def __str__(self) -> str:
+        elapsed = time.monotonic() - self.started
+        eta = elapsed / self.done * (self.todo - self.done) if self.done else None
+        state = "finished" if self.finished else f"~{fmt_time(eta)} left" if eta is not None else "starting"
+        lines = [f"## Rescore of {f'`{self.challenge}`' if self.challenge else 'every challenge'} with `{self.fingerprint}`",
+                 f"replayed {self.done}/{self.todo} ({self.done / max(self.todo, 1):.0%}) in {fmt_time(elapsed)}, {state}",
+                 f"- {self.timed} timed, {self.failed} no longer pass, {self.errors} errors (retried next time)" + (f", {self.other} judged with other fingerprints" if self.other else ""),
+                 f"- {self.replayable - self.todo} already replayed, {self.total - self.replayable} without a recorded launch configuration"]
+        if self.promoted is not None: lines.append(f"- promoted {self.promoted} timings to the main leaderboards")
+        if self.error: lines.append(f"stopped: {self.error}")
+        return "\n".join(lines)
+
+class RescoreCog(Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.task: Optional[asyncio.Task] = None
+        self.progress: Optional[Progress] = None
+
+    @command()
+    @check_user(Perm.ADMIN)
+    @autocomplete(challenge=challenge_ac)
+    @describe(
+        challenge="Only rescore this challenge, every challenge if not given",
+        promote="Replace the submissions' timings with the new ones once done, eg. after a driver upgrade",
+    )
+    async def rescore(self, interaction: discord.Interaction, challenge: Optional[str] = None, promote: bool = False):
+        """Replay stored submissions on the judging devices and record their timings under the devices' fingerprint"""
+        if self.task is not None and not self.task.done():
+            return await interaction.response.send_message(f"A rescore is already running:\n{self.progress}", ephemeral=True)
+        comp_id = None
+        if challenge is not None:
+            if (row := await db.fetchone("SELECT id FROM challenges WHERE name = ?", (challenge,))) is None:
+                return await interaction.response.send_message(f"Challenge `{challenge}` not found.", ephemeral=True)
+            comp_id = row[0]
+        await interaction.response.send_message("fingerprinting the judging devices...", ephemeral=True)
+
+        jobs = interaction.client.jobs
+        try:
+            fp = await jobs.submit(fingerprint, user_id=RESCORE_USER).future
+        except Exception as e:
+            return await interaction.edit_original_response(content=f"Could not start the rescore: {e}")
+        # interaction responses expire after 15 minutes, a rescore can take hours
+        message = await interaction.channel.send(f"Rescore with `{fp}` starting...")
+        await interaction.edit_original_response(content=f"Rescoring with fingerprint `{fp}`, progress is posted in this channel.")
+        self.task = asyncio.create_task(self.run(jobs, comp_id, challenge, fp, promote, message), name="rescore")
+
+    async def run(self, jobs, comp_id: Optional[int], challenge: Optional[str], fp: str, promote: bool, message: discord.Message):
+        (total, replayable), = await db.fetchall(COUNT_QUERY, (comp_id,))
+        todo = [sub_id for sub_id, in await db.fetchall(TODO_QUERY, (comp_id, fp))]
+        self.progress = progress = Progress(fp, challenge, total, replayable, len(todo))
+        logger.info(f"Rescoring {len(todo)} submissions with {fp}")
+
+        # one replay in flight per device, so user submissions queued meanwhile wait for at most one rescore job per device
+        ids = iter(todo)
+        async def replay_all():
+            for sub_id in ids: await self.replay(jobs, sub_id, fp, progress)
+        reporter = asyncio.create_task(self.report(progress, message))
+        replayers = [asyncio.create_task(replay_all()) for _ in range(jobs.num_workers)]
+        try:
+            await asyncio.gather(*replayers)
+            if promote: progress.promoted = await self.promote(comp_id, fp)
+        except Exception as e:
+            logger.exception("Rescore failed")
+            progress.error = str(e) or repr(e)
+        finally:
+            for task in (reporter, *replayers): task.cancel()  # the other replays stop once one fails
+            progress.finished = True
+            self.refresh(progress)
+            logger.info(f"Rescore with {fp} finished: {progress.done}/{progress.todo} replayed, {progress.errors} errors")
+            try: await message.edit(content=str(progress))
+            except discord.HTTPException: pass
+
+    async def replay(self, jobs, sub_id: int, fp: str, progress: Progress):
+        if (row := await db.fetchone(REPLAY_QUERY, (sub_id,))) is None:
+            progress.todo -= 1  # deleted since the rescore started
+            return
+        src, ktype, name, global_size, local_size, layouts, comp_id, tests, tolerance = row
+        args = (src, ktype, name, tuple(json.loads(global_size)), tuple(json.loads(local_size)), tests,
+                json.loads(layouts) if layouts else [], comp_id, json.loads(tolerance) if tolerance else None)
+        for retries in itertools.count():
+            try:
+                job = jobs.submit(judge, *args, user_id=RESCORE_USER, max_per_user=jobs.max_queued)
+                break
+            except QueueFull as e:
+                # waiting doesn't bring back devices that failed to start, nor a bot that is shutting down
+                if jobs.closing or (jobs.unavailable and not jobs.slots): raise
+                if retries >= MAX_RETRIES: raise QueueFull(f"the judging queue stayed full for {fmt_time(retries * RETRY_INTERVAL)}: {e}") from e
+                await asyncio.sleep(RETRY_INTERVAL)
+
+        timing, stats, error, got = None, None, None, fp
+        try:
+            timing, stats = await job.future
+            got = stats["fingerprint"]
+        except (CompileError, WrongAnswer) as e:
+            error = f"{'compile error' if isinstance(e, CompileError) else 'wrong answer'}: {e}"
+        except Exception as e:
+            logger.warning(f"Rescore of submission {sub_id} failed: {e}")
+            progress.errors += 1
+            return
+        try: await db.execute(SAVE_QUERY, (got, sub_id, timing, json.dumps(stats) if stats else None, error))
+        except sqlite3.IntegrityError:
+            progress.todo -= 1  # deleted while it was being replayed
+            return
+        progress.touched.add(comp_id)
+        if got != fp: progress.other += 1
+        elif error: progress.failed += 1
+        else: progress.timed += 1
+
+    def refresh(self, progress: Progress):
+        # the fingerprint boards of the rescored challenges changed, the main ones only change when promoting
+        for comp_id in progress.touched:
+            rankings.drop(comp_id, progress.fingerprint)
+            challenge_updated(comp_id)
+        progress.touched.clear()
+
+    async def report(self, progress: Progress, message: discord.Message):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            self.refresh(progress)
+            logger.info(f"Rescore with {progress.fingerprint}: {progress.done}/{progress.todo} replayed, {progress.errors} errors")
+            try: await message.edit(content=str(progress))
+            except discord.HTTPException as e: logger.warning(f"Could not update the rescore progress: {e}")
+
+    async def promote(self, comp_id: Optional[int], fp: str) -> int:
+        rows = await db.execute(PROMOTE_QUERY, (comp_id, fp))
+        for cid in {cid for cid, in rows}:
+            rankings.drop(cid)
+            challenge_updated(cid)
+        return len(rows)
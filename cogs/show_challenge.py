@@ -3,23 +3,24 @@ import discord
 from discord.app_commands import autocomplete, command, describe
 from discord.ext.commands import Cog
 
-from utils import active_chals, challenge_ac, make_leaderboard
+from utils import active_chals, challenge_ac, fingerprint_ac, make_leaderboard
 from db import db, Perm
 from utils import check_user
 
 class ShowCog(Cog):
   @command()
   @check_user(Perm.USER, Perm.ADMIN)
-  @autocomplete(challenge=challenge_ac)
+  @autocomplete(challenge=challenge_ac, fingerprint=fingerprint_ac)
   @describe(
     challenge="Name of the challenge to show submissions for",
+    fingerprint="Only rank timings measured on this device, toolchain and method, eg. after a rescore",
   )
-  async def show(self, interaction: discord.Interaction, challenge:Optional[str]):
+  async def show(self, interaction: discord.Interaction, challenge:Optional[str], fingerprint:Optional[str]=None):
     """Show leaderboard for a challenge"""
     await interaction.response.send_message("generating listing...", ephemeral=True)
     if challenge is None:
-      await interaction.edit_original_response(content="## Active Challenges\n" + "\n".join([f"- `{chal}`" for chal in active_chals()]))
+      await interaction.edit_original_response(content="## Active Challenges\n" + "\n".join([f"- `{chal}`" for chal in await active_chals()]))
     else:
       # Get the leaderboard with medals for top 3
-      leaderboard = make_leaderboard(challenge, with_medals=True)
+      leaderboard = await make_leaderboard(challenge, with_medals=True, fingerprint=fingerprint)
       await interaction.edit_original_response(content=leaderboard)
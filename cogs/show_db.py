@@ -15,17 +15,20 @@ class ShowDBCog(Cog):
         
         if table is None:
             # Show available tables
-            tables = db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+            tables = await db.fetchall("SELECT name FROM sqlite_master WHERE type='table'")
             table_list = "\n".join([f"- `{table[0]}`" for table in tables])
             await interaction.followup.send(f"## Database Tables\n{table_list}\nUse `/showdb table_name` to view contents.")
         else:
             try:
-                rows = db.execute(f"SELECT * FROM {table} LIMIT 100").fetchall()
+                def select(conn):
+                    cur = conn.execute(f"SELECT * FROM {table} LIMIT 100")
+                    return cur.description, cur.fetchall()
+                description, rows = await db.read(select)
                 if not rows:
                     await interaction.followup.send(f"Table `{table}` exists but contains no data.")
                     return
                     
-                headers = [description[0] for description in db.execute(f"SELECT * FROM {table} LIMIT 1").description]
+                headers = [column[0] for column in description]
                 header_row = " | ".join(headers)
                 separator = "-" * len(header_row)
                 
@@ -45,7 +48,7 @@ class ShowDBCog(Cog):
     @showdb.autocomplete('table')
     async def table_autocomplete(self, interaction: discord.Interaction, current: str):
         """Provides autocomplete for database table names"""
-        tables = db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        tables = await db.fetchall("SELECT name FROM sqlite_master WHERE type='table'")
         table_names = [table[0] for table in tables]
         return [
             Choice(name=name, value=name) 
@@ -21,18 +21,18 @@ class ShowSubmissionsCog(Cog):
         # Only allow viewing your own submissions
         target_user = interaction.user
         
-        challenge_exists = db.execute("SELECT 1 FROM challenges WHERE name = ?", (challenge,)).fetchone()
+        challenge_exists = await db.fetchone("SELECT 1 FROM challenges WHERE name = ?", (challenge,))
         if not challenge_exists:
             await interaction.followup.send(f"Challenge `{challenge}` not found.", ephemeral=True)
             return
             
-        submissions = db.execute("""
+        submissions = await db.fetchall("""
             SELECT s.name, s.type, s.timing, s.created_at
             FROM submissions s
             JOIN challenges c ON s.comp_id = c.id
             WHERE c.name = ? AND s.user_id = ?
             ORDER BY s.timing ASC
-        """, (challenge, str(target_user.id))).fetchall()
+        """, (challenge, str(target_user.id)))
         
         if not submissions:
             await interaction.followup.send(f"You have no submissions for challenge `{challenge}`.", ephemeral=True)
@@ -67,18 +67,18 @@ class ShowSubmissionsCog(Cog):
         """Admin command to view any user's submissions for a challenge"""
         await interaction.response.defer(ephemeral=True)
         
-        challenge_exists = db.execute("SELECT 1 FROM challenges WHERE name = ?", (challenge,)).fetchone()
+        challenge_exists = await db.fetchone("SELECT 1 FROM challenges WHERE name = ?", (challenge,))
         if not challenge_exists:
             await interaction.followup.send(f"Challenge `{challenge}` not found.", ephemeral=True)
             return
             
-        submissions = db.execute("""
+        submissions = await db.fetchall("""
             SELECT s.name, s.type, s.timing, s.created_at
             FROM submissions s
             JOIN challenges c ON s.comp_id = c.id
             WHERE c.name = ? AND s.user_id = ?
             ORDER BY s.timing ASC
-        """, (challenge, str(user.id))).fetchall()
+        """, (challenge, str(user.id)))
         
         if not submissions:
             await interaction.followup.send(f"{user.display_name} has no submissions for challenge `{challenge}`.", ephemeral=True)
@@ -1,11 +1,16 @@
+import json
+from typing import Optional
 import discord
 from discord.app_commands import autocomplete, command, describe
 from discord.ext.commands import Cog
 
-from run import cc, run_tests, ktypes, ktype_ac
-from utils import check_user, convert_literals, challenge_ac, make_leaderboard, format_submission_result, get_submission_position
-from utils import get_ordinal, format_time
+from jobs import QueueFull
+from run import CompileError, WrongAnswer, judge, ktypes
+from utils import check_user, convert_literals, ktype_ac, challenge_ac, challenge_updated, format_submission_result
+from utils import get_ordinal, fmt_time, try_edit
 from db import db, Perm
+from ranking import Entry, rankings
+from layouts import ROW, resolve
 
 class SubmitCog(Cog):
 
@@ -15,60 +20,69 @@ class SubmitCog(Cog):
   @convert_literals
   async def submit(self, interaction: discord.Interaction, challenge:str, ktype:str, name:str, 
                   global_size:tuple[int,int,int], local_size:tuple[int,int,int], 
-                   kernel:discord.Attachment, transpose_a:bool=False, transpose_b:bool=False):
+                   kernel:discord.Attachment, transpose_a:bool=False, transpose_b:bool=False, layouts:Optional[str]=None):
     """Submit a kernel for a challenge"""
     await interaction.response.send_message("checking...", ephemeral=True)
-    if ktype not in ktypes: return await interaction.response.send_message("invalid ktype", ephemeral=True)
-    chal, tensors = db.execute("SELECT id, tests FROM challenges as c WHERE c.name = ?", (challenge,)).fetchone()
-    if chal is None: return await interaction.response.send_message(f"could not find challenge {challenge}", ephemeral=True)
+    if ktype not in ktypes: return await interaction.edit_original_response(content="invalid ktype")
+    row = await db.fetchone("SELECT id, tests, tolerance, layouts FROM challenges as c WHERE c.name = ?", (challenge,))
+    if row is None: return await interaction.edit_original_response(content=f"could not find challenge {challenge}")
+    chal, tests, tolerance, offered = row
     
-    if challenge.lower() != "matmul" and (transpose_a or transpose_b):
-        await interaction.edit_original_response(content="Transpose options are only available for matmul challenge")
-        return
+    # one comma-separated layout per input, transpose_a/b are shorthands for a column-major first/second input
+    requested = [l.strip() for l in layouts.split(",")] if layouts else []
+    for i, t in enumerate((transpose_a, transpose_b)):
+      if t:
+        requested += [ROW] * (i + 1 - len(requested))
+        requested[i] = "col"
+    try: requested = resolve(requested, json.loads(offered) if offered else [ROW])
+    except ValueError as e: return await interaction.edit_original_response(content=str(e))
         
     await interaction.edit_original_response(content="downloading...")
     src = (await kernel.read()).decode("utf-8")
-    await interaction.edit_original_response(content="compiling...")
+
+    jobs = interaction.client.jobs
+    try:
+      job = jobs.submit(judge, src, ktype, name, global_size, local_size, tests, requested, chal,
+                        json.loads(tolerance) if tolerance else None, user_id=interaction.user.id)
+    except QueueFull as e:
+      return await interaction.edit_original_response(content=f"Submission rejected: {e}")
+    await interaction.edit_original_response(content=jobs.status(job))
 
     try: 
-      prog = cc(src, ktype, name)
-    except Exception as e: 
+      tm, stats = await jobs.wait(job, lambda job: interaction.edit_original_response(content=jobs.status(job)))
+    except CompileError as e: 
       # Capture detailed error message with code snippet
       error_msg = str(e)
       formatted_error = f"```\n{error_msg}\n```"
-      return await interaction.edit_original_response(content=f"Failed to compile:\n{formatted_error}")
-    
-    await interaction.edit_original_response(content="running...")
-    try: 
-      tm = run_tests(prog, global_size, local_size, tensors, challenge, transpose_a, transpose_b)
+      return await try_edit(interaction, f"Failed to compile:\n{formatted_error}")
+    except WrongAnswer as e:
+      return await try_edit(interaction, f"Wrong answer:\n```\n{e}\n```")
     except Exception as e: 
       error_msg = str(e)
       formatted_error = f"```\n{error_msg}\n```"
-      return await interaction.edit_original_response(content=f"Error while running tests:\n{formatted_error}")
+      return await try_edit(interaction, f"Error while running tests:\n{formatted_error}")
     print("avg time:", tm) 
-    db.execute("INSERT INTO submissions (name, type, source, comp_id, user_id, timing) VALUES (?, ?, ?, ?, ?, ?);",
-              (name, ktype, src, chal, interaction.user.id, tm))
-    db.commit()
-    make_leaderboard.cache_clear()
-    
-    result = format_submission_result(challenge, str(interaction.user.id), name, ktype, tm)
-    await interaction.edit_original_response(content=f"{result}")
+    # the launch configuration is kept so the submission can be replayed exactly, see cogs/rescore.py
+    (sub_id,), = await db.execute("INSERT INTO submissions (name, type, source, comp_id, user_id, timing, stats, layouts, global_size, local_size, fingerprint) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id;",
+                                  (name, ktype, src, chal, interaction.user.id, tm, json.dumps(stats),
+                                   json.dumps(requested) if any(l != ROW for l in requested) else None,
+                                   json.dumps(global_size), json.dumps(local_size), stats.get("fingerprint")))
     
-    # Check if this is the user's BEST submission for this challenge
-    is_personal_best = db.execute("""
-        SELECT MIN(timing) = ? 
-        FROM submissions 
-        WHERE comp_id = ? AND user_id = ?
-    """, (tm, chal, interaction.user.id)).fetchone()[0]
+    is_personal_best = await rankings.submit(chal, Entry(interaction.user.id, sub_id, tm, name, ktype), stats.get("fingerprint"))
+    board = await rankings.board(chal)
+    challenge_updated(chal)
+    position = board.rank(interaction.user.id)
     
-    position = get_submission_position(challenge, interaction.user.id)
+    result = format_submission_result(board, challenge, interaction.user.id, name, ktype, tm, stats)
+    await try_edit(interaction, result)
     
     message = f"<@{interaction.user.id}>'s submission with id `{name}` to leaderboard `{challenge}`:\n"
     
     if is_personal_best and position <= 3:
         medal_emoji = "🥇 " if position == 1 else "🥈 " if position == 2 else "🥉 "
-        message += f"{medal_emoji}{get_ordinal(position)} place on {challenge}: {format_time(tm)}"
+        message += f"{medal_emoji}{get_ordinal(position)} place on {challenge}: {fmt_time(tm)}"
     else:
-        message += f"{challenge}: {format_time(tm)}"
+        message += f"{challenge}: {fmt_time(tm)}"
     
     await interaction.channel.send(message)
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import numpy as np
+
+CHUNK = 1 << 20  # elements compared at a time, bounds the temporaries to a few MB whatever the output size
+
+@dataclass(frozen=True)
+class Tolerance:
+  """An element matches if |out - expected| <= atol + rtol * |expected|, or with ulps set,
+  if it is within that many units in the last place of expected (or within atol, for values near zero)."""
+  rtol: float = 0.0
+  atol: float = 0.0
+  ulps: Optional[int] = None
+
+  @staticmethod
+  def from_dict(d:Optional[dict]) -> Optional['Tolerance']: return Tolerance(**d) if d else None
+  def to_dict(self) -> dict: return {k: v for k, v in asdict(self).items() if v is not None}
+
+# reference and submission usually differ in summation order, these leave room for that at each precision
+PRESETS = {
+  np.dtype(np.float16): Tolerance(rtol=1e-2, atol=1e-2),
+  np.dtype(np.float32): Tolerance(rtol=1e-3, atol=1e-3),
+  np.dtype(np.float64): Tolerance(rtol=1e-5, atol=1e-5),
+}
+EXACT = Tolerance()  # integers and booleans
+
+def default_tolerance(dtype:np.dtype) -> Tolerance: return PRESETS.get(np.dtype(dtype), EXACT)
+
+def custom_tolerance(dtype:np.dtype, rtol:Optional[float]=None, atol:Optional[float]=None, ulps:Optional[int]=None) -> Optional[Tolerance]:
+  """A challenge's tolerance from the bounds its creator gave, None keeps the dtype's default. Left out bounds come from
+  the preset, except that a ulps tolerance only allows the atol and rtol given explicitly."""
+  if rtol is None and atol is None and ulps is None: return None
+  base = Tolerance() if ulps is not None else default_tolerance(dtype)
+  return Tolerance(rtol=base.rtol if rtol is None else rtol, atol=base.atol if atol is None else atol, ulps=ulps)
+
+@dataclass
+class Mismatch:
+  """Statistics of a comparison, the errors are maxima over all elements (matching ones, eg. nan where both are nan, count as 0)."""
+  size: int
+  bad: int = 0
+  first: Optional[int] = None         # flat index of the first mismatch
+  got: Optional[float] = None         # values at first
+  expected: Optional[float] = None
+  max_abs: float = 0.0
+  max_rel: float = 0.0
+  max_ulps: Optional[int] = None
+
+  @property
+  def ok(self) -> bool: return self.bad == 0
+  def to_dict(self) -> dict: return asdict(self)
+
+  def merge(self, other:'Mismatch', offset:int) -> 'Mismatch':
+    """Fold in the statistics of a later chunk starting at flat index offset."""
+    if other.bad and self.first is None: self.first, self.got, self.expected = other.first + offset, other.got, other.expected
+    self.bad += other.bad
+    self.max_abs, self.max_rel = max(self.max_abs, other.max_abs), max(self.max_rel, other.max_rel)
+    if other.max_ulps is not None: self.max_ulps = max(self.max_ulps or 0, other.max_ulps)
+    return self
+
+  def summary(self, shape:tuple) -> str:
+    if self.ok: return f"all {self.size} elements match"
+    first = tuple(int(x) for x in np.unravel_index(self.first, shape))
+    return (f"{self.bad} of {self.size} elements differ, first at {first}: got {self.got}, expected {self.expected}; "
+            f"max abs error {self.max_abs:.3g}, max rel error {self.max_rel:.3g}"
+            + (f", max {self.max_ulps} ulps" if self.max_ulps is not None else ""))
+
+_UINTS = {2: np.uint16, 4: np.uint32, 8: np.uint64}
+
+def ulp_distance(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+  """Number of representable floats between a and b, as unsigned integers of the same width."""
+  ut = _UINTS[a.dtype.itemsize]
+  sign = ut(1) << ut(8 * a.dtype.itemsize - 1)
+  def ordered(x):  # maps floats onto unsigned integers in the same order
+    u = x.view(ut)
+    return np.where(u & sign, ~u, u | sign)
+  oa, ob = ordered(a), ordered(b)
+  return np.where(oa >= ob, oa - ob, ob - oa)
+
+def _compare_chunk(out:np.ndarray, expected:np.ndarray, tol:Tolerance) -> Mismatch:
+  res = Mismatch(out.size)
+  with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+    # float32 is exact enough for the errors of half and single outputs and halves the memory traffic of float64
+    wt = np.float64 if out.dtype.itemsize > 4 or out.dtype.kind != "f" else np.float32
+    diff, mag = np.abs(out.astype(wt) - expected.astype(wt)), np.abs(expected.astype(wt))
+    if out.dtype.kind != "f": bad = out != expected
+    else:
+      if tol.ulps is not None:
+        ulps = ulp_distance(out, expected.astype(out.dtype, copy=False))
+        bad = ~(diff <= tol.atol) & (ulps > tol.ulps)  # a nan diff is never within atol
+      else: bad = ~(diff <= tol.atol + tol.rtol * mag)
+      # equal values (infinities included) and nan where expected is nan count as matches, any other nan doesn't
+      same = (out == expected) | (np.isnan(out) & np.isnan(expected))
+      bad &= ~same
+      diff[np.isnan(diff)] = np.inf
+      diff[same] = 0
+      if tol.ulps is not None: res.max_ulps = int(np.where(same, 0, ulps).max(initial=0))
+    if diff.size:
+      res.max_abs = float(np.max(diff))
+      res.max_rel = float(np.max(np.divide(diff, mag, out=np.where(diff > 0, np.inf, 0.0), where=mag > 0)))
+  if (nbad:=int(np.count_nonzero(bad))):
+    idx = int(np.argmax(bad))
+    res.bad, res.first, res.got, res.expected = nbad, idx, out[idx].item(), expected[idx].item()
+  return res
+
+def compare(out:np.ndarray, expected:np.ndarray, tol:Optional[Tolerance]=None, threads:int=1, chunk:int=CHUNK) -> Mismatch:
+  """Compare out against expected in chunks of flat elements, on up to threads threads (numpy releases the GIL)."""
+  assert out.shape == expected.shape, f"output shape {out.shape} doesn't match expected {expected.shape}"
+  if tol is None: tol = default_tolerance(expected.dtype)
+  a, b = out.reshape(-1), expected.reshape(-1)
+  starts = range(0, a.size, chunk)
+  work = lambda st: _compare_chunk(a[st:st+chunk], b[st:st+chunk], tol)
+  if threads > 1 and len(starts) > 1:
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="compare") as pool: parts = list(pool.map(work, starts))
+  else: parts = map(work, starts)
+  res = Mismatch(a.size)
+  for st, part in zip(starts, parts): res.merge(part, st)
+  return res
@@ -1,11 +1,16 @@
-import sqlite3
+import asyncio, hashlib, logging, os, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
+from typing import Any, Callable, Optional
+
+import store
 
 DB = "kernelbot.db"
+READERS = 4           # read-only connections, ie. queries that can run at once
+BUSY_TIMEOUT = 5000   # ms a connection waits for another writer (eg. register) before "database is locked"
 
-# high byte: major version
-# low byte: minor version
-SCHEMA_VERSION = 0x0001
+log = logging.getLogger(__name__)
 
 USERS_SCHEMA = """users (
   id       INTEGER PRIMARY KEY,       -- discord id
@@ -16,10 +21,12 @@ CHALLENGES_SCHEMA = """challenges (
   id         INTEGER PRIMARY KEY AUTOINCREMENT,          -- unique id
   name       TEXT NOT NULL UNIQUE,                       -- name of challenge
   desc       TEXT,                                       -- description of challenge
-  creator_id INTEGER NOT NULL REFERENCES users(discord), -- discord id of challenge creator
-  tests      BLOB NOT NULL,                              -- safetensors
+  creator_id INTEGER NOT NULL,                           -- discord id of challenge creator
+  tests      TEXT NOT NULL,                              -- sha256 of the safetensors file in store.TESTS_DIR
   flops      INTEGER,                                    -- estimated flopcount [optional]
   timing     REAL,                                       -- test timing [optional]
+  tolerance  TEXT,                                       -- compare.Tolerance (json), default by dtype if NULL
+  layouts    TEXT,                                       -- input layouts submissions may pick (json list), see layouts.py
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )"""
 SUBMISSIONS_SCHEMA = """submissions (
@@ -27,31 +34,365 @@ SUBMISSIONS_SCHEMA = """submissions (
   name      TEXT NOT NULL,                              -- submission name
   type      TEXT NOT NULL,                              -- eg. CUDA, PTX
   source    TEXT NOT NULL,                              -- source code
-  comp_id   INTEGER NOT NULL REFERENCES challenges(id), -- competition id
-  user_id   INTEGER NOT NULL REFERENCES users(discord), -- discord id of creator
+  comp_id   INTEGER NOT NULL REFERENCES challenges(id) ON DELETE CASCADE, -- competition id
+  user_id   INTEGER NOT NULL,                           -- discord id of creator, who may not be registered
   timing    REAL NOT NULL,                              -- test timing
   transpose_a BOOLEAN DEFAULT 0,                        -- whether A was transposed
   transpose_b BOOLEAN DEFAULT 0,                        -- whether B was transposed
+  stats     TEXT,                                       -- benchmark statistics (json)
+  layouts   TEXT,                                       -- layout of every input (json list), NULL if all row-major
+  global_size TEXT,                                     -- launch grid (json), NULL for submissions older than v11
+  local_size  TEXT,                                     -- launch block (json), NULL for submissions older than v11
+  fingerprint TEXT,                                     -- device, toolchain and method timing was measured with, see run.fingerprint
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 )"""
 
-def init_db():
-  db = sqlite3.connect(DB)
+# best submission of every user per challenge, kept up to date by the triggers below
+BEST_SUBMISSIONS_SCHEMA = """best_submissions (
+  comp_id       INTEGER NOT NULL,                       -- competition id
+  user_id       INTEGER NOT NULL,                       -- discord id of creator
+  submission_id INTEGER NOT NULL,                       -- submissions(id) of the best one
+  timing        REAL NOT NULL,                          -- its timing
+  PRIMARY KEY (comp_id, user_id)
+) WITHOUT ROWID"""
+def _recompute_best(row:str) -> str: return f"""
+    DELETE FROM best_submissions WHERE comp_id = {row}.comp_id AND user_id = {row}.user_id;
+    INSERT INTO best_submissions (comp_id, user_id, submission_id, timing)
+      SELECT comp_id, user_id, id, timing FROM submissions WHERE comp_id = {row}.comp_id AND user_id = {row}.user_id
+      ORDER BY timing, id LIMIT 1;"""
+BEST_SUBMISSIONS_DDL = [
+  "CREATE INDEX IF NOT EXISTS best_submissions_rank ON best_submissions (comp_id, timing, submission_id);",
+  "CREATE INDEX IF NOT EXISTS submissions_best ON submissions (comp_id, user_id, timing);",
+  """CREATE TRIGGER IF NOT EXISTS best_submissions_insert AFTER INSERT ON submissions BEGIN
+    INSERT INTO best_submissions (comp_id, user_id, submission_id, timing) VALUES (NEW.comp_id, NEW.user_id, NEW.id, NEW.timing)
+    ON CONFLICT (comp_id, user_id) DO UPDATE SET submission_id = excluded.submission_id, timing = excluded.timing
+    WHERE excluded.timing < best_submissions.timing;
+  END;""",
+  # deleting or rescoring a user's best submission promotes their next best one
+  f"""CREATE TRIGGER IF NOT EXISTS best_submissions_delete AFTER DELETE ON submissions
+  WHEN OLD.id IN (SELECT submission_id FROM best_submissions WHERE comp_id = OLD.comp_id AND user_id = OLD.user_id) BEGIN{_recompute_best("OLD")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS best_submissions_update AFTER UPDATE OF timing, comp_id, user_id ON submissions BEGIN{_recompute_best("OLD")}{_recompute_best("NEW")}
+  END;""",
+]
+# every change that can affect the public leaderboard, so db_export.py only has to apply what changed since its
+# last run. the exporter deletes the entries it applied, so the table stays small as long as one runs
+CHANGELOG_SCHEMA = """changelog (
+  seq     INTEGER PRIMARY KEY AUTOINCREMENT,
+  tbl     TEXT NOT NULL,                                -- submissions, challenges or users
+  comp_id INTEGER,                                      -- challenge whose leaderboard changed
+  user_id INTEGER                                       -- user whose entry or name changed
+)"""
+# fingerprint of the command tree and permissions last synced to each guild, see KernelBot.sync_guild
+GUILD_SYNCS_SCHEMA = """guild_syncs (
+  guild_id    INTEGER PRIMARY KEY,
+  fingerprint TEXT NOT NULL,                            -- sha256 of the synced payload
+  synced_at   TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)"""
+
+# timings of submissions replayed under another device, toolchain or method, see cogs/rescore.py
+RESCORES_SCHEMA = """rescores (
+  fingerprint   TEXT NOT NULL,                          -- run.fingerprint the submission was replayed with
+  submission_id INTEGER NOT NULL REFERENCES submissions(id) ON DELETE CASCADE,
+  timing        REAL,                                   -- NULL if it failed, see error
+  stats         TEXT,                                   -- benchmark statistics (json)
+  error         TEXT,                                   -- why it no longer passes, eg. a compile error under a new toolchain
+  created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (fingerprint, submission_id)
+) WITHOUT ROWID"""
+
+def _log_change(tbl:str, comp_id:str="NULL", user_id:str="NULL") -> str:
+  return f"\n    INSERT INTO changelog (tbl, comp_id, user_id) VALUES ('{tbl}', {comp_id}, {user_id});"
+CHANGELOG_DDL = [
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_submissions_insert AFTER INSERT ON submissions BEGIN{_log_change("submissions", "NEW.comp_id", "NEW.user_id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_submissions_update AFTER UPDATE ON submissions BEGIN{_log_change("submissions", "OLD.comp_id", "OLD.user_id")}{_log_change("submissions", "NEW.comp_id", "NEW.user_id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_submissions_delete AFTER DELETE ON submissions BEGIN{_log_change("submissions", "OLD.comp_id", "OLD.user_id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_challenges_insert AFTER INSERT ON challenges BEGIN{_log_change("challenges", "NEW.id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_challenges_update AFTER UPDATE ON challenges BEGIN{_log_change("challenges", "NEW.id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_challenges_delete AFTER DELETE ON challenges BEGIN{_log_change("challenges", "OLD.id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_users_insert AFTER INSERT ON users BEGIN{_log_change("users", user_id="NEW.id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_users_update AFTER UPDATE ON users BEGIN{_log_change("users", user_id="NEW.id")}
+  END;""",
+  f"""CREATE TRIGGER IF NOT EXISTS changelog_users_delete AFTER DELETE ON users BEGIN{_log_change("users", user_id="OLD.id")}
+  END;""",
+]
+
+INDEXES = [
+  "CREATE INDEX IF NOT EXISTS submissions_user ON submissions (user_id, comp_id, timing);",
+  "CREATE INDEX IF NOT EXISTS challenges_creator ON challenges (creator_id);",
+]
+
+@dataclass(frozen=True)
+class Migration:
+  version: int
+  desc: str
+  fn: Callable[..., None]
+  foreign_keys_off: bool = False  # rebuilds a table, so foreign key enforcement is paused around it
+  files: bool = False             # changes files on disk, fn takes dry_run and only reports what it would change then
+  vacuum: bool = False            # frees enough space to be worth a VACUUM afterwards
+
+def create_tables(db:sqlite3.Connection):
+  """v1: the base tables"""
+  for schema in (USERS_SCHEMA, CHALLENGES_SCHEMA, SUBMISSIONS_SCHEMA): db.execute(f"CREATE TABLE IF NOT EXISTS {schema};")
+
+def add_column(db:sqlite3.Connection, table:str, coldef:str):
+  if coldef.split()[0] not in [r[1] for r in db.execute(f"PRAGMA table_info({table});")]:
+    db.execute(f"ALTER TABLE {table} ADD COLUMN {coldef};")
+
+def migrate_tests_to_store(db:sqlite3.Connection, dry_run:bool=False):
+  """v2: move safetensors BLOBs out of challenges.tests into the on-disk store, keeping only their hash"""
+  ids, nbytes = db.execute("SELECT id FROM challenges WHERE typeof(tests) = 'blob';").fetchall(), 0
+  for cid, in ids:
+    blob = db.execute("SELECT tests FROM challenges WHERE id = ?;", (cid,)).fetchone()[0]
+    nbytes += len(blob)
+    db.execute("UPDATE challenges SET tests = ? WHERE id = ?;", (hashlib.sha256(blob).hexdigest() if dry_run else store.put(blob), cid))
+  if dry_run and ids: log.info(f"  would write {len(ids)} test files ({nbytes / 2**20:.1f}MB) to {store.TESTS_DIR}")
+
+def rebuild_best_submissions(db:sqlite3.Connection):
+  """v4: (re)create best_submissions and its triggers, then backfill it from submissions"""
+  db.execute("DROP TABLE IF EXISTS best_submissions;")
+  db.execute(f"CREATE TABLE {BEST_SUBMISSIONS_SCHEMA};")
+  for stmt in BEST_SUBMISSIONS_DDL: db.execute(stmt)
+  db.execute("""
+    INSERT INTO best_submissions (comp_id, user_id, submission_id, timing)
+    SELECT comp_id, user_id, id, timing FROM (
+      SELECT comp_id, user_id, id, timing, ROW_NUMBER() OVER (PARTITION BY comp_id, user_id ORDER BY timing, id) AS rn
+      FROM submissions
+    ) WHERE rn = 1;
+  """)
+
+def add_indexes(db:sqlite3.Connection):
+  """v5: covering indexes for the leaderboard, per-user history and user autocomplete queries"""
+  db.execute("DROP INDEX IF EXISTS best_submissions_rank;")  # v4 created it without submission_id
+  for stmt in BEST_SUBMISSIONS_DDL + INDEXES: db.execute(stmt)
+
+def cascade_deletes(db:sqlite3.Connection):
+  """v6: rebuild submissions so deleting a challenge deletes its submissions, and drop the references to the
+  nonexistent users(discord) column, which foreign key enforcement would reject"""
+  # orphans of challenges deleted before this were never shown anywhere and would fail the foreign key check
+  db.execute("DELETE FROM submissions WHERE comp_id NOT IN (SELECT id FROM challenges);")
+  rebuild_table(db, "challenges", CHALLENGES_SCHEMA)
+  rebuild_table(db, "submissions", SUBMISSIONS_SCHEMA)
+  for stmt in BEST_SUBMISSIONS_DDL + INDEXES: db.execute(stmt)
+
+def add_changelog(db:sqlite3.Connection):
+  """v7: log leaderboard changes for the incremental export"""
+  db.execute(f"CREATE TABLE IF NOT EXISTS {CHANGELOG_SCHEMA};")
+  for stmt in CHANGELOG_DDL: db.execute(stmt)
+
+def add_layouts(db:sqlite3.Connection):
+  """v9: declared input layouts, matmul keeps offering the transposed inputs it had as a special case"""
+  add_column(db, "challenges", "layouts TEXT")
+  add_column(db, "submissions", "layouts TEXT")
+  db.execute("""UPDATE challenges SET layouts = '["row", "col"]' WHERE lower(name) = 'matmul';""")
+  db.execute("""UPDATE submissions SET layouts = json_array(CASE WHEN transpose_a THEN 'col' ELSE 'row' END,
+                                                  CASE WHEN transpose_b THEN 'col' ELSE 'row' END)
+                WHERE transpose_a OR transpose_b;""")
+
+def add_rescores(db:sqlite3.Connection):
+  """v11: record launch configurations and timing fingerprints, so submissions can be replayed exactly"""
+  for col in ("global_size TEXT", "local_size TEXT", "fingerprint TEXT"): add_column(db, "submissions", col)
+  db.execute(f"CREATE TABLE IF NOT EXISTS {RESCORES_SCHEMA};")
+  db.execute("CREATE INDEX IF NOT EXISTS submissions_fingerprint ON submissions (fingerprint, comp_id);")
+  db.execute("CREATE INDEX IF NOT EXISTS rescores_submission ON rescores (submission_id);")  # for the cascading delete
+
+def move_test_store(db:sqlite3.Connection, dry_run:bool=False):
+  """v12: the test store moved from tests/ to testdata/, leaving tests/ to a test suite"""
+  if os.path.isdir(store.OLD_TESTS_DIR) and not os.path.exists(store.TESTS_DIR):
+    if dry_run: log.info(f"  would rename {store.OLD_TESTS_DIR}/ to {store.TESTS_DIR}/")
+    else: os.rename(store.OLD_TESTS_DIR, store.TESTS_DIR)
+
+def sweep_tests(db:sqlite3.Connection) -> int:
+  """Delete stored test files of deleted or regenerated challenges, returns how many."""
+  return store.sweep({digest for digest, in db.execute("SELECT tests FROM challenges;")})
+
+def rebuild_table(db:sqlite3.Connection, table:str, schema:str):
+  """Recreate a table from its current schema keeping its rows, for changes ALTER TABLE can't make.
+  Its indexes and triggers are dropped with it and have to be recreated by the caller."""
+  cols = ", ".join(r[1] for r in db.execute(f"PRAGMA table_info({table});"))
+  seq = db.execute("SELECT seq FROM sqlite_sequence WHERE name = ?;", (table,)).fetchone() if "AUTOINCREMENT" in schema else None
+  db.execute(f"CREATE TABLE {schema.replace(table, f'{table}_new', 1)};")
+  db.execute(f"INSERT INTO {table}_new ({cols}) SELECT {cols} FROM {table};")
+  db.execute(f"DROP TABLE {table};")
+  db.execute(f"ALTER TABLE {table}_new RENAME TO {table};")
+  # AUTOINCREMENT ids must never be reused (see tcache.invalidate), even those of rows deleted before the rebuild
+  if seq: db.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?;", (seq[0], table))
+
+MIGRATIONS = [
+  Migration(1, "create tables", create_tables),
+  Migration(2, "move test data to the store", migrate_tests_to_store, vacuum=True, files=True),
+  Migration(3, "add submissions.stats", lambda db: add_column(db, "submissions", "stats TEXT")),
+  Migration(4, "add best_submissions", rebuild_best_submissions),
+  Migration(5, "add indexes", add_indexes),
+  Migration(6, "cascade challenge deletes to submissions", cascade_deletes, foreign_keys_off=True),
+  Migration(7, "add changelog", add_changelog),
+  Migration(8, "add challenges.tolerance", lambda db: add_column(db, "challenges", "tolerance TEXT")),
+  Migration(9, "add input layouts", add_layouts),
+  Migration(10, "add guild_syncs", lambda db: db.execute(f"CREATE TABLE IF NOT EXISTS {GUILD_SYNCS_SCHEMA};")),
+  Migration(11, "add launch configurations and rescores", add_rescores),
+  Migration(12, "move the test store to testdata/", move_test_store, files=True),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+def pending(db:sqlite3.Connection) -> list[Migration]:
   version = db.execute("PRAGMA user_version").fetchone()[0]
-  assert version & 0xFF00 == SCHEMA_VERSION & 0xFF00, "database migration required"
-  if version & 0xFF < SCHEMA_VERSION & 0xFF:
-    cur = db.cursor()
-    cur.execute(f"CREATE TABLE IF NOT EXISTS {USERS_SCHEMA};")
-    cur.execute(f"CREATE TABLE IF NOT EXISTS {CHALLENGES_SCHEMA};")
-    cur.execute(f"CREATE TABLE IF NOT EXISTS {SUBMISSIONS_SCHEMA};")
-    cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+  assert version <= SCHEMA_VERSION, f"database is at schema version {version}, newer than this code ({SCHEMA_VERSION})"
+  return [m for m in MIGRATIONS if m.version > version]
+
+def migrate(db:sqlite3.Connection, dry_run:bool=False) -> list[tuple[Migration, float]]:
+  """Apply every pending migration in order, each in its own transaction together with its user_version bump,
+  so a failed step leaves the database at the previous version. With dry_run all steps run in one transaction
+  that is rolled back, which times the upgrade without changing the database, and the steps that change files only
+  log what they would change.
+  Returns the migrations and how long each took in seconds."""
+  steps, report, isolation = pending(db), [], db.isolation_level
+  db.isolation_level = None  # transactions are managed here
+  try:
+    if dry_run: db.execute("PRAGMA foreign_keys = OFF;"); db.execute("BEGIN;")
+    for m in steps:
+      if m.foreign_keys_off and not dry_run: db.execute("PRAGMA foreign_keys = OFF;")  # a no-op inside a transaction
+      st = time.perf_counter()
+      if not dry_run: db.execute("BEGIN;")
+      try:
+        if m.files: m.fn(db, dry_run=dry_run)
+        else: m.fn(db)
+        if m.foreign_keys_off and (bad:=db.execute("PRAGMA foreign_key_check;").fetchall()):
+          raise sqlite3.IntegrityError(f"foreign key violations after migration {m.version}: {bad[:5]}")
+        db.execute(f"PRAGMA user_version = {m.version};")
+        if not dry_run: db.execute("COMMIT;")
+      except BaseException:
+        if db.in_transaction: db.execute("ROLLBACK;")
+        raise
+      finally:
+        if not dry_run: db.execute("PRAGMA foreign_keys = ON;")
+      if m.vacuum and not dry_run: db.execute("VACUUM;")
+      report.append((m, time.perf_counter() - st))
+      log.info(f"{'Dry-ran' if dry_run else 'Applied'} migration {m.version} ({m.desc}) in {report[-1][1]:.2f}s")
+  finally:
+    if dry_run:
+      if db.in_transaction: db.execute("ROLLBACK;")
+      db.execute("PRAGMA foreign_keys = ON;")
+    db.isolation_level = isolation
+  return report
+
+def init_db(upgrade:bool=True) -> sqlite3.Connection:
+  db = sqlite3.connect(DB, check_same_thread=False)
+  # WAL lets readers run alongside the writer, it is a property of the file so register uses it too
+  db.execute("PRAGMA journal_mode = WAL;")
+  db.execute("PRAGMA synchronous = NORMAL;")
+  db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT};")
+  db.execute("PRAGMA foreign_keys = ON;")
+  if upgrade: migrate(db)
   return db
 
-db = init_db()
+class Database:
+  """Async access to the database that never blocks the event loop.
+  Reads run on a pool of read-only connections in threads. Writes all go through one connection in a thread of
+  its own; writes submitted while a commit is in progress are committed together in the next transaction, each
+  in a savepoint so a failing write doesn't take the others down with it."""
+  def __init__(self, readers:int=READERS, upgrade:bool=True):
+    self.conn = init_db(upgrade)  # the writer's connection
+    self.conn.isolation_level = None
+    self._local = threading.local()
+    self._readers = ThreadPoolExecutor(readers, thread_name_prefix="db-read", initializer=self._open_reader)
+    self._writer = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+    self._writes: list[tuple[Callable, tuple, asyncio.Future]] = []
+    self._flushing: Optional[asyncio.Task] = None
+
+  def _open_reader(self):
+    self._local.conn = sqlite3.connect(f"file:{DB}?mode=ro", uri=True, check_same_thread=False)
+    self._local.conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT};")
+
+  async def read(self, fn:Callable[..., Any], *args) -> Any:
+    """Run fn(connection, *args) on a read-only connection."""
+    return await asyncio.get_running_loop().run_in_executor(self._readers, lambda: fn(self._local.conn, *args))
+
+  async def fetchall(self, sql:str, params:tuple=()) -> list[tuple]: return await self.read(lambda c: c.execute(sql, params).fetchall())
+  async def fetchone(self, sql:str, params:tuple=()) -> Optional[tuple]: return await self.read(lambda c: c.execute(sql, params).fetchone())
+
+  async def write(self, fn:Callable[..., Any], *args) -> Any:
+    """Run fn(connection, *args) in a transaction and return its result once committed.
+    Everything fn does is rolled back if it raises, fn must not commit or roll back itself."""
+    self._writes.append((fn, args, fut:=asyncio.get_running_loop().create_future()))
+    if self._flushing is None or self._flushing.done(): self._flushing = asyncio.create_task(self._flush())
+    return await fut
+
+  async def execute(self, sql:str, params:tuple=()) -> list[tuple]:
+    """Run a single writing statement, returning its rows (eg. with RETURNING)."""
+    return await self.write(lambda c: c.execute(sql, params).fetchall())
+
+  async def _flush(self):
+    while self._writes:
+      batch, self._writes = self._writes, []
+      try: results = await asyncio.get_running_loop().run_in_executor(self._writer, self._commit, batch)
+      except Exception as e: results = [(False, e)] * len(batch)
+      for (_, _, fut), (ok, res) in zip(batch, results):
+        if fut.done(): continue
+        if ok: fut.set_result(res)
+        else: fut.set_exception(res)
+
+  def _commit(self, batch:list) -> list[tuple[bool, Any]]:
+    results = []
+    self.conn.execute("BEGIN IMMEDIATE;")
+    try:
+      for fn, args, _ in batch:
+        self.conn.execute("SAVEPOINT write;")
+        try: results.append((True, fn(self.conn, *args)))
+        except Exception as e:
+          self.conn.execute("ROLLBACK TO write;")
+          results.append((False, e))
+        self.conn.execute("RELEASE write;")
+      self.conn.execute("COMMIT;")
+    except BaseException:
+      if self.conn.in_transaction: self.conn.execute("ROLLBACK;")
+      raise
+    return results
+
+  async def close(self):
+    """Wait for pending writes, then close every connection."""
+    while self._flushing is not None and not self._flushing.done(): await self._flushing
+    self._readers.shutdown()
+    self._writer.shutdown()
+    self.conn.close()
+
+# running this file upgrades the database by hand (see below), importing it upgrades it automatically
+db = Database(upgrade=__name__ != "__main__")
 
 class Perm(Enum):
   CREATE_CHALLENGE = 0b1
   USER = 1
   ADMIN = 2
 
-
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(prog="db", description="kernelbot database maintenance")
+  parser.add_argument("command", choices=["plan", "migrate", "rebuild-best", "sweep"],
+                      help="plan: list pending migrations, migrate: apply them, rebuild-best: recompute best_submissions from submissions, "
+                           "sweep: delete test files no challenge refers to")
+  parser.add_argument("--dry-run", action="store_true", help="with migrate: run and time every step, then roll back")
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  version = db.conn.execute("PRAGMA user_version").fetchone()[0]
+  if args.command == "plan":
+    print(f"{DB} is at schema version {version}, this code is at {SCHEMA_VERSION}")
+    for m in pending(db.conn): print(f"  {m.version}: {m.desc}{' (then VACUUM)' if m.vacuum else ''}")
+  if args.command == "migrate":
+    report = migrate(db.conn, dry_run=args.dry_run)
+    print(f"{'would migrate' if args.dry_run else 'migrated'} {DB} from version {version} to {SCHEMA_VERSION} "
+          f"in {sum(t for _, t in report):.2f}s" if report else f"{DB} is up to date")
+  if args.command == "rebuild-best":
+    migrate(db.conn)
+    db.conn.execute("BEGIN;")
+    rebuild_best_submissions(db.conn)
+    db.conn.execute("COMMIT;")
+    print(f"rebuilt best_submissions: {db.conn.execute('SELECT COUNT(*) FROM best_submissions;').fetchone()[0]} rows")
+  if args.command == "sweep":
+    migrate(db.conn)
+    print(f"deleted {sweep_tests(db.conn)} unreferenced test files from {store.TESTS_DIR}")
@@ -1,8 +1,17 @@
 import sqlite3
 import os
-import subprocess
+import argparse
+import csv
+import hashlib
+import html
+import io
+import json
+import time
 import logging
 from datetime import datetime
+from typing import Iterator, Optional
+
+from helpers import fmt_time
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,123 +19,304 @@ logging.basicConfig(
 )
 logger = logging.getLogger('leaderboard_export')
 
-MAIN_DB_PATH = "/home/kernelbot/scratch/kernelbot.db" 
+MAIN_DB_PATH = "/home/kernelbot/scratch/kernelbot.db"
 EXPORT_DB_PATH = "/home/kernelbot/leaderboard.db"
+WATCH_INTERVAL = 5.0  # seconds between checks for new changes in watch mode
+DEBOUNCE = 2.0        # seconds to wait after a change, so a burst of submissions is exported at once
+BUSY_TIMEOUT = 5000   # ms, same as db.BUSY_TIMEOUT
+EXPORT_VERSION = 2    # of EXPORT_SCHEMA, a working copy made with another version is rebuilt with a full export
+
+EXPORT_SCHEMA = [
+    '''
+    CREATE TABLE challenges (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        desc TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE best_submissions (
+        user_id TEXT NOT NULL,
+        username TEXT,
+        challenge_id INTEGER NOT NULL,
+        kernel_name TEXT NOT NULL,
+        kernel_type TEXT NOT NULL,
+        timing REAL NOT NULL,
+        submission_date TEXT,
+        submission_id INTEGER NOT NULL,
+        FOREIGN KEY (challenge_id) REFERENCES challenges(id)
+    )
+    ''',
+    "CREATE UNIQUE INDEX best_submissions_entry ON best_submissions (challenge_id, user_id)",
+    '''
+    CREATE TABLE metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''',
+]
+
+BEST_QUERY = """
+    SELECT
+        b.user_id,
+        b.comp_id as challenge_id,
+        s.name as kernel_name,
+        s.type as kernel_type,
+        b.timing,
+        s.created_at,
+        b.submission_id
+    FROM best_submissions b
+    JOIN submissions s ON s.id = b.submission_id
+    JOIN challenges c ON b.comp_id = c.id
+    WHERE b.timing > 0
+"""
+
+def work_path(export_path: str) -> str:
+    # the exporter updates a private copy in place and publishes whole snapshots of it, readers never see a partial export
+    return export_path + ".work"
+
+def connect_main(main_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(main_path, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    return conn
+
+def usernames(main_conn: sqlite3.Connection, user_ids=None) -> dict:
+    try:
+        if user_ids is None: users = main_conn.execute("SELECT id, username FROM users").fetchall()
+        else: users = main_conn.execute(f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(user_ids))})", list(user_ids)).fetchall()
+        return {str(user_id): username for user_id, username in users}
+    except Exception as e:
+        logger.warning(f"Error fetching user mappings: {e}")
+        return {}
+
+def export_rows(rows, user_mapping: dict) -> list:
+    return [(user_id, user_mapping.get(str(user_id), f"User-{user_id}"), challenge_id, kernel_name, kernel_type, timing, created_at, submission_id)
+            for user_id, challenge_id, kernel_name, kernel_type, timing, created_at, submission_id in rows]
+
+def full_export(main_conn: sqlite3.Connection, path: str) -> int:
+    """Build the export from scratch at path, returns the changelog position it is current as of"""
+    tmp = path + ".tmp"
+    if os.path.exists(tmp): os.remove(tmp)
+    export_conn = sqlite3.connect(tmp)
+    for stmt in EXPORT_SCHEMA: export_conn.execute(stmt)
+
+    main_conn.execute("BEGIN")  # one snapshot for the data and the changelog position
+    try:
+        seq = main_conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changelog").fetchone()[0]
+        challenges = main_conn.execute("SELECT id, name, desc FROM challenges").fetchall()
+        best_submissions = export_rows(main_conn.execute(BEST_QUERY + " ORDER BY b.comp_id, b.timing, b.submission_id").fetchall(), usernames(main_conn))
+    finally:
+        main_conn.execute("COMMIT")
+
+    export_conn.executemany("INSERT INTO challenges VALUES (?, ?, ?)", challenges)
+    export_conn.executemany("INSERT INTO best_submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", best_submissions)
+    metadata = [("export_time", datetime.now().isoformat()), ("changelog_seq", str(seq)), ("export_version", str(EXPORT_VERSION))]
+    export_conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata)
+    export_conn.commit()
+    export_conn.close()
+    os.replace(tmp, path)
+
+    logger.info(f"Exported {len(challenges)} challenges and {len(best_submissions)} best submissions")
+    return seq
+
+def apply_changes(main_conn: sqlite3.Connection, export_conn: sqlite3.Connection, since: int) -> int:
+    """Bring the export up to date with the changelog entries after since, returns the new position"""
+    main_conn.execute("BEGIN")
+    try:
+        changes = main_conn.execute("SELECT seq, tbl, comp_id, user_id FROM changelog WHERE seq > ? ORDER BY seq", (since,)).fetchall()
+        if not changes: return since
+        entries = {(comp_id, user_id) for _, tbl, comp_id, user_id in changes if tbl == "submissions"}
+        challenge_ids = {comp_id for _, tbl, comp_id, _ in changes if tbl == "challenges"}
+        user_ids = {user_id for _, tbl, _, user_id in changes if tbl == "users"}
+
+        challenges = {cid: main_conn.execute("SELECT id, name, desc FROM challenges WHERE id = ?", (cid,)).fetchone() for cid in challenge_ids}
+        best = {key: main_conn.execute(BEST_QUERY + " AND b.comp_id = ? AND b.user_id = ?", key).fetchone() for key in entries}
+        user_mapping = usernames(main_conn, user_ids | {user_id for _, user_id in entries})
+    finally:
+        main_conn.execute("COMMIT")
+
+    with export_conn:
+        for cid, row in challenges.items():
+            if row is None:
+                export_conn.execute("DELETE FROM challenges WHERE id = ?", (cid,))
+                export_conn.execute("DELETE FROM best_submissions WHERE challenge_id = ?", (cid,))
+            else: export_conn.execute("INSERT OR REPLACE INTO challenges VALUES (?, ?, ?)", row)
+        for (comp_id, user_id), row in best.items():
+            if row is None: export_conn.execute("DELETE FROM best_submissions WHERE challenge_id = ? AND user_id = ?", (comp_id, user_id))
+            else: export_conn.execute("INSERT OR REPLACE INTO best_submissions VALUES (?, ?, ?, ?, ?, ?, ?, ?)", export_rows([row], user_mapping)[0])
+        for user_id in user_ids:
+            export_conn.execute("UPDATE best_submissions SET username = ? WHERE user_id = ?",
+                                (user_mapping.get(str(user_id), f"User-{user_id}"), user_id))
+        seq = changes[-1][0]
+        export_conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", [("export_time", datetime.now().isoformat()), ("changelog_seq", str(seq))])
+
+    logger.info(f"Applied {len(changes)} changes: {len(challenges)} challenges, {len(best)} best submissions, {len(user_ids)} users")
+    return seq
 
-def export_leaderboard_data():
-    """Export minimal leaderboard data (just users and times) to a separate SQLite database"""
+def publish(work: str, export_path: str):
+    """Atomically replace the export with a consistent copy of the working database"""
+    tmp = export_path + ".tmp"
+    src, dest = sqlite3.connect(work), sqlite3.connect(tmp)
+    try: src.backup(dest)
+    finally: src.close(); dest.close()
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, export_path)
+
+# static export: one JSON, CSV and HTML shard per challenge plus manifest.json, for a plain file server or CDN
+SHARD_FIELDS = ["rank", "user_id", "username", "kernel_name", "kernel_type", "timing", "submission_date"]
+CHUNK_ROWS = 512  # rows fetched from the export database at a time
+
+def leaderboard_rows(export_conn: sqlite3.Connection, challenge_id: int) -> Iterator[tuple]:
+    cur = export_conn.execute("""
+        SELECT user_id, username, kernel_name, kernel_type, timing, submission_date
+        FROM best_submissions WHERE challenge_id = ? ORDER BY timing, submission_id
+    """, (challenge_id,))
+    rank = 0
+    while rows := cur.fetchmany(CHUNK_ROWS):
+        for row in rows:
+            rank += 1
+            yield (rank, *row)
+
+def json_shard(challenge: tuple, rows: Iterator[tuple]) -> Iterator[str]:
+    cid, name, desc = challenge
+    yield f'{{"id": {cid}, "name": {json.dumps(name)}, "desc": {json.dumps(desc)}, "leaderboard": ['
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + "\n  " + json.dumps(dict(zip(SHARD_FIELDS, row)))
+    yield "\n]}\n"
+
+def csv_shard(challenge: tuple, rows: Iterator[tuple]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(SHARD_FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+def html_shard(challenge: tuple, rows: Iterator[tuple]) -> Iterator[str]:
+    cid, name, desc = challenge
+    yield (f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>{html.escape(name)} leaderboard</title></head><body>\n"
+           f"<h1>{html.escape(name)}</h1>\n<p>{html.escape(desc or '')}</p>\n"
+           "<table>\n<tr><th>#</th><th>user</th><th>kernel</th><th>type</th><th>time</th><th>submitted</th></tr>\n")
+    for rank, user_id, username, kernel_name, kernel_type, timing, submitted in rows:
+        yield (f"<tr><td>{rank}</td><td>{html.escape(str(username))}</td><td>{html.escape(kernel_name)}</td>"
+               f"<td>{html.escape(kernel_type)}</td><td>{fmt_time(timing)}</td><td>{html.escape(str(submitted or ''))}</td></tr>\n")
+    yield "</table>\n</body></html>\n"
+
+SHARD_FORMATS = {"json": json_shard, "csv": csv_shard, "html": html_shard}
+
+def write_shard(path: str, chunks: Iterator[str], etag: Optional[str]) -> tuple[str, int, bool]:
+    """Stream chunks into path unless they hash to etag, returns (etag, size, whether the file was rewritten)"""
+    tmp, digest, size = path + ".tmp", hashlib.sha256(), 0
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            data = chunk.encode()
+            digest.update(data)
+            size += len(data)
+            f.write(data)
+    new_etag = f'"{digest.hexdigest()[:32]}"'
+    if new_etag == etag and os.path.exists(path):
+        os.remove(tmp)
+        return etag, size, False
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+    return new_etag, size, True
+
+def export_static(export_path: str, out_dir: str) -> bool:
+    """Write per-challenge shards of the published export to out_dir, rewriting only those whose content changed"""
     try:
-        if os.path.exists(EXPORT_DB_PATH):
-            os.remove(EXPORT_DB_PATH)
-        
-        export_conn = sqlite3.connect(EXPORT_DB_PATH)
-        export_cur = export_conn.cursor()
-        
-        main_conn = sqlite3.connect(MAIN_DB_PATH)
-        main_cur = main_conn.cursor()
-        
-        export_cur.execute('''
-        CREATE TABLE challenges (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            desc TEXT
-        )
-        ''')
-        
-        export_cur.execute('''
-        CREATE TABLE best_submissions (
-            user_id TEXT NOT NULL,
-            username TEXT,
-            challenge_id INTEGER NOT NULL,
-            kernel_name TEXT NOT NULL,
-            kernel_type TEXT NOT NULL,
-            timing REAL NOT NULL,
-            submission_date TEXT,
-            FOREIGN KEY (challenge_id) REFERENCES challenges(id)
-        )
-        ''')
-        
-        export_cur.execute('''
-        CREATE TABLE metadata (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        ''')
-        export_cur.execute("INSERT INTO metadata VALUES (?, ?)", 
-                          ("export_time", datetime.now().isoformat()))
-        
-        main_cur.execute("SELECT id, name, desc FROM challenges")
-        challenges = main_cur.fetchall()
-        export_cur.executemany("INSERT INTO challenges VALUES (?, ?, ?)", challenges)
-        
-        user_mapping = {}
+        os.makedirs(os.path.join(out_dir, "challenges"), exist_ok=True)
+        manifest_path = os.path.join(out_dir, "manifest.json")
+        old = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f: old = {str(c["id"]): c for c in json.load(f)["challenges"]}
+
+        export_conn = sqlite3.connect(f"file:{export_path}?mode=ro", uri=True)
+        challenges, rewritten = [], 0
         try:
-            users = main_cur.execute("SELECT id, username FROM users").fetchall()
-            for user_id, username in users:
-                user_mapping[str(user_id)] = username
-        except Exception as e:
-            logger.warning(f"Error fetching user mappings: {e}")
-        
-        main_cur.execute("""
-            WITH RankedSubmissions AS (
-                SELECT 
-                    s.user_id, 
-                    c.id as challenge_id,
-                    s.name as kernel_name, 
-                    s.type as kernel_type, 
-                    s.timing,
-                    s.created_at,
-                    ROW_NUMBER() OVER (PARTITION BY s.user_id, s.comp_id ORDER BY s.timing ASC) as rn
-                FROM submissions s
-                JOIN challenges c ON s.comp_id = c.id
-                WHERE s.timing > 0
-            )
-            SELECT 
-                user_id, 
-                challenge_id,
-                kernel_name, 
-                kernel_type, 
-                timing,
-                created_at
-            FROM RankedSubmissions
-            WHERE rn = 1
-            ORDER BY challenge_id, timing ASC
-        """)
-        
-        best_submissions_raw = main_cur.fetchall()
-        
-        best_submissions = []
-        for user_id, challenge_id, kernel_name, kernel_type, timing, created_at in best_submissions_raw:
-            username = user_mapping.get(str(user_id), f"User-{user_id}")
-            best_submissions.append((
-                user_id, 
-                username,
-                challenge_id,
-                kernel_name, 
-                kernel_type, 
-                timing,
-                created_at
-            ))
-        
-        export_cur.executemany("""
-            INSERT INTO best_submissions 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, best_submissions)
-        
-        export_conn.commit()
-        export_cur.execute("VACUUM")
-
-        export_conn.close()
-        main_conn.close()
-
-        os.chmod(EXPORT_DB_PATH, 0o644)
-        
-        logger.info(f"Exported {len(challenges)} challenges and {len(best_submissions)} best submissions")
+            for challenge in export_conn.execute("SELECT id, name, desc FROM challenges ORDER BY id").fetchall():
+                entry = {"id": challenge[0], "name": challenge[1], "files": {}}
+                for fmt, shard in SHARD_FORMATS.items():
+                    path = os.path.join("challenges", f"{challenge[0]}.{fmt}")
+                    prev = old.get(str(challenge[0]), {}).get("files", {}).get(fmt, {}).get("etag")
+                    etag, size, changed = write_shard(os.path.join(out_dir, path), shard(challenge, leaderboard_rows(export_conn, challenge[0])), prev)
+                    entry["files"][fmt] = {"path": path, "etag": etag, "bytes": size}
+                    rewritten += changed
+                challenges.append(entry)
+        finally:
+            export_conn.close()
+
+        # shards of deleted challenges
+        for cid in old.keys() - {str(c["id"]) for c in challenges}:
+            for fmt in SHARD_FORMATS:
+                if os.path.exists(path := os.path.join(out_dir, "challenges", f"{cid}.{fmt}")): os.remove(path)
+
+        write_shard(manifest_path, iter([json.dumps({"generated": datetime.now().isoformat(), "challenges": challenges}, indent=1)]), None)
+        logger.info(f"Static export: {rewritten} of {len(challenges) * len(SHARD_FORMATS)} shards rewritten")
         return True
-        
+
+    except Exception as e:
+        logger.error(f"Error writing static export: {e}")
+        return False
+
+def export_leaderboard_data(main_path: str = MAIN_DB_PATH, export_path: str = EXPORT_DB_PATH, full: bool = False,
+                            static_dir: Optional[str] = None):
+    """Export minimal leaderboard data (just users and times) to a separate SQLite database, and to static files in
+    static_dir if given. Only changes since the last export are applied, unless there is no previous export or full is set"""
+    try:
+        main_conn = connect_main(main_path)
+        work = work_path(export_path)
+        try:
+            seq = None
+            if not full and os.path.exists(work):
+                export_conn = sqlite3.connect(work)
+                try:
+                    meta = dict(export_conn.execute("SELECT key, value FROM metadata").fetchall())
+                    if "changelog_seq" in meta and meta.get("export_version") == str(EXPORT_VERSION):
+                        since = int(meta["changelog_seq"])
+                        seq = apply_changes(main_conn, export_conn, since)
+                        if seq == since and os.path.exists(export_path):  # nothing changed
+                            return static_dir is None or os.path.exists(os.path.join(static_dir, "manifest.json")) or export_static(export_path, static_dir)
+                finally:
+                    export_conn.close()
+            if seq is None: seq = full_export(main_conn, work)
+            publish(work, export_path)
+            # the applied entries aren't needed anymore, a lost working copy is rebuilt with a full export
+            main_conn.execute("DELETE FROM changelog WHERE seq <= ?", (seq,))
+        finally:
+            main_conn.close()
+        return static_dir is None or export_static(export_path, static_dir)
+
     except Exception as e:
         logger.error(f"Error exporting leaderboard data: {e}")
         return False
 
+def watch(main_path: str = MAIN_DB_PATH, export_path: str = EXPORT_DB_PATH, interval: float = WATCH_INTERVAL,
+          static_dir: Optional[str] = None):
+    """Re-export shortly after every change to the main database"""
+    export_leaderboard_data(main_path, export_path, static_dir=static_dir)
+    main_conn = connect_main(main_path)
+    last = None
+    while True:
+        time.sleep(interval)
+        try: pending = main_conn.execute("SELECT COUNT(*), MAX(seq) FROM changelog").fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Error polling for changes: {e}")
+            continue
+        if pending[0] and pending[1] != last:
+            time.sleep(DEBOUNCE)
+            if export_leaderboard_data(main_path, export_path, static_dir=static_dir): last = pending[1]
+
 if __name__ == "__main__":
-    export_leaderboard_data()
+    parser = argparse.ArgumentParser(prog="db_export", description="export the public leaderboard database")
+    parser.add_argument("--main", default=MAIN_DB_PATH, help="bot database to export from")
+    parser.add_argument("--export", default=EXPORT_DB_PATH, help="leaderboard database to publish")
+    parser.add_argument("--full", action="store_true", help="rebuild the export from scratch")
+    parser.add_argument("--static", metavar="DIR", help="also write JSON, CSV and HTML leaderboards per challenge to DIR")
+    parser.add_argument("--watch", action="store_true", help="keep running and re-export shortly after every change")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="seconds between checks for changes in watch mode")
+    args = parser.parse_args()
+    if args.watch: watch(args.main, args.export, args.interval, args.static)
+    else: raise SystemExit(not export_leaderboard_data(args.main, args.export, args.full, args.static))
@@ -0,0 +1,211 @@
+import ctypes, importlib.metadata, os, platform, time
+from collections import Counter
+from typing import Any, Optional
+
+import numpy as np
+
+from bufpool import BufferPool
+from tcache import TestCache
+from helpers import logger
+
+cuda = None  # tinygrad's CUDA runtime, imported by load_cuda() when the first CUDA device is used
+
+def load_cuda():
+  """Import tinygrad's CUDA runtime. It takes a while and fails on hosts without CUDA, so only the processes that
+  use a GPU pay for it, and the bot itself starts (and serves everything but judging) anywhere."""
+  global cuda, nvrtc, CUDAAllocator, CUDADevice, CUDAProgram, check, CUDACompiler, PTXCompiler
+  if cuda is not None: return
+  try:
+    from tinygrad.runtime.autogen import nvrtc
+    from tinygrad.runtime.ops_cuda import CUDAAllocator, CUDADevice, CUDAProgram, check
+    from tinygrad.runtime.support.compiler_cuda import CUDACompiler, PTXCompiler
+    from tinygrad.runtime.autogen import cuda
+  except (ImportError, AttributeError, OSError) as e: raise RuntimeError(f"CUDA is not available on this host: {e}") from e
+
+# "cuda" for every GPU of the ranking model, "mock:N" for N CPU stand-ins
+BACKEND = os.getenv("KERNELBOT_BACKEND", "cuda")
+STAGING_BYTES = 16 << 20  # size of each of the two pinned host buffers CUDA transfers are pipelined through
+
+def host_view(a:np.ndarray) -> memoryview:
+  """Flat byte view of an array without copying it, eg. straight from a memory mapped test file."""
+  return np.ascontiguousarray(a).data.cast("B")
+
+def host_address(a:np.ndarray) -> int:
+  """Address of a C-contiguous array's data. Unlike a ctypes view of its buffer this doesn't need it to be writable,
+  and test inputs are read-only views of memory mapped files."""
+  assert a.flags.c_contiguous, "only contiguous arrays have a single address"
+  return a.ctypes.data
+
+class Backend:
+  """One device with its own compilers, allocator, buffer pool and test cache. Only its runner thread may use it."""
+  name: str           # eg. cuda:1
+  model: str          # devices are only ranked against devices of the same model
+  arch: str
+  toolchain: str
+  l2_bytes: int
+  compilers: dict[str, Any]
+
+  def __init__(self, allocator):
+    self.allocator = allocator
+    self.tcache = TestCache(allocator, self.upload)
+    self.pool = BufferPool(allocator, fill=self.memset)
+    self._flush_buf = None
+
+  def load(self, name:str, lib:bytes) -> Any: raise NotImplementedError
+  def memset(self, buf, value:int, size:int): raise NotImplementedError
+  def copy(self, dest, src, size:int): raise NotImplementedError
+  def upload(self, dest, src:np.ndarray): self.allocator._copyin(dest, host_view(src))
+  def download(self, dest:np.ndarray, src): self.allocator._copyout(host_view(dest), src)
+
+  def flush_l2(self):
+    if self._flush_buf is None: self._flush_buf = self.allocator.alloc(2 * self.l2_bytes)
+    self.memset(self._flush_buf, 0, 2 * self.l2_bytes)
+
+  def __repr__(self): return f"<{type(self).__name__} {self.name} ({self.model})>"
+
+class CUDABackend(Backend):
+  def __init__(self, idx:int):
+    load_cuda()
+    self.device = CUDADevice(f"cuda:{idx}")
+    self.name, self.arch, self.model = f"cuda:{idx}", self.device.arch, cuda_model(idx)
+    self.compilers = {"CUDA": CUDACompiler(self.arch), "PTX": PTXCompiler(self.arch)}
+    l2, nv_major, nv_minor, driver = ctypes.c_int(), ctypes.c_int(), ctypes.c_int(), ctypes.c_int()
+    check(cuda.cuDeviceGetAttribute(ctypes.byref(l2), cuda.CU_DEVICE_ATTRIBUTE_L2_CACHE_SIZE, self.device.cu_device))
+    nvrtc.nvrtcVersion(ctypes.byref(nv_major), ctypes.byref(nv_minor))
+    check(cuda.cuDriverGetVersion(ctypes.byref(driver)))
+    self.l2_bytes = l2.value
+    self.toolchain = f"nvrtc{nv_major.value}.{nv_minor.value}-driver{driver.value}-tinygrad{importlib.metadata.version('tinygrad')}"
+    self._staging = None
+    super().__init__(CUDAAllocator(self.device))
+
+  def load(self, name:str, lib:bytes) -> Any: return CUDAProgram(self.device, name, lib)
+
+  def memset(self, buf, value:int, size:int):
+    check(cuda.cuCtxSetCurrent(self.device.context))
+    check(cuda.cuMemsetD8_v2(buf, value, size))
+
+  def copy(self, dest, src, size:int):
+    check(cuda.cuCtxSetCurrent(self.device.context))
+    check(cuda.cuMemcpyDtoD_v2(dest, src, size))
+
+  def staging(self) -> list[tuple[ctypes.c_void_p, Any]]:
+    """Two pinned host buffers with an event each, allocated once: while the DMA engine copies one the host fills
+    or drains the other, and copies from pinned memory don't need the driver's own bounce buffer."""
+    if self._staging is None:
+      self._staging = []
+      for _ in range(2):
+        check(cuda.cuMemHostAlloc(ctypes.byref(buf:=ctypes.c_void_p()), STAGING_BYTES, 0))
+        check(cuda.cuEventCreate(ctypes.byref(ev:=cuda.CUevent()), cuda.CU_EVENT_DISABLE_TIMING))
+        self._staging.append((buf, ev))
+    return self._staging
+
+  def upload(self, dest, src:np.ndarray):
+    check(cuda.cuCtxSetCurrent(self.device.context))
+    src, staging = np.ascontiguousarray(src), self.staging()
+    addr = host_address(src)
+    for i, off in enumerate(range(0, src.nbytes, STAGING_BYTES)):
+      (buf, ev), n = staging[i % 2], min(STAGING_BYTES, src.nbytes - off)
+      check(cuda.cuEventSynchronize(ev))  # the copy out of this buffer two chunks ago is done
+      ctypes.memmove(buf, addr + off, n)
+      check(cuda.cuMemcpyHtoDAsync_v2(cuda.CUdeviceptr(dest.value + off), buf, n, None))
+      check(cuda.cuEventRecord(ev, None))
+    check(cuda.cuCtxSynchronize())
+
+  def download(self, dest:np.ndarray, src):
+    check(cuda.cuCtxSetCurrent(self.device.context))
+    addr, staging, prev = host_address(dest), self.staging(), None
+    def drain(i, off, n):
+      buf, ev = staging[i % 2]
+      check(cuda.cuEventSynchronize(ev))
+      ctypes.memmove(addr + off, buf, n)
+    for i, off in enumerate(range(0, dest.nbytes, STAGING_BYTES)):
+      (buf, ev), n = staging[i % 2], min(STAGING_BYTES, dest.nbytes - off)
+      check(cuda.cuMemcpyDtoHAsync_v2(buf, cuda.CUdeviceptr(src.value + off), n, None))
+      check(cuda.cuEventRecord(ev, None))
+      if prev is not None: drain(*prev)  # copy the previous chunk out while this one is in flight
+      prev = (i, off, n)
+    if prev is not None: drain(*prev)
+
+def cuda_model(idx:int) -> str:
+  check(cuda.cuInit(0))
+  check(cuda.cuDeviceGet(ctypes.byref(dev:=cuda.CUdevice()), idx))
+  check(cuda.cuDeviceGetName(buf:=ctypes.create_string_buffer(256), 256, dev))
+  return buf.value.decode()
+
+# the mock backend runs "kernels" written in python on the CPU, so the judging path can be exercised without a GPU.
+# a kernel is a function taking every buffer as a flat uint8 numpy array, eg.
+#   def add(a, b, out): out.view(np.float32)[:] = a.view(np.float32) + b.view(np.float32)
+class MockAllocator:
+  def alloc(self, size:int) -> np.ndarray: return np.zeros(size, dtype=np.uint8)
+  def free(self, buf:np.ndarray, size:int): pass
+  def _copyin(self, dest:np.ndarray, src) -> None: dest[:len(src)] = np.frombuffer(src, dtype=np.uint8)
+  def _copyout(self, dest:memoryview, src:np.ndarray) -> None:
+    out = np.frombuffer(dest, dtype=np.uint8)
+    out[:] = src[:len(out)]
+
+class MockCompiler:
+  def compile(self, src:str) -> bytes:
+    compile(src, "<kernel>", "exec")
+    return src.encode()
+
+class MockProgram:
+  def __init__(self, name:str, lib:bytes):
+    ns = {"np": np}
+    exec(compile(lib.decode(), f"<{name}>", "exec"), ns)
+    self.fn = ns.get(name)
+    if not callable(self.fn): raise RuntimeError(f"kernel {name} not found")
+  def __call__(self, *bufs, global_size=(1,1,1), local_size=(1,1,1), wait=False) -> float:
+    st = time.perf_counter()
+    self.fn(*bufs)
+    return time.perf_counter() - st
+
+class MockBackend(Backend):
+  def __init__(self, idx:int=0):
+    self.name, self.model, self.arch, self.l2_bytes = f"mock:{idx}", "mock", "mock", 1 << 20
+    self.toolchain = f"python{platform.python_version()}"
+    self.compilers = {"CUDA": MockCompiler(), "PTX": MockCompiler()}
+    super().__init__(MockAllocator())
+  def load(self, name:str, lib:bytes) -> MockProgram: return MockProgram(name, lib)
+  def memset(self, buf:np.ndarray, value:int, size:int): buf[:size] = value
+  def copy(self, dest:np.ndarray, src:np.ndarray, size:int): dest[:size] = src[:size]
+  def upload(self, dest:np.ndarray, src:np.ndarray): dest[:src.nbytes] = np.frombuffer(host_view(src), dtype=np.uint8)
+  def download(self, dest:np.ndarray, src:np.ndarray): np.frombuffer(host_view(dest), dtype=np.uint8)[:] = src[:dest.nbytes]
+
+class DevicePool:
+  """The devices submissions are judged on, all of the same model so their timings are comparable."""
+  def __init__(self, backends:list[Backend]):
+    assert backends and len(set(b.model for b in backends)) == 1, "a device pool needs devices of a single model"
+    self.backends, self.model = backends, backends[0].model
+
+  @staticmethod
+  def cuda(model:Optional[str]=None) -> 'DevicePool': return DevicePool([CUDABackend(i) for i in cuda_indices(model)[1]])
+
+  @staticmethod
+  def mock(n:int=1) -> 'DevicePool': return DevicePool([MockBackend(i) for i in range(n)])
+
+  @staticmethod
+  def from_spec(spec:str=BACKEND) -> 'DevicePool':
+    kind, idxs, _ = indices(spec)
+    return DevicePool([backend(kind, i) for i in idxs])
+
+def cuda_indices(model:Optional[str]=None) -> tuple[str, list[int]]:
+  """Every visible GPU of the given model, by default the most common model on the host. Creates no context."""
+  load_cuda()
+  check(cuda.cuInit(0))
+  check(cuda.cuDeviceGetCount(ctypes.byref(count:=ctypes.c_int())))
+  models = [cuda_model(i) for i in range(count.value)]
+  if model is None: model = Counter(models).most_common(1)[0][0]
+  for i, m in enumerate(models):
+    if m != model: logger.warning(f"Skipping cuda:{i} ({m}), only {model} devices are used for judging")
+  return model, [i for i, m in enumerate(models) if m == model]
+
+def indices(spec:str=BACKEND) -> tuple[str, list[int], str]:
+  """(backend kind, device indices, model) of a backend spec, without initializing the devices."""
+  kind, _, arg = spec.partition(":")
+  if kind == "cuda":
+    model, idxs = cuda_indices(arg or None)
+    return kind, idxs, model
+  if kind == "mock": return kind, list(range(int(arg or 1))), "mock"
+  raise ValueError(f"unknown device backend {spec}")
+
+def backend(kind:str, idx:int) -> Backend: return CUDABackend(idx) if kind == "cuda" else MockBackend(idx)
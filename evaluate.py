@@ -0,0 +1,88 @@
+import argparse, contextlib, json, os, sys, time, traceback
+from dataclasses import asdict, fields
+from typing import Optional
+
+import bench, run, store
+from devices import BACKEND, backend, indices
+from layouts import resolve
+
+# judge a kernel from the command line through the same compile, verify and benchmark path as /submit, eg.
+#   python3 evaluate.py matmul kernel.cu --name matmul --global 128,128,1 --local 16,16,1
+#   python3 evaluate.py tests.safetensors add.py --name add --backend mock
+# prints one json object with the result and per-stage timings to stdout, exits 1 on a wrong answer, 2 if the kernel doesn't
+# compile, 3 if it fails to run (eg. a bad launch configuration, a missing entry point or a device fault) and 4 if judging
+# can't start (eg. an unknown challenge, a layout it doesn't offer, inputs that no longer regenerate or no such device)
+
+def dims(s:str) -> tuple[int, int, int]:
+  d = tuple(int(x) for x in s.replace("(", "").replace(")", "").split(","))
+  if len(d) != 3: raise argparse.ArgumentTypeError(f"expected 3 launch dimensions, got {s!r}")
+  return d
+
+class SetupError(Exception):
+  """The challenge, its tests, the layouts or the device can't be used, before the kernel is involved."""
+
+def challenge(name:str) -> tuple[str, Optional[int], Optional[dict], list[str]]:
+  """(tests digest, challenge id, tolerance, offered layouts) of a challenge name or a safetensors file."""
+  if os.path.isfile(name): return store.add(name), None, None, []
+  from db import db  # opens (and migrates) kernelbot.db in the working directory, so only for challenge names
+  row = db.conn.execute("SELECT id, tests, tolerance, layouts FROM challenges WHERE name = ?;", (name,)).fetchone()
+  if row is None: raise SetupError(f"no challenge or file named {name}")
+  chal_id, tests, tolerance, offered = row
+  return tests, chal_id, json.loads(tolerance) if tolerance else None, json.loads(offered) if offered else []
+
+def evaluate(args) -> tuple[int, dict]:
+  out = {"challenge": args.challenge, "kernel": args.kernel, "name": args.name, "ktype": args.ktype,
+         "global_size": args.global_size, "local_size": args.local_size}
+  stages, code = bench.Stages(), 0
+  try:
+    try:
+      tests, chal_id, tolerance, offered = challenge(args.challenge)
+      tolerance = {**(tolerance or {}), **{k: v for k in ("rtol", "atol", "ulps") if (v:=getattr(args, k)) is not None}} or None
+      requested = [l.strip() for l in args.layouts.split(",")] if args.layouts else []
+      layouts = resolve(requested, offered + requested) if args.any_layout else resolve(requested, offered)
+      config = bench.BenchConfig(**{f.name: v for f in fields(bench.BenchConfig) if (v:=getattr(args, f.name)) is not None})
+      out.update(tests=tests, layouts=layouts, tolerance=tolerance, config=asdict(config))
+      with open(args.kernel) as f: src = f.read()
+      kind, idxs, _ = indices(args.backend)
+      if not 0 <= args.device < len(idxs): raise SetupError(f"no {kind} device {args.device}, found {len(idxs)}")
+      with stages("init"): dev = backend(kind, idxs[args.device])
+      out.update(device=dev.model, device_name=dev.name)
+    except SetupError: raise
+    except Exception as e: raise SetupError(f"{type(e).__name__}: {e}") from e
+    with stages("compile"):
+      try: prog = run.cc(dev, src, args.ktype, args.name)
+      except Exception as e: raise run.CompileError(str(e)) from e
+    tm, stats = run.run_tests(dev, prog, args.global_size, args.local_size, tests, layouts, chal_id, config, tolerance, stages)
+    out.update(ok=True, timing=tm, per_test=stats["tests"])
+  except run.WrongAnswer as e: out.update(ok=False, error="wrong", message=str(e)); code = 1
+  except run.CompileError as e: out.update(ok=False, error="compile", message=str(e)); code = 2
+  except (SetupError, store.InputsChanged) as e: out.update(ok=False, error="setup", message=str(e)); code = 4
+  except Exception as e: out.update(ok=False, error="runtime", message=f"{type(e).__name__}: {e}", detail=traceback.format_exc()); code = 3
+  out["stages"] = stages.to_dict()
+  return code, out
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(prog="evaluate", description="judge a kernel against a challenge without discord")
+  parser.add_argument("challenge", help="challenge name in the database, or a tests .safetensors file")
+  parser.add_argument("kernel", help="kernel source file")
+  parser.add_argument("--name", required=True, help="kernel entry point")
+  parser.add_argument("--ktype", default="CUDA", choices=run.ktypes)
+  parser.add_argument("--global", dest="global_size", type=dims, default=(1, 1, 1), help="eg. 128,128,1")
+  parser.add_argument("--local", dest="local_size", type=dims, default=(1, 1, 1), help="eg. 16,16,1")
+  parser.add_argument("--layouts", help="comma separated layout of every input, see layouts.py")
+  parser.add_argument("--any-layout", action="store_true", help="allow layouts the challenge doesn't offer")
+  parser.add_argument("--backend", default=BACKEND, help="device backend, eg. cuda or mock")
+  parser.add_argument("--device", type=int, default=0, help="index among the backend's devices")
+  for k, t in (("rtol", float), ("atol", float), ("ulps", int)): parser.add_argument(f"--{k}", type=t, help="override the challenge's tolerance")
+  for f in fields(bench.BenchConfig):
+    if f.type in (int, float): parser.add_argument(f"--{f.name.replace('_', '-')}", dest=f.name, type=f.type, help=f"default {f.default}")
+  parser.add_argument("--no-flush-l2", dest="flush_l2", action="store_const", const=False)
+  parser.add_argument("-o", "--output", help="also write the json to this file")
+  args = parser.parse_args()
+  st = time.perf_counter()
+  with contextlib.redirect_stdout(sys.stderr): code, out = evaluate(args)  # keep stdout for the json
+  out["wall"] = time.perf_counter() - st
+  print(res:=json.dumps(out, indent=2))
+  if args.output:
+    with open(args.output, "w") as f: f.write(res + "\n")
+  raise SystemExit(code)
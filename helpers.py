@@ -0,0 +1,38 @@
+import functools, logging, operator, os
+from typing import Iterable, Optional, TypeVar, Union
+
+# shared by the bot, the processes that judge (runner.py, worker.py) and db_export.py, so nothing here may import the database or discord
+
+def init_logger():
+  formatter = logging.Formatter("[%(asctime)s] %(levelname)s %(message)s", datefmt="%b %d %H:%M:%S")
+  handler = logging.StreamHandler()
+  handler.setFormatter(formatter)
+  logger = logging.getLogger("kernelbot")
+  logger.setLevel(logging.INFO)
+  logger.addHandler(handler)
+  return logger, formatter
+
+logger, formatter = init_logger()
+
+T = TypeVar("T")
+def all_same(items:list[T]): return all(x == items[0] for x in items)
+def prod(x:Iterable[T]) -> Union[T,int]: return functools.reduce(operator.mul, x, 1)
+def fmt_time(tm:float) -> str: return f"{tm*1e6:.2f} us" if tm < 1e-3 else f"{tm*1e3:.2f} ms" if tm < 1 else f"{tm:.2f} s"
+
+def evict_lru(directory:str, suffix:str, max_bytes:int, keep:Optional[str]=None) -> int:
+  """Delete the least recently used files ending in suffix until directory holds at most max_bytes of them, returns
+  how many went. Users of the files touch their mtime, which is the LRU timestamp; keep counts but is never deleted."""
+  entries = []
+  for e in os.scandir(directory):
+    if e.name.endswith(suffix) and e.path != keep:
+      try: st = e.stat()
+      except FileNotFoundError: continue
+      entries.append((st.st_mtime, st.st_size, e.path))
+  total, evicted = sum(sz for _, sz, _ in entries) + (os.path.getsize(keep) if keep else 0), 0
+  for _, sz, fn in sorted(entries):
+    if total <= max_bytes: break
+    try: os.unlink(fn)  # readers that already opened or mapped it keep it
+    except FileNotFoundError: pass
+    total -= sz
+    evicted += 1
+  return evicted
@@ -0,0 +1,158 @@
+import asyncio, time, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+import tcache
+from helpers import fmt_time, logger
+
+MAX_QUEUED = 32        # waiting jobs before new submissions are rejected
+MAX_PER_USER = 2       # waiting jobs a single user may have at once
+UPDATE_INTERVAL = 2.0  # seconds between queue position updates
+DRAIN_TIMEOUT = 120.0  # seconds to wait for queued jobs on shutdown
+MAX_ATTEMPTS = 3       # times a job is retried after the runner executing it went away
+
+class QueueFull(Exception): pass
+class RunnerLost(Exception):
+  """The runner went away while executing a job, which is then retried elsewhere."""
+
+@dataclass(eq=False)
+class Job:
+  fn: Callable[..., Any]
+  args: tuple
+  user_id: int
+  future: asyncio.Future
+  queued_at: float = field(default_factory=time.monotonic)
+  started_at: Optional[float] = None
+  key: str = field(default_factory=lambda: uuid.uuid4().hex)  # lets a runner reattach a retried job to its result
+  attempts: int = 0
+
+class LocalSlot:
+  """Executes jobs on a device of this process, in a thread of its own."""
+  def __init__(self, dev):
+    self.dev, self.name = dev, dev.name
+    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"runner-{dev.name}")
+    self.online = True
+  def start(self): pass
+  async def ready(self): pass
+  async def execute(self, job:Job) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(self.executor, job.fn, self.dev, *job.args)
+  def invalidate(self, chal_id:int): tcache.invalidate(chal_id)
+  async def close(self): self.executor.shutdown(wait=False, cancel_futures=True)
+
+class JobQueue:
+  """Bounded FIFO of GPU jobs. Every slot (a local device or a device of a remote runner, see rpc.py) pulls the
+  next job whenever it is idle, so the event loop never blocks on a kernel.
+  Jobs are called with the device as their first argument."""
+  def __init__(self, slots:list, max_queued:int=MAX_QUEUED, max_per_user:int=MAX_PER_USER):
+    self.slots, self.max_queued, self.max_per_user = slots, max_queued, max_per_user
+    self.pending: deque[Job] = deque()
+    self.running: set[Job] = set()
+    self.avg_runtime = 5.0  # moving average of job runtime in seconds, seeds the ETA before any job finished
+    self.closing = False
+    self.unavailable: Optional[str] = None  # why there are no slots to judge on, if so
+    self._workers: list[asyncio.Task] = []
+
+  def start(self):
+    self._ready, self._closed = asyncio.Semaphore(0), asyncio.Event()
+    slots, self.slots = self.slots, []
+    for slot in slots: self.add(slot)
+
+  def add(self, slot):
+    """Start taking jobs on another slot, eg. once the devices were found after startup."""
+    self.slots.append(slot)
+    slot.start()
+    self._workers.append(asyncio.create_task(self._work(slot), name=f"runner-{slot.name}"))
+
+  def submit(self, fn:Callable[..., Any], *args, user_id:int, max_per_user:Optional[int]=None) -> Job:
+    """Queue a job, max_per_user overrides the limit for background work that paces itself, eg. a rescore."""
+    if self.closing: raise QueueFull("the bot is shutting down, please try again later")
+    if self.unavailable and not self.slots: raise QueueFull(self.unavailable)
+    if len(self.pending) >= self.max_queued:
+      raise QueueFull(f"the judging queue is full ({len(self.pending)} jobs waiting), please try again in a few minutes")
+    if sum(j.user_id == user_id for j in self.pending) >= (limit:=max_per_user or self.max_per_user):
+      raise QueueFull(f"you already have {limit} jobs waiting, please wait for them to finish")
+    job = Job(fn, args, user_id, asyncio.get_running_loop().create_future())
+    self.pending.append(job)
+    self._ready.release()
+    return job
+
+  @property
+  def num_workers(self) -> int: return max(sum(slot.online for slot in self.slots), 1)
+
+  def position(self, job:Job) -> int:
+    """1-based position in the queue, 0 once the job is running or done."""
+    try: return self.pending.index(job) + 1
+    except ValueError: return 0
+
+  def eta(self, job:Job) -> float:
+    if (pos:=self.position(job)) == 0: return max(self.avg_runtime - (time.monotonic() - (job.started_at or time.monotonic())), 0)
+    return ((pos - 1) // self.num_workers + 1) * self.avg_runtime
+
+  def status(self, job:Job) -> str:
+    if (pos:=self.position(job)) == 0: return f"running... (~{fmt_time(self.eta(job))} left)"
+    return f"queued: position {pos} of {len(self.pending)}, starting in ~{fmt_time(self.eta(job))}"
+
+  async def wait(self, job:Job, on_update:Optional[Callable[[Job], Awaitable[Any]]], interval:float=UPDATE_INTERVAL) -> Any:
+    """Wait for the job result, calling on_update every interval seconds while it is queued or running. A failing
+    update (eg. an expired interaction token or a transient HTTP error) is logged and the updates stop, the wait doesn't."""
+    while True:
+      try: return await asyncio.wait_for(asyncio.shield(job.future), timeout=interval)
+      except asyncio.TimeoutError:
+        if on_update is None: continue
+        try: await on_update(job)
+        except Exception as e:
+          logger.warning(f"Stopped status updates of job {job.key}: {type(e).__name__}: {e}")
+          on_update = None
+
+  def invalidate(self, chal_id:int):
+    """Tell every runner a challenge was deleted so it can free the test data it keeps for it."""
+    for slot in self.slots: slot.invalidate(chal_id)
+
+  async def _wait_ready(self, slot) -> bool:
+    ready, closed = asyncio.ensure_future(slot.ready()), asyncio.ensure_future(self._closed.wait())
+    await asyncio.wait([ready, closed], return_when=asyncio.FIRST_COMPLETED)
+    ready.cancel(), closed.cancel()
+    return not closed.done() or ready.done()
+
+  async def _work(self, slot):
+    while True:
+      if not await self._wait_ready(slot): return  # slot never came back before shutdown
+      await self._ready.acquire()
+      if not self.pending: return  # woken by shutdown with nothing left to drain
+      if not slot.online:  # went away while this worker was waiting for a job, leave it to another slot
+        self._ready.release()
+        continue
+      job = self.pending.popleft()
+      if job.future.done(): continue
+      job.started_at, job.attempts = time.monotonic(), job.attempts + 1
+      self.running.add(job)
+      try: res = await slot.execute(job)
+      except RunnerLost as e:
+        if job.attempts < MAX_ATTEMPTS:
+          logger.warning(f"Runner {slot.name} lost job {job.key}, retrying: {e}")
+          self.pending.appendleft(job)
+          self._ready.release()
+        elif not job.future.done(): job.future.set_exception(RuntimeError(f"the runner went away while judging: {e}"))
+      except Exception as e:
+        if not job.future.done(): job.future.set_exception(e)
+      else:
+        if not job.future.done(): job.future.set_result(res)
+      finally:
+        self.running.discard(job)
+        self.avg_runtime = 0.8 * self.avg_runtime + 0.2 * (time.monotonic() - job.started_at)
+
+  async def shutdown(self, timeout:float=DRAIN_TIMEOUT):
+    """Stop accepting jobs and let queued and in-flight ones finish, failing whatever is left after timeout."""
+    if self.closing: return
+    self.closing = True
+    logger.info(f"Draining job queue: {len(self.pending)} queued, {len(self.running)} running")
+    self._closed.set()
+    for _ in self._workers: self._ready.release()
+    if self._workers: _, stuck = await asyncio.wait(self._workers, timeout=timeout)
+    else: stuck = set()
+    for job in list(self.pending) + list(self.running):
+      if not job.future.done(): job.future.set_exception(RuntimeError("the bot shut down before this job finished"))
+    for task in stuck: task.cancel()
+    for slot in self.slots: await slot.close()
@@ -0,0 +1,56 @@
+import fcntl, hashlib, os, tempfile
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from helpers import evict_lru
+
+# content-addressed store of compiled kernels, shared by every runner process on the host
+CACHE_DIR = "kcache"
+MAX_BYTES = 1 << 30  # least recently used binaries are evicted beyond this
+
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+def cache_key(src:str, ktype:str, arch:str, version:str) -> str:
+  h = hashlib.sha256()
+  for part in (ktype, arch, version, src): h.update(part.encode() + b"\0")
+  return h.hexdigest()
+
+def _path(key:str) -> str: return os.path.join(CACHE_DIR, f"{key}.bin")
+
+@contextmanager
+def _locked():
+  # writers serialize eviction on this lock, readers never need it since entries are replaced atomically
+  with open(os.path.join(CACHE_DIR, ".lock"), "a") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try: yield
+    finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+def get(key:str) -> Optional[bytes]:
+  try:
+    with open(path:=_path(key), "rb") as f: lib = f.read()
+    os.utime(path)  # mtime doubles as the LRU timestamp
+  except FileNotFoundError: return None
+  return lib
+
+def put(key:str, lib:bytes):
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tmp-")
+  try:
+    with os.fdopen(fd, "wb") as f: f.write(lib)
+    os.replace(tmp, _path(key))
+  except BaseException:
+    os.unlink(tmp)
+    raise
+  evict()
+
+def evict(max_bytes:Optional[int]=None):
+  with _locked(): stats["evictions"] += evict_lru(CACHE_DIR, ".bin", MAX_BYTES if max_bytes is None else max_bytes)
+
+def compile_cached(src:str, ktype:str, arch:str, version:str, compile_fn:Callable[[str], bytes]) -> bytes:
+  key = cache_key(src, ktype, arch, version)
+  if (lib:=get(key)) is not None:
+    stats["hits"] += 1
+    return lib
+  stats["misses"] += 1
+  put(key, lib:=compile_fn(src))
+  return lib
@@ -0,0 +1,47 @@
+import re
+import numpy as np
+
+# memory layouts a challenge can offer its inputs in. a layout is a "+"-separated list of transforms applied in order
+# to the row-major input, eg. "col+pad32" stores a matrix column-major with every column padded to 32 elements
+ROW = "row"  # as generated, C order
+TRANSFORMS = {
+  "row": lambda a: a,
+  "col": lambda a: np.ascontiguousarray(np.swapaxes(a, -1, -2)) if a.ndim >= 2 else a,  # same as .T.copy() for matrices
+}
+PAD = re.compile(r"pad(\d+)")  # last axis zero-padded to a multiple of N elements, ie. a pitch of N
+
+def parse(layout:str) -> list[str]:
+  """Transforms of a layout, raises ValueError for unknown ones."""
+  parts = layout.strip().lower().split("+")
+  for p in parts:
+    if p not in TRANSFORMS and not ((m:=PAD.fullmatch(p)) and int(m[1]) > 0): raise ValueError(f"unknown layout {layout!r}")
+  return parts
+
+def normalize(layout:str) -> str: return "+".join(p for p in parse(layout) if p != ROW) or ROW
+
+def apply(a:np.ndarray, layout:str) -> np.ndarray:
+  for p in parse(layout):
+    if (m:=PAD.fullmatch(p)):
+      n = int(m[1])
+      a = np.pad(a, [(0, 0)] * (a.ndim - 1) + [(0, -a.shape[-1] % n)]) if a.ndim else a
+    else: a = TRANSFORMS[p](a)
+  return np.ascontiguousarray(a)
+
+def shape(shape:tuple[int, ...], layout:str) -> tuple[int, ...]:
+  """Shape apply gives an array of this shape, without making it."""
+  s = tuple(shape)
+  for p in parse(layout):
+    if (m:=PAD.fullmatch(p)): s = s[:-1] + (s[-1] + -s[-1] % int(m[1]),) if s else s
+    elif p == "col" and len(s) >= 2: s = s[:-2] + (s[-1], s[-2])
+  return s
+
+def key(layouts:tuple[str, ...]) -> str:
+  """Short file name part of a set of per-input layouts."""
+  return "-".join(normalize(l).replace("+", "_") for l in layouts)
+
+def resolve(requested:list[str], allowed:list[str]) -> tuple[str, ...]:
+  """Normalized per-input layouts of a submission, raises ValueError if the challenge doesn't offer one of them."""
+  ok = {normalize(l) for l in allowed} | {ROW}
+  for l in requested:
+    if normalize(l) not in ok: raise ValueError(f"layout {l!r} is not offered by this challenge, choose from {', '.join(sorted(ok))}")
+  return tuple(normalize(l) for l in requested)
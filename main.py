@@ -2,19 +2,38 @@ import discord
 from discord.ext import commands
 
 import asyncio
+import hashlib
+import json
 import subprocess
 import os
+from typing import Optional
 from config import DISCORD_TOKEN
-from utils import logger, formatter
-from cogs import ShowCog, SubmitCog, CreateCog, DeleteCog, ShowDBCog, ShowSubmissionsCog, DeleteUserCog
+from utils import logger, formatter, leaderboards, challenges
+from db import db, Perm
+from jobs import JobQueue
+from rpc import RUNNERS, remote_slots
+from worker import ISOLATE, local_slots
+from cogs import ShowCog, SubmitCog, CreateCog, DeleteCog, ShowDBCog, ShowSubmissionsCog, DeleteUserCog, RescoreCog
+
+NICK = "Kernel Bot"
+ROLES = ("CUDA Coda", "kernelbot admin")  # roles the command permissions refer to
+SYNC_CONCURRENCY = 4  # guilds synced at once, discord.py waits out the rate limit of every request by itself
 
 class KernelBot(commands.Bot):
   def __init__(self):
     intents = discord.Intents.default()
     intents.message_content = True
     super().__init__(intents=intents, command_prefix="!")
+    if RUNNERS:
+      logger.info(f"Judging on remote runners {RUNNERS}")
+      self.jobs = JobQueue(remote_slots(RUNNERS))
+    else: self.jobs = JobQueue([])  # local devices are added by find_devices once the bot is up
+    self.synced: Optional[dict[int, str]] = None  # guild id -> fingerprint of what it was last synced with
+    self.sync_lock = asyncio.Lock()
 
   async def setup_hook(self):
+    self.jobs.start()
+    if not RUNNERS: self._find_devices = asyncio.create_task(self.find_devices())
     logger.info(f"Syncing commands")
     await self.add_cog(SubmitCog(self))
     await self.add_cog(CreateCog(self))
@@ -23,61 +42,73 @@ class KernelBot(commands.Bot):
     await self.add_cog(ShowDBCog(self))
     await self.add_cog(ShowSubmissionsCog(self))
     await self.add_cog(DeleteUserCog(self))
+    await self.add_cog(RescoreCog(self))
+    self.restrict_admin_commands()
+
+  async def find_devices(self):
+    # enumerating GPUs imports the CUDA runtime, which is slow and fails on hosts without one: everything
+    # but judging works regardless, and submissions made meanwhile wait in the queue
+    try: slots, model = await asyncio.to_thread(local_slots)
+    except Exception as e:
+      logger.warning(f"No devices to judge on, submissions are disabled: {e}")
+      self.jobs.unavailable = "judging is not available on this host"
+      return
+    logger.info(f"Judging on {len(slots)} x {model}" + (" in worker processes" if ISOLATE else ""))
+    for slot in slots: self.jobs.add(slot)
+
+  async def close(self):
+    await self.jobs.shutdown()
+    await super().close()
+    await db.close()
+    logger.info(f"{leaderboards}, {challenges}")
 
   async def on_ready(self):
+    # runs again after every reconnect, when usually nothing changed and no guild needs a sync
     logger.info(f"Logged in as {self.user}")
-    for guild in self.guilds:
-      await guild.me.edit(nick="Kernel Bot")
-      
-      await self.set_command_permissions(guild)
-      
-      self.tree.copy_global_to(guild=guild)
-      await self.tree.sync(guild=guild)
+    async with self.sync_lock:
+      if self.synced is None: self.synced = dict(await db.fetchall("SELECT guild_id, fingerprint FROM guild_syncs;"))
+      limit = asyncio.Semaphore(SYNC_CONCURRENCY)
+      async def sync(guild):
+        async with limit: return await self.sync_guild(guild)
+      results = await asyncio.gather(*(sync(guild) for guild in self.guilds), return_exceptions=True)
+    for guild, res in zip(self.guilds, results):
+      if isinstance(res, Exception): logger.error(f"Failed to sync commands to {guild.name}: {res}")
+    logger.info(f"Ready, synced {sum(r is True for r in results)} of {len(self.guilds)} guilds")
+
+  async def on_guild_join(self, guild):
+    async with self.sync_lock: await self.sync_guild(guild)
+
+  def fingerprint(self, guild) -> str:
+    """Hash of everything a sync sends to the guild: the command payload and the roles its permissions refer to."""
+    self.tree.copy_global_to(guild=guild)
+    payload = {"commands": [cmd.to_dict(self.tree) for cmd in self.tree.get_commands(guild=guild)],
+               "roles": {name: getattr(discord.utils.get(guild.roles, name=name), "id", None) for name in ROLES}}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+  async def sync_guild(self, guild) -> bool:
+    """Sync the command tree and permissions to a guild unless it already has them, returns whether it synced."""
+    if guild.me.nick != NICK: await guild.me.edit(nick=NICK)
+    if (self.synced or {}).get(guild.id) == (fp:=self.fingerprint(guild)): return False
+    await self.tree.sync(guild=guild)
+    if not self.check_roles(guild): return True  # synced, but retried on the next start until the roles exist
+    await db.execute("""INSERT INTO guild_syncs (guild_id, fingerprint) VALUES (?, ?)
+                        ON CONFLICT (guild_id) DO UPDATE SET fingerprint = excluded.fingerprint, synced_at = CURRENT_TIMESTAMP;""", (guild.id, fp))
+    if self.synced is not None: self.synced[guild.id] = fp
+    logger.info(f"Synced commands to {guild.name}")
+    return True
+
+  def restrict_admin_commands(self):
+    """Hide admin-only commands from members who can't manage the server. Bots can't give a role access to a command
+    (that needs a user's OAuth2 token), so server admins grant the kernelbot admin role in Server Settings > Integrations.
+    The restriction is part of the command payload, so it is synced (and fingerprinted) with the commands."""
+    for command in self.tree.get_commands():
+      perms = getattr(getattr(command, "callback", None), "_check_user_perms", ())  # see utils.check_user
+      if Perm.ADMIN in perms and Perm.USER not in perms: command.default_permissions = discord.Permissions(manage_guild=True)
 
-  async def set_command_permissions(self, guild):
-      """Set command permissions based on the required roles"""
-      cuda_coda_role = discord.utils.get(guild.roles, name="CUDA Coda")
-      admin_role = discord.utils.get(guild.roles, name="kernelbot admin")
-      
-      logger.info(f"Available roles in {guild.name}: {[role.name for role in guild.roles]}")
-      
-      if not cuda_coda_role:
-          logger.warning(f"Could not find CUDA Coda role in guild {guild.name}")
-      
-      if not admin_role:
-          logger.warning(f"Could not find kernelbot admin role in guild {guild.name}")
-      
-      if not cuda_coda_role or not admin_role:
-          return
-        
-      commands = self.tree.get_commands()
-      
-      for command in commands:
-        if hasattr(command, "_check_user_perms"):
-          perms = command._check_user_perms
-          
-          permissions = []
-          
-          # Admin-only commands
-          if Perm.ADMIN in perms and Perm.USER not in perms:
-            permissions.append(discord.app_commands.CommandPermission(
-              id=admin_role.id, 
-              type=discord.app_commands.CommandPermissionType.role, 
-              permission=True
-            ))
-            # Hide from everyone else
-            permissions.append(discord.app_commands.CommandPermission(
-              id=guild.default_role.id,
-              type=discord.app_commands.CommandPermissionType.role,
-              permission=False
-            ))
-          
-          # Apply permissions if we have any
-          if permissions:
-            try:
-              await self.tree.set_permissions(guild=guild, command=command, permissions=permissions)
-              logger.info(f"Set permissions for command {command.name}")
-            except Exception as e:
-              logger.error(f"Failed to set permissions for command {command.name}: {e}")
+  def check_roles(self, guild) -> bool:
+    """Whether the guild has the roles the commands check for, a guild without them isn't recorded as synced."""
+    missing = [name for name in ROLES if discord.utils.get(guild.roles, name=name) is None]
+    if missing: logger.warning(f"Could not find the {', '.join(missing)} role(s) in guild {guild.name}, commands will refuse everyone")
+    return not missing
 
 if __name__ == "__main__": KernelBot().run(DISCORD_TOKEN, log_formatter=formatter)
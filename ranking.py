@@ -0,0 +1,201 @@
+import asyncio, itertools, random
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from db import db
+
+@dataclass(frozen=True)
+class Entry:
+  user_id: int
+  submission_id: int
+  timing: float
+  name: str
+  type: str
+
+  @property
+  def key(self) -> tuple[float, int]: return (self.timing, self.submission_id)  # ties go to the earlier submission
+
+class _Node:
+  __slots__ = ("entry", "prio", "size", "left", "right")
+  def __init__(self, entry:Entry):
+    self.entry, self.prio, self.size, self.left, self.right = entry, random.random(), 1, None, None
+
+def _size(n:Optional[_Node]) -> int: return n.size if n is not None else 0
+def _fix(n:_Node) -> _Node:
+  n.size = 1 + _size(n.left) + _size(n.right)
+  return n
+
+def _split(n:Optional[_Node], key:tuple) -> tuple[Optional[_Node], Optional[_Node]]:
+  """(keys < key, keys >= key)"""
+  if n is None: return None, None
+  if n.entry.key < key:
+    n.right, right = _split(n.right, key)
+    return _fix(n), right
+  left, n.left = _split(n.left, key)
+  return left, _fix(n)
+
+def _merge(a:Optional[_Node], b:Optional[_Node]) -> Optional[_Node]:
+  """every key of a must be smaller than every key of b"""
+  if a is None or b is None: return a if b is None else b
+  if a.prio > b.prio:
+    a.right = _merge(a.right, b)
+    return _fix(a)
+  b.left = _merge(a, b.left)
+  return _fix(b)
+
+class Board:
+  """Every user's best submission to one challenge, in a treap ordered by timing that keeps subtree sizes,
+  so rank, k-th place and personal best are all O(log n)."""
+  def __init__(self, entries:list[Entry]=()):
+    self.root: Optional[_Node] = None
+    self.best: dict[int, Entry] = {}
+    for e in entries: self.submit(e)
+
+  def __len__(self) -> int: return len(self.best)
+
+  def submit(self, e:Entry) -> bool:
+    """Record a submission, returns whether it is the user's new best."""
+    if (old:=self.best.get(e.user_id)) is not None:
+      if old.key <= e.key: return old.submission_id == e.submission_id
+      self._remove(old)
+    self.best[e.user_id] = e
+    left, right = _split(self.root, e.key)
+    self.root = _merge(_merge(left, _Node(e)), right)
+    return True
+
+  def remove(self, user_id:int) -> Optional[Entry]:
+    if (e:=self.best.pop(user_id, None)) is not None: self._remove(e)
+    return e
+
+  def _remove(self, e:Entry):
+    left, rest = _split(self.root, e.key)
+    _, right = _split(rest, (e.timing, e.submission_id + 1))
+    self.root = _merge(left, right)
+
+  def count_faster(self, timing:float) -> int:
+    n, count = self.root, 0
+    while n is not None:
+      if n.entry.timing < timing: count, n = count + _size(n.left) + 1, n.right
+      else: n = n.left
+    return count
+
+  def index(self, user_id:int) -> int:
+    """0-based position of the user in leaderboard order, -1 without a submission."""
+    if (e:=self.best.get(user_id)) is None: return -1
+    n, count = self.root, 0
+    while n is not None:
+      if n.entry.key < e.key: count, n = count + _size(n.left) + 1, n.right
+      elif n.entry.key > e.key: n = n.left
+      else: return count + _size(n.left)
+    raise RuntimeError("ranking out of sync with its index")
+
+  def rank(self, user_id:int) -> int:
+    """1-based rank of the user, users with the same time share a rank. 0 without a submission."""
+    return self.count_faster(e.timing) + 1 if (e:=self.best.get(user_id)) is not None else 0
+
+  def kth(self, k:int) -> Entry:
+    """Entry in 0-based leaderboard position k."""
+    if not 0 <= k < len(self): raise IndexError(k)
+    n = self.root
+    while True:
+      if k < (ls:=_size(n.left)): n = n.left
+      elif k == ls: return n.entry
+      else: k, n = k - ls - 1, n.right
+
+  def neighbors(self, user_id:int, k:int=1) -> tuple[list[Entry], list[Entry]]:
+    """The up to k users just ahead of and just behind the user."""
+    if (i:=self.index(user_id)) < 0: return [], []
+    return [self.kth(j) for j in range(max(i - k, 0), i)], [self.kth(j) for j in range(i + 1, min(i + k + 1, len(self)))]
+
+  def top(self, k:Optional[int]=None) -> list[Entry]: return list(itertools.islice(self, k))
+
+  def __iter__(self) -> Iterator[Entry]:
+    stack, n = [], self.root
+    while stack or n is not None:
+      while n is not None: stack.append(n); n = n.left
+      n = stack.pop()
+      yield n.entry
+      n = n.right
+
+BOARD_QUERY = """
+  SELECT b.user_id, b.submission_id, b.timing, s.name, s.type
+  FROM best_submissions b JOIN submissions s ON s.id = b.submission_id
+  WHERE b.comp_id = ?
+"""
+# timings measured with one fingerprint (see run.fingerprint): rescores first, then submissions originally judged with it
+FINGERPRINT_BOARD_QUERY = """
+  SELECT s.user_id, s.id, r.timing, s.name, s.type
+  FROM rescores r JOIN submissions s ON s.id = r.submission_id
+  WHERE r.fingerprint = ?1 AND s.comp_id = ?2 AND r.timing IS NOT NULL
+  UNION ALL
+  SELECT user_id, id, timing, name, type FROM submissions
+  WHERE fingerprint = ?1 AND comp_id = ?2 AND id NOT IN (SELECT submission_id FROM rescores WHERE fingerprint = ?1)
+"""
+# ground truth for check(), straight from submissions rather than the best_submissions table the boards are loaded from
+CHECK_QUERY = """
+  SELECT user_id, id, timing FROM (
+    SELECT user_id, id, timing, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timing, id) AS rn
+    FROM submissions WHERE comp_id = ?
+  ) WHERE rn = 1 ORDER BY timing, id
+"""
+
+class Rankings:
+  """Leaderboards of every challenge, loaded from the database the first time they are needed and then kept in
+  sync by the cogs that insert or delete submissions. Besides the main board of a challenge, there is one board per
+  fingerprint its submissions were timed (or rescored) with, see cogs/rescore.py."""
+  def __init__(self):
+    self.boards: dict[tuple[int, Optional[str]], asyncio.Future] = {}  # (comp_id, fingerprint or None) -> board
+
+  async def board(self, comp_id:int, fingerprint:Optional[str]=None) -> Board:
+    # concurrent first requests share one load
+    if (fut:=self.boards.get(key:=(comp_id, fingerprint))) is None:
+      self.boards[key] = fut = asyncio.ensure_future(self._load(comp_id, fingerprint))
+      fut.add_done_callback(lambda f: f.cancelled() or f.exception() is None or self.boards.pop(key, None))
+    return await asyncio.shield(fut)
+
+  async def _load(self, comp_id:int, fingerprint:Optional[str]=None) -> Board:
+    if fingerprint is None: return Board([Entry(*row) for row in await db.fetchall(BOARD_QUERY, (comp_id,))])
+    return Board([Entry(*row) for row in await db.fetchall(FINGERPRINT_BOARD_QUERY, (fingerprint, comp_id))])
+
+  def _loaded(self, key:tuple[int, Optional[str]]) -> Optional[Board]:
+    """A board that finished loading, boards still loading (or failed) are dropped as they may miss a change."""
+    if (fut:=self.boards.get(key)) is not None and fut.done() and not fut.cancelled() and fut.exception() is None: return fut.result()
+    self.boards.pop(key, None)
+    return None
+
+  async def submit(self, comp_id:int, e:Entry, fingerprint:Optional[str]=None) -> bool:
+    """Record a committed submission, returns whether it is the user's new best."""
+    if fingerprint is not None and (board:=self._loaded((comp_id, fingerprint))) is not None: board.submit(e)
+    return (await self.board(comp_id)).submit(e)
+
+  def drop(self, comp_id:int, fingerprint:Optional[str]=None):
+    """Forget the boards of a challenge (only the one of fingerprint if given), eg. when it was deleted or rescored,
+    they are reloaded from the database if needed again."""
+    for key in [k for k in self.boards if k[0] == comp_id and fingerprint in (None, k[1])]: self.boards.pop(key, None)
+
+  def drop_user(self, user_id:int):
+    for key in list(self.boards):
+      if (board:=self._loaded(key)) is not None: board.remove(user_id)
+
+  async def check(self, comp_id:int) -> list[str]:
+    """Compare a board against the submissions table, returns the differences (none if they agree)."""
+    board, rows = await self.board(comp_id), await db.fetchall(CHECK_QUERY, (comp_id,))
+    ours = [(e.user_id, e.submission_id, e.timing) for e in board]
+    if ours == [tuple(r) for r in rows]: return []
+    want, have = {r[0]: tuple(r) for r in rows}, {r[0]: r for r in ours}
+    diffs = [f"user {u}: board has {have.get(u)}, database has {want.get(u)}" for u in sorted(want.keys() | have.keys()) if have.get(u) != want.get(u)]
+    return diffs or ["same entries in a different order"]
+
+rankings = Rankings()
+
+if __name__ == "__main__":
+  async def check_all():
+    bad = 0
+    for comp_id, name in await db.fetchall("SELECT id, name FROM challenges;"):
+      diffs = await rankings.check(comp_id)
+      print(f"{name}: {len((await rankings.board(comp_id)))} users, " + (f"{len(diffs)} differences" if diffs else "ok"))
+      for d in diffs: print(f"  {d}")
+      bad += bool(diffs)
+    await db.close()
+    return bad
+  raise SystemExit(asyncio.run(check_all()))
@@ -6,6 +6,10 @@
 #ifndef DB
 #define DB "kernelbot.db"
 #endif
+/* ms to wait while the bot is writing, the database is in WAL mode so reads never block us */
+#ifndef BUSY_TIMEOUT
+#define BUSY_TIMEOUT 5000
+#endif
 
 int main(int argc, char **argv) {
   long long uid;
@@ -30,6 +34,7 @@ int main(int argc, char **argv) {
     sqlite3_close(db);
     return 1;
   }
+  sqlite3_busy_timeout(db, BUSY_TIMEOUT);
 
   if (sqlite3_prepare_v2(db, sql, -1, &stmt, NULL) != SQLITE_OK) {
     fprintf(stderr, "Failed to prepare statement: %s\n", sqlite3_errmsg(db));
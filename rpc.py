@@ -0,0 +1,151 @@
+import asyncio, hmac, itertools, json, os
+from typing import Any, Optional
+
+import store
+from jobs import Job, RunnerLost
+from run import CompileError, WrongAnswer
+from helpers import logger
+
+# comma separated host:port of runner daemons (see runner.py), judging happens in-process when empty
+RUNNERS = os.getenv("KERNELBOT_RUNNERS", "")
+# shared secret a client shows in its first message, runners refuse other clients. it is sent in the clear, so a runner
+# reachable from outside a trusted network belongs behind a tunnel or VPN
+TOKEN = os.getenv("KERNELBOT_RUNNER_TOKEN", "")
+MAX_SLOTS = 16           # most devices a single runner is expected to have
+HEALTH_INTERVAL = 5.0    # seconds between pings of a connected runner
+HEALTH_TIMEOUT = 10.0    # a runner that doesn't answer a ping within this is considered dead
+MAX_BACKOFF = 30.0       # seconds between reconnection attempts, doubling from 1
+
+# wire format: one json object per line, followed by "size" bytes of raw payload. the first message on a connection is
+# {"op": "hello", "token": TOKEN}, answered like any other call
+async def send(writer:asyncio.StreamWriter, msg:dict, payload:bytes=b""):
+  writer.write(json.dumps({**msg, "size": len(payload)}).encode() + b"\n" + payload)
+  await writer.drain()
+
+async def recv(reader:asyncio.StreamReader) -> tuple[dict, bytes]:
+  if not (line:=await reader.readline()): raise ConnectionError("connection closed")
+  msg = json.loads(line)
+  return msg, await reader.readexactly(size) if (size:=msg.pop("size", 0)) else b""
+
+def authentic(msg:dict, token:str) -> bool:
+  return isinstance(msg, dict) and msg.get("op") == "hello" and hmac.compare_digest(str(msg.get("token", "")).encode(), token.encode())
+
+class RemoteError(Exception):
+  def __init__(self, kind:str, message:str):
+    super().__init__(message)
+    self.kind = kind
+
+class RemoteRunner:
+  """Connection to a runner daemon, kept alive with pings and reconnected with backoff whenever it drops."""
+  def __init__(self, host:str, port:int, token:str=TOKEN):
+    self.host, self.port, self.name, self.token = host, port, f"{host}:{port}", token
+    self.capacity, self.load, self.inflight, self.model = 0, 0, 0, None
+    self._pending: dict[int, asyncio.Future] = {}
+    self._ids = itertools.count()
+    self._writer: Optional[asyncio.StreamWriter] = None
+    self._task: Optional[asyncio.Task] = None
+
+  def start(self):
+    if self._task is None:
+      self._changed, self._lock = asyncio.Condition(), asyncio.Lock()
+      self._task = asyncio.create_task(self._maintain(), name=f"rpc-{self.name}")
+
+  async def close(self):
+    if self._task is not None: self._task.cancel()
+
+  async def _notify(self):
+    async with self._changed: self._changed.notify_all()
+
+  async def _maintain(self):
+    backoff = 1.0
+    while True:
+      reader_task = None
+      try:
+        reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), HEALTH_TIMEOUT)
+        await send(self._writer, {"id": None, "op": "hello", "token": self.token})
+        if not (reply:=(await asyncio.wait_for(recv(reader), HEALTH_TIMEOUT))[0])["ok"]: raise RemoteError(reply["kind"], reply["error"])
+        reader_task = asyncio.create_task(self._read(reader))
+        while not reader_task.done():
+          info, _ = await asyncio.wait_for(self.call("ping"), HEALTH_TIMEOUT)
+          if self.capacity == 0: logger.info(f"Runner {self.name} is up with {info['capacity']} x {info['model']}")
+          # devices busy with other clients' jobs aren't available to us
+          self.capacity, self.model = info["capacity"], info["model"]
+          self.load, backoff = max(info["load"] - self.inflight, 0), 1.0
+          await self._notify()
+          await asyncio.wait([reader_task], timeout=HEALTH_INTERVAL)
+        await reader_task
+      except asyncio.CancelledError: raise
+      except Exception as e: logger.warning(f"Runner {self.name} unavailable: {e!r}")
+      finally:
+        self.capacity = 0
+        if reader_task is not None: reader_task.cancel()
+        if self._writer is not None: self._writer.close()
+        self._writer = None
+      await self._notify()
+      await asyncio.sleep(backoff)
+      backoff = min(backoff * 2, MAX_BACKOFF)
+
+  async def _read(self, reader:asyncio.StreamReader):
+    try:
+      while True:
+        msg, payload = await recv(reader)
+        if (fut:=self._pending.pop(msg["id"], None)) is not None and not fut.done(): fut.set_result((msg, payload))
+    finally:
+      self.capacity = 0
+      for fut in self._pending.values():
+        if not fut.done(): fut.set_exception(RunnerLost(f"lost connection to {self.name}"))
+      self._pending.clear()
+
+  async def call(self, op:str, *args, payload:bytes=b"", key:Optional[str]=None) -> tuple[Any, bytes]:
+    if self._writer is None: raise RunnerLost(f"not connected to {self.name}")
+    self._pending[rid:=next(self._ids)] = fut = asyncio.get_running_loop().create_future()
+    try:
+      async with self._lock: await send(self._writer, {"id": rid, "op": op, "args": args, "key": key}, payload)
+    except (ConnectionError, OSError) as e: raise RunnerLost(f"lost connection to {self.name}: {e}")
+    msg, payload = await fut
+    if not msg["ok"]: raise RemoteError(msg["kind"], msg["error"])
+    return msg["result"], payload
+
+  def available(self, slot:int) -> bool: return slot < self.capacity - self.load
+
+class RemoteSlot:
+  """One device of a remote runner, it only takes jobs while the runner is healthy and that device is free."""
+  def __init__(self, runner:RemoteRunner, idx:int):
+    self.runner, self.idx, self.name = runner, idx, f"{runner.name}#{idx}"
+
+  @property
+  def online(self) -> bool: return self.idx < self.runner.capacity
+  def start(self): self.runner.start()
+  async def close(self): await self.runner.close()
+
+  async def ready(self):
+    async with self.runner._changed: await self.runner._changed.wait_for(lambda: self.runner.available(self.idx))
+
+  def invalidate(self, chal_id:int):
+    if self.idx == 0 and self.runner.capacity: asyncio.create_task(self.runner.call("invalidate", chal_id))
+
+  async def execute(self, job:Job) -> Any:
+    self.runner.inflight += 1
+    try: return await self._execute(job)
+    finally: self.runner.inflight -= 1
+
+  async def _execute(self, job:Job) -> Any:
+    op = job.fn.__name__
+    for _ in range(2):
+      try: result, _ = await self.runner.call(op, *job.args, key=job.key)
+      except RemoteError as e:
+        if e.kind == "compile": raise CompileError(str(e)) from None
+        if e.kind == "wrong": raise WrongAnswer(str(e)) from None
+        if e.kind != "missing_tests": raise
+        # the runner hasn't seen this challenge's test file yet
+        with open(store.path(str(e)), "rb") as f: await self.runner.call("put_tests", str(e), payload=f.read())
+        continue
+      if op == "make_tests" and not os.path.exists(store.path(result[0])):
+        _, data = await self.runner.call("get_tests", result[0])
+        store.put(data)
+      return result
+    raise RuntimeError(f"runner {self.runner.name} did not accept the test data")
+
+def remote_slots(spec:str=RUNNERS) -> list[RemoteSlot]:
+  runners = [RemoteRunner(host, int(port)) for host, _, port in (addr.strip().rpartition(":") for addr in spec.split(",") if addr.strip())]
+  return [RemoteSlot(r, i) for r in runners for i in range(MAX_SLOTS)]
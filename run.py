@@ -1,83 +1,174 @@
-import safetensors.numpy
+import hashlib, json, time
 import numpy as np
-from tinygrad import GlobalCounters
-from tinygrad.helpers import flat_mv
-from tinygrad.runtime.ops_cuda import CUDAAllocator, CUDADevice, CUDAProgram
-from tinygrad.runtime.support.compiler_cuda import CUDACompiler, PTXCompiler
 from statistics import fmean
-from discord.app_commands import Choice
-from typing import Callable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Any, Optional, Sequence, Tuple
 
-from utils import prod
+import bench, compare, kcache, store
+from devices import Backend
+from helpers import logger, prod
 
 ktypes = ["CUDA", "PTX"]
-async def ktype_ac(_, curr): return [Choice(name=kt, value=kt) for kt in ktypes if curr.lower() in kt.lower()]
 
-device = CUDADevice("cuda:0")
-compilers = {
-  'CUDA': CUDACompiler(device.arch),
-  'PTX': PTXCompiler(device.arch)
-}
-cualloc = CUDAAllocator(device)
+rand_fns = store.RAND_FNS
 
-def cc(kernel:str, ktype:str, name:str) -> CUDAProgram: return CUDAProgram(device, name, compilers[ktype].compile(kernel))
+class CompileError(Exception): pass
 
-def run(prog:CUDAProgram, global_size:tuple[int,int,int], local_size:tuple[int,int,int], *args) -> int:
-  return prog(*args, global_size=global_size, local_size=local_size, wait=True)
+def cc(dev:Backend, kernel:str, ktype:str, name:str) -> Any:
+  # the entry point name isn't part of the key, so renamed resubmissions of the same source still hit
+  compiler = dev.compilers[ktype]
+  lib = kcache.compile_cached(kernel, ktype, dev.arch, f"{type(compiler).__name__}-{dev.toolchain}", compiler.compile)
+  return dev.load(name, lib)
 
-def gen_tests(prog:CUDAProgram, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
+launch_started: Optional[float] = None  # time.monotonic() at the start of the launch in flight, watched by worker.py
+
+def run(prog:Any, global_size:tuple[int,int,int], local_size:tuple[int,int,int], *args) -> int:
+  global launch_started
+  launch_started = time.monotonic()
+  try: return prog(*args, global_size=global_size, local_size=local_size, wait=True)
+  finally: launch_started = None
+
+def gen_tests(dev:Backend, prog:Any, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
               in_shapes:list[Tuple[int,...]], out_shape:Tuple[int,...], dtype,
-              rand_fn:Callable[...,np.ndarray], num_tests:int) -> Tuple[bytes, float]:
+              rand_fn:str, num_tests:int, seeded:bool=True, config:bench.BenchConfig=bench.DEFAULT) -> Tuple[str, float]:
+  """Runs the reference kernel on random inputs. Seeded test files only store the outputs and the seed,
+  the inputs are regenerated from it when needed (see store.TestFile)."""
   assert num_tests > 0, "must generate at least one test"
-  tensors, times = {}, []
+  tensors, times, digests, seed = {}, [], [], store.new_seed()
   for i in range(num_tests):
     # create tensors and buffers
-    args = [rand_fn(*shape).astype(dtype) for shape in in_shapes]
-    tg_args = [cualloc.alloc(arg.size * arg.itemsize) for arg in args]
-    for arg, tg in zip(args, tg_args): cualloc._copyin(tg, bytearray(arg))
-    print(dtype)
-    out_tg = cualloc.alloc(prod(out_shape) * dtype.itemsize)
-    # run kernel
-    times.append(run(prog, global_size, local_size, *tg_args, out_tg))
-    # store to safetensors
-    for j, t in enumerate(args): tensors[f"test{i}.in.{j}"] = t
-    cualloc._copyout(flat_mv((out:=np.empty(out_shape, dtype=dtype)).data), out_tg)
-    tensors[f"test{i}.out"] = out
-
-  return safetensors.numpy.save(tensors), fmean(times)
-
-def run_tests(prog:CUDAProgram, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
-              tensors: bytes, challenge_name: str = None, transpose_a: bool = False, 
-              transpose_b: bool = False) -> float:
-    tensor_dict = safetensors.numpy.load(tensors)
-    num_tests = len(set([k.split('.')[0] for k in tensor_dict.keys()]))
-    num_args = max([int(k.split('.')[-1]) for k in tensor_dict.keys() if 'in' in k]) + 1
-    times = []
+    args = store.generate_inputs(seed, rand_fn, dtype, in_shapes, i)
+    digests.append(store.inputs_digest(args))
+    with dev.pool.lease() as lease:
+      tg_args = [lease.acquire(arg.size * arg.itemsize) for arg in args]
+      for arg, tg in zip(args, tg_args): dev.upload(tg, arg)
+      out_tg = lease.output(prod(out_shape) * dtype.itemsize)
+      # run kernel
+      run(prog, global_size, local_size, *tg_args, out_tg)
+      times.append(bench.benchmark(lambda: run(prog, global_size, local_size, *tg_args, out_tg), dev.flush_l2, config).median)
+      # store to safetensors
+      if not seeded:
+        for j, t in enumerate(args): tensors[f"test{i}.in.{j}"] = t
+      dev.download(out:=np.empty(out_shape, dtype=dtype), out_tg)
+      tensors[f"test{i}.out"] = out
+
+  return store.save(tensors, store.seeded_metadata(seed, rand_fn, dtype, in_shapes, digests) if seeded else None), fmean(times)
+
+VERIFY_THREADS = 4  # threads comparing the chunks of one output, see compare.py
+
+class WrongAnswer(Exception): pass
+
+def check_output(out:np.ndarray, expected:np.ndarray, test:int, tol:Optional[compare.Tolerance]=None) -> compare.Mismatch:
+    """Raises WrongAnswer with a short summary of the mismatching elements, returns the error statistics otherwise."""
+    tol = tol or compare.default_tolerance(expected.dtype)
+    res = compare.compare(out, expected, tol, threads=VERIFY_THREADS)
+    if not res.ok: raise WrongAnswer(f"test {test}: {res.summary(expected.shape)} ({', '.join(f'{k}={v}' for k, v in tol.to_dict().items())})")
+    return res
+
+METHOD_VERSION = 1  # bump when timings change in a way BenchConfig doesn't capture, eg. how the median is taken
+
+def method(dev:Backend, config:bench.BenchConfig=bench.DEFAULT) -> dict:
+  """Everything a timing depends on besides the kernel: device model, driver and compiler versions, benchmark settings."""
+  return {**asdict(config), "version": METHOD_VERSION, "device": dev.model, "toolchain": dev.toolchain}
+
+def fingerprint(dev:Backend, config:bench.BenchConfig=bench.DEFAULT) -> str:
+  """Short hash of method(), timings are only comparable if their fingerprints match. Also a job entry point."""
+  return hashlib.sha256(json.dumps(method(dev, config), sort_keys=True).encode()).hexdigest()[:16]
+
+def run_tests(dev:Backend, prog:Any, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
+              tests: str, layouts: Sequence[str] = (), chal_id: Optional[int] = None,
+              config: bench.BenchConfig = bench.DEFAULT, tolerance: Optional[dict] = None,
+              stages: Optional[bench.Stages] = None) -> Tuple[float, dict]:
+    """Verifies every test, then benchmarks them. Returns the mean of per-test medians and the full statistics.
+    Verification runs the smallest test first and stops at the first wrong output, so most wrong submissions
+    are rejected after a single small launch. layouts are the submission's per-input layouts (see layouts.py), tolerance
+    overrides the dtype's default, see compare.Tolerance."""
+    tol, stages = compare.Tolerance.from_dict(tolerance), stages or bench.Stages()
+    test_file = store.TestFile(tests)
+    layouts = test_file.full_layouts(tuple(layouts))
+    sizes = [test_file.test_nbytes(i, layouts) for i in range(test_file.num_tests)]
+    order = sorted(range(test_file.num_tests), key=sizes.__getitem__)
+    # inputs of known challenges stay resident on the device, see tcache.py
+    key = (chal_id, layouts) if chal_id is not None else None
+    res = dev.tcache.get(key) if key is not None else None
+    
+    def get_test(i):
+        return (res.inputs[i], res.outputs[i]) if res is not None else test_file.test(i, layouts)
+    
+    def upload(lease, args) -> list:
+        if res is not None:
+            # work on copies so a kernel writing to its inputs can't corrupt the cached ones
+            tg_args = [lease.acquire(sz) for _, sz in args]
+            with stages("device_copy", sum(sz for _, sz in args)):
+                for tg, (buf, sz) in zip(tg_args, args): dev.copy(tg, buf, sz)
+        else:
+            tg_args = [lease.acquire(arg.nbytes) for arg in args]
+            # straight from the (memory mapped) arrays, see Backend.upload
+            with stages("upload", sum(arg.nbytes for arg in args)):
+                for arg, tg in zip(args, tg_args): dev.upload(tg, arg)
+        return tg_args
     
-    for i in range(num_tests):
-        args = [tensor_dict[f"test{i}.in.{j}"] for j in range(num_args)]
-        
-        if challenge_name and challenge_name.lower() == "matmul":
-            if transpose_a and len(args) > 0:
-                args[0] = args[0].T.copy()  # ensure contiguous memory
-            if transpose_b and len(args) > 1:
-                args[1] = args[1].T.copy()
-        
-        tg_args = [cualloc.alloc(arg.size * arg.itemsize) for arg in args]
-        for arg, tg in zip(args, tg_args): 
-            cualloc._copyin(tg, bytearray(arg))
-        
-        out_tg = cualloc.alloc(tensor_dict[f"test{i}.out"].size * tensor_dict[f"test{i}.out"].itemsize)
-        
-        # run kernel
-        GlobalCounters.reset()
-        times.append(run(prog, global_size, local_size, *tg_args, out_tg))
-        
-        # check output
-        out = np.empty(tensor_dict[f"test{i}.out"].shape, dtype=tensor_dict[f"test{i}.out"].dtype)
-        cualloc._copyout(flat_mv(out.data), out_tg)
-        np.testing.assert_allclose(out, tensor_dict[f"test{i}.out"], rtol=1e-3, atol=1e-3)
+    def launch(i) -> tuple[np.ndarray, np.ndarray]:
+        args, expected = get_test(i)
+        with dev.pool.lease() as lease:
+            tg_args = upload(lease, args)
+            out_tg = lease.output(expected.size * expected.itemsize)
+            with stages("launch"): run(prog, global_size, local_size, *tg_args, out_tg)
+            out = np.empty(expected.shape, dtype=expected.dtype)
+            with stages("download", out.nbytes): dev.download(out, out_tg)
+        return out, expected
     
-    print('times:', times)
+    # check a single launch of every test before spending time on benchmarks
+    errors = [None] * len(sizes)
+    def verify(out, expected, i):
+        with stages("verify", expected.nbytes): errors[i] = check_output(out, expected, i, tol)
+    # the smallest test goes first, so a wrong submission doesn't get to upload every test into the cache
+    verify(*launch(order[0]), order[0])
+    if res is None and key is not None:
+        nbytes = sum(sizes)
+        with stages("upload", nbytes): res = dev.tcache.put(key, (test_file.test(i, layouts) for i in range(test_file.num_tests)), nbytes)
+    # the output of one test is compared on the host while the next one is uploaded and launched
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="verify") as verifier:
+        checking = None
+        for i in order[1:]:
+            out, expected = launch(i)
+            if checking is not None: checking.result()
+            checking = verifier.submit(verify, out, expected, i)
+        if checking is not None: checking.result()
     
-    return fmean(times)
+    # every timed launch starts from a poisoned output and the last one is checked too, so a kernel that only
+    # computes the result on its first launch (or leaves the verified one in place) fails instead of timing a no-op
+    stats = []
+    for i in range(len(sizes)):
+        args, expected = get_test(i)
+        with dev.pool.lease() as lease:
+            tg_args = upload(lease, args)
+            out_tg = lease.output(nbytes:=expected.size * expected.itemsize)
+            with stages("benchmark"):
+                stats.append(bench.benchmark(lambda: run(prog, global_size, local_size, *tg_args, out_tg), dev.flush_l2, config,
+                                             reset=lambda: lease.poison(out_tg, nbytes)))
+            out = np.empty(expected.shape, dtype=expected.dtype)
+            with stages("download", out.nbytes): dev.download(out, out_tg)
+        with stages("verify", expected.nbytes): check_output(out, expected, i, tol)
+    
+    logger.debug(f"medians {[st.median for st in stats]}, pool {dev.pool.occupancy()}, stages {stages.to_dict()}")
+    
+    return fmean(st.median for st in stats), {"method": {**method(dev, config), "device_name": dev.name},
+                                              "fingerprint": fingerprint(dev, config), "stages": stages.to_dict(),
+                                              "tests": [{**st.to_dict(), "max_abs_err": err.max_abs, "max_rel_err": err.max_rel}
+                                                        for st, err in zip(stats, errors)]}
+
+# job entry points, executed by the runner workers in jobs.py on their own device
+def judge(dev:Backend, kernel:str, ktype:str, name:str, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
+          tests:str, layouts:Sequence[str]=(), chal_id:Optional[int]=None, tolerance:Optional[dict]=None) -> Tuple[float, dict]:
+  try: prog = cc(dev, kernel, ktype, name)
+  except Exception as e: raise CompileError(str(e)) from e
+  return run_tests(dev, prog, global_size, local_size, tests, layouts, chal_id, tolerance=tolerance)
+
+def make_tests(dev:Backend, kernel:str, ktype:str, name:str, global_size:tuple[int,int,int], local_size:tuple[int,int,int],
+               in_shapes:list[Tuple[int,...]], out_shape:Tuple[int,...], dtype:str, rand_fn:str, num_tests:int,
+               seeded:bool=True) -> Tuple[str, float]:
+  try: prog = cc(dev, kernel, ktype, name)
+  except Exception as e: raise CompileError(str(e)) from e
+  return gen_tests(dev, prog, global_size, local_size, in_shapes, out_shape, np.dtype(dtype), rand_fn, num_tests, seeded)
@@ -0,0 +1,101 @@
+import argparse, asyncio, ipaddress, json, os
+from typing import Any, Optional
+
+import run, store
+from devices import BACKEND
+from jobs import JobQueue
+from rpc import TOKEN, authentic, recv, send
+from worker import ISOLATE, local_slots
+from helpers import logger
+
+RESULT_TTL = 600.0  # seconds a finished job's result is kept for a client that reconnects to collect it
+
+class MissingTests(Exception): pass
+
+class RunnerServer:
+  """Compiles, verifies and benchmarks kernels on this host's devices for any number of bots (see rpc.py).
+  Jobs outlive the connection that submitted them, so a restarting bot doesn't kill in-flight benchmarks."""
+  def __init__(self, slots:list, model:str, token:str=TOKEN):
+    self.model, self.token = model, token
+    # the bot already enforces per-user limits, here every client is a single "user"
+    self.jobs = JobQueue(slots, max_per_user=1 << 30)
+    self.inflight: dict[str, asyncio.Future] = {}
+
+  async def serve(self, host:str, port:int):
+    self.jobs.start()
+    server = await asyncio.start_server(self.handle, host, port)
+    logger.info(f"Runner listening on {host}:{port} with {len(self.jobs.slots)} x {self.model}")
+    try:
+      async with server: await server.serve_forever()
+    finally: await self.jobs.shutdown()
+
+  async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+    lock, tasks = asyncio.Lock(), set()
+    try:
+      # nothing else, not even a payload, is read from a client that didn't show the token
+      hello = json.loads(await reader.readline() or "{}")
+      if not authentic(hello, self.token):
+        logger.warning(f"Rejected runner client {writer.get_extra_info('peername')}: wrong token")
+        return await send(writer, {"id": None, "ok": False, "kind": "auth", "error": "wrong runner token"})
+      await send(writer, {"id": None, "ok": True, "result": None})
+      while True:
+        msg, payload = await recv(reader)
+        tasks.add(task:=asyncio.create_task(self.dispatch(msg, payload, writer, lock)))
+        task.add_done_callback(tasks.discard)
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError): pass
+    finally: writer.close()
+
+  async def dispatch(self, msg:dict, payload:bytes, writer:asyncio.StreamWriter, lock:asyncio.Lock):
+    out = b""
+    try:
+      result, out = await self.op(msg["op"], msg["args"], payload, msg.get("key"))
+      reply = {"id": msg["id"], "ok": True, "result": result}
+    except run.CompileError as e: reply = {"id": msg["id"], "ok": False, "kind": "compile", "error": str(e)}
+    except run.WrongAnswer as e: reply = {"id": msg["id"], "ok": False, "kind": "wrong", "error": str(e)}
+    except MissingTests as e: reply = {"id": msg["id"], "ok": False, "kind": "missing_tests", "error": str(e)}
+    except Exception as e: reply = {"id": msg["id"], "ok": False, "kind": "error", "error": str(e) or repr(e)}
+    try:
+      async with lock: await send(writer, reply, out)
+    except (ConnectionError, OSError): pass  # the client went away, it can collect the result by key later
+
+  async def op(self, op:str, args:list, payload:bytes, key:Optional[str]) -> tuple[Any, bytes]:
+    if op == "ping":
+      return {"capacity": sum(slot.online for slot in self.jobs.slots), "model": self.model,
+              "load": len(self.jobs.pending) + len(self.jobs.running)}, b""
+    if op in ("judge", "make_tests", "fingerprint"):
+      if op == "judge" and not os.path.exists(store.path(args[5])): raise MissingTests(args[5])
+      return await self.submit(getattr(run, op), args, key), b""
+    if op == "put_tests":
+      if store.put(payload) != args[0]: raise ValueError("test data does not match its hash")
+      return None, b""
+    if op == "get_tests":
+      with open(store.path(args[0]), "rb") as f: return None, f.read()
+    if op == "invalidate":
+      self.jobs.invalidate(args[0])
+      return None, b""
+    raise ValueError(f"unknown op {op}")
+
+  async def submit(self, fn, args:list, key:Optional[str]) -> Any:
+    # a retried job (same key) attaches to the original run instead of starting over
+    if key is None or (fut:=self.inflight.get(key)) is None:
+      fut = self.jobs.submit(fn, *args, user_id=0).future
+      if key is not None:
+        self.inflight[key] = fut
+        fut.add_done_callback(lambda f: self._expire(f, key))
+    return await asyncio.shield(fut)
+
+  def _expire(self, fut:asyncio.Future, key:str):
+    if not fut.cancelled(): fut.exception()  # retrieved here in case the client never comes back for it
+    asyncio.get_running_loop().call_later(RESULT_TTL, self.inflight.pop, key, None)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(prog="runner", description="serve kernel evaluation for remote bots")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=7000)
+  parser.add_argument("--backend", default=BACKEND, help="device backend, eg. cuda or mock:2")
+  parser.add_argument("--isolate", action=argparse.BooleanOptionalAction, default=ISOLATE, help="judge in supervised worker processes")
+  args = parser.parse_args()
+  try: loopback = args.host == "localhost" or ipaddress.ip_address(args.host).is_loopback
+  except ValueError: loopback = False
+  if not TOKEN and not loopback: parser.error(f"set KERNELBOT_RUNNER_TOKEN (on the bot too) to listen on {args.host}, anyone who can connect may run code here")
+  asyncio.run(RunnerServer(*local_slots(args.backend, args.isolate)).serve(args.host, args.port))
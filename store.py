@@ -0,0 +1,203 @@
+import hashlib, json, mmap, os, tempfile, time
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+import safetensors.numpy
+
+import layouts
+from helpers import evict_lru
+
+# content-addressed .safetensors files holding challenge tests, relative to the working directory like db.DB
+TESTS_DIR = "testdata"
+OLD_TESTS_DIR = "tests"  # before v12, see db.move_test_store
+SWEEP_GRACE = 3600.0     # seconds a file may go unreferenced, /create stores its tests before the challenge row exists
+
+DTYPES = {"F64": np.float64, "F32": np.float32, "F16": np.float16, "I64": np.int64, "I32": np.int32, "I16": np.int16,
+          "I8": np.int8, "U64": np.uint64, "U32": np.uint32, "U16": np.uint16, "U8": np.uint8, "BOOL": np.bool_}
+
+# inputs regenerated from seeded test files and inputs in other layouts, a cache that can be deleted at any time
+INPUTS_DIR = os.path.join(TESTS_DIR, "inputs")
+MAX_INPUT_BYTES = 16 << 30
+
+# seeded generators of test inputs, vectorized and reproducible from (seed, test index) alone.
+# floats are drawn in float32 or float64 directly instead of drawing float64 and converting
+def _floats(draw:Callable) -> Callable[[np.random.Generator, tuple, np.dtype], np.ndarray]:
+  return lambda rng, shape, dtype: draw(rng, shape, np.float32 if dtype.itemsize <= 4 else np.float64).astype(dtype, copy=False)
+RAND_FNS = {
+  "rand": _floats(lambda rng, shape, dt: rng.random(shape, dtype=dt)),
+  "randn": _floats(lambda rng, shape, dt: rng.standard_normal(shape, dtype=dt)),
+  "randint": lambda rng, shape, dtype: rng.integers(-8, 8, size=shape).astype(dtype),  # small so sums stay exact
+}
+
+def generate_inputs(seed:int, rand_fn:str, dtype:np.dtype, in_shapes:list, i:int) -> list[np.ndarray]:
+  """Inputs of test i of a seeded test file."""
+  rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(i,))))
+  return [RAND_FNS[rand_fn](rng, tuple(shape), np.dtype(dtype)) for shape in in_shapes]
+
+class InputsChanged(Exception):
+  """Regenerating the inputs of a seeded test file gave different ones, eg. after a numpy upgrade changed a generator."""
+
+def inputs_digest(args:list[np.ndarray]) -> str:
+  h = hashlib.sha256()
+  for a in args: h.update(np.ascontiguousarray(a).data)
+  return h.hexdigest()[:16]
+
+def new_seed() -> int: return int(np.random.SeedSequence().entropy) & ((1 << 63) - 1)
+
+def path(digest:str) -> str: return os.path.join(TESTS_DIR, f"{digest}.safetensors")
+
+def _publish(tmp:str, digest:str) -> str:
+  if os.path.exists(path(digest)): os.unlink(tmp)
+  else: os.replace(tmp, path(digest))
+  return digest
+
+def put(data:bytes) -> str:
+  """Store a serialized safetensors blob, returns its sha256."""
+  os.makedirs(TESTS_DIR, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=TESTS_DIR, prefix=".tmp-")
+  with os.fdopen(fd, "wb") as f: f.write(data)
+  return _publish(tmp, hashlib.sha256(data).hexdigest())
+
+def add(fn:str) -> str:
+  """Copy a safetensors file into the store, returns its sha256."""
+  os.makedirs(TESTS_DIR, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=TESTS_DIR, prefix=".tmp-")
+  h = hashlib.sha256()
+  with open(fn, "rb") as src, os.fdopen(fd, "wb") as dst:
+    while chunk := src.read(1 << 20):
+      h.update(chunk)
+      dst.write(chunk)
+  return _publish(tmp, h.hexdigest())
+
+def save(tensors:dict[str, np.ndarray], metadata:Optional[dict[str, str]]=None) -> str:
+  """Serialize tensors straight to the store without building the blob in memory, returns its sha256."""
+  os.makedirs(TESTS_DIR, exist_ok=True)
+  fd, tmp = tempfile.mkstemp(dir=TESTS_DIR, prefix=".tmp-")
+  os.close(fd)
+  safetensors.numpy.save_file(tensors, tmp, metadata=metadata)
+  h = hashlib.sha256()
+  with open(tmp, "rb") as f:
+    while chunk := f.read(1 << 20): h.update(chunk)
+  return _publish(tmp, h.hexdigest())
+
+def seeded_metadata(seed:int, rand_fn:str, dtype:np.dtype, in_shapes:list, digests:list[str]) -> dict[str, str]:
+  """Metadata of a test file storing only outputs, its inputs are regenerated with generate_inputs and checked
+  against digests, the inputs_digest of every test."""
+  return {"seed": str(seed), "rand_fn": rand_fn, "dtype": np.dtype(dtype).name, "in_shapes": json.dumps([list(s) for s in in_shapes]),
+          "numpy": np.__version__, "inputs": json.dumps(digests)}
+
+class _Mapped:
+  """Read-only mmap of a safetensors file, tensors are zero-copy numpy views created on access."""
+  def __init__(self, fn:str):
+    with open(fn, "rb") as f: self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    n = int.from_bytes(self.mm[:8], "little")
+    header = json.loads(self.mm[8:8+n])
+    self.metadata: dict[str, str] = header.pop("__metadata__", None) or {}
+    self.header, self.base = header, 8 + n
+
+  def __getitem__(self, key:str) -> np.ndarray:
+    info = self.header[key]
+    start, end = info["data_offsets"]
+    dtype = np.dtype(DTYPES[info["dtype"]])
+    return np.frombuffer(self.mm, dtype=dtype, count=(end-start)//dtype.itemsize, offset=self.base+start).reshape(info["shape"])
+
+class TestFile:
+  """A stored test file. Inputs of seeded files are regenerated on first use and kept in INPUTS_DIR."""
+  def __init__(self, digest:str):
+    self.digest, self.file = digest, _Mapped(path(digest))
+    self.header, self.metadata = self.file.header, self.file.metadata
+    self.num_tests = len(set(k.split('.')[0] for k in self.header))
+    if self.seeded:
+      self.in_shapes = json.loads(self.metadata["in_shapes"])
+      self.dtype = np.dtype(self.metadata["dtype"])
+      self.num_args = len(self.in_shapes)
+    else: self.num_args = max(int(k.split('.')[-1]) for k in self.header if 'in' in k) + 1
+    self._inputs: dict[int, _Mapped] = {}
+    self._layout_files: dict[tuple[int, tuple[str, ...]], _Mapped] = {}
+
+  @property
+  def seeded(self) -> bool: return "seed" in self.metadata
+
+  def __getitem__(self, key:str) -> np.ndarray:
+    if key in self.header: return self.file[key]
+    if self.seeded and ".in." in key: return self.inputs(int(key[4:key.index(".")]))[key]
+    raise KeyError(key)
+
+  def _cached(self, name:str, make:Callable[[], dict[str, np.ndarray]]) -> _Mapped:
+    """Map a file of derived tensors in INPUTS_DIR, creating it first if it was never made or was evicted."""
+    fn = os.path.join(INPUTS_DIR, f"{name}.safetensors")
+    if not os.path.exists(fn):
+      tensors = make()
+      os.makedirs(INPUTS_DIR, exist_ok=True)
+      fd, tmp = tempfile.mkstemp(dir=INPUTS_DIR, prefix=".tmp-")
+      os.close(fd)
+      safetensors.numpy.save_file(tensors, tmp)
+      os.replace(tmp, fn)
+      evict_inputs(keep=fn)
+    else: os.utime(fn)  # mtime is the LRU timestamp
+    return _Mapped(fn)
+
+  def inputs(self, i:int) -> _Mapped:
+    """The regenerated inputs of test i of a seeded file, one test at a time so they never all have to be in memory."""
+    if (m:=self._inputs.get(i)) is None: self._inputs[i] = m = self._cached(f"{self.digest}.{i}", lambda: self._regenerate(i))
+    return m
+
+  def _regenerate(self, i:int) -> dict[str, np.ndarray]:
+    args = generate_inputs(int(self.metadata["seed"]), self.metadata["rand_fn"], self.dtype, self.in_shapes, i)
+    if "inputs" in self.metadata:
+      if inputs_digest(args) != json.loads(self.metadata["inputs"])[i]:
+        raise InputsChanged(f"the regenerated inputs of test {i} differ from the ones the outputs were made from "
+                            f"(numpy {np.__version__}, the tests were made with {self.metadata.get('numpy')}), regenerate the challenge")
+    elif self.metadata.get("numpy") != np.__version__:  # older files have no digests, only the version is known to be safe
+      raise InputsChanged(f"the tests were made with numpy {self.metadata.get('numpy')} and can't be checked under {np.__version__}, "
+                          f"install that version or regenerate the challenge")
+    return {f"test{i}.in.{j}": a for j, a in enumerate(args)}
+
+  def layout(self, i:int, ls:tuple[str, ...]) -> Optional[_Mapped]:
+    """Inputs of test i in the given per-input layouts (see layouts.py), materialized once. None if all are row-major,
+    otherwise the file only holds the inputs that aren't."""
+    ls = self.full_layouts(ls)
+    if all(l == layouts.ROW for l in ls): return None
+    if (m:=self._layout_files.get((i, ls))) is None:
+      self._layout_files[(i, ls)] = m = self._cached(f"{self.digest}.{i}.{layouts.key(ls)}", lambda: {
+        f"test{i}.in.{j}": layouts.apply(self[f"test{i}.in.{j}"], l) for j, l in enumerate(ls) if l != layouts.ROW})
+    return m
+
+  def full_layouts(self, ls:tuple[str, ...]) -> tuple[str, ...]:
+    """Normalized layout of every input, those not given are row-major."""
+    if len(ls) > self.num_args: raise ValueError(f"{len(ls)} layouts given for {self.num_args} inputs")
+    return tuple(layouts.normalize(l) for l in ls) + (layouts.ROW,) * (self.num_args - len(ls))
+
+  def test_nbytes(self, i:int, ls:tuple[str, ...]=()) -> int:
+    """Size of test i's inputs in the given layouts, from the header alone so nothing is regenerated or mapped."""
+    if self.seeded: specs = [(s, self.dtype) for s in self.in_shapes]
+    else: specs = [(self.header[k]["shape"], np.dtype(DTYPES[self.header[k]["dtype"]])) for k in (f"test{i}.in.{j}" for j in range(self.num_args))]
+    return sum(int(np.prod(layouts.shape(s, l))) * dt.itemsize for (s, dt), l in zip(specs, self.full_layouts(ls)))
+
+  def input_nbytes(self, ls:tuple[str, ...]=()) -> int: return sum(self.test_nbytes(i, ls) for i in range(self.num_tests))
+
+  def test(self, i:int, ls:tuple[str, ...]=()) -> tuple[list[np.ndarray], np.ndarray]:
+    """(inputs, expected output) of test i, with the inputs in the given layouts."""
+    m, keys = self.layout(i, ls), [f"test{i}.in.{j}" for j in range(self.num_args)]
+    return [m[k] if m is not None and k in m.header else self[k] for k in keys], self[f"test{i}.out"]
+
+  def __iter__(self) -> Iterator[tuple[list[np.ndarray], np.ndarray]]:
+    for i in range(self.num_tests): yield self.test(i)
+
+def evict_inputs(max_bytes:Optional[int]=None, keep:Optional[str]=None):
+  """Delete the least recently used regenerated inputs until INPUTS_DIR fits in max_bytes."""
+  evict_lru(INPUTS_DIR, ".safetensors", MAX_INPUT_BYTES if max_bytes is None else max_bytes, keep)
+
+def sweep(referenced:set[str], grace:float=SWEEP_GRACE) -> int:
+  """Delete test files no challenge refers to anymore, and the inputs derived from them, returns how many test files went."""
+  removed, now = 0, time.time()
+  for d in (TESTS_DIR, INPUTS_DIR):
+    if not os.path.isdir(d): continue
+    for e in os.scandir(d):
+      if not e.is_file() or e.name.split(".")[0] in referenced: continue  # leftover .tmp- files never are
+      try:
+        if now - e.stat().st_mtime < grace: continue
+        os.unlink(e.path)
+      except FileNotFoundError: continue
+      removed += d == TESTS_DIR and e.name.endswith(".safetensors")
+  return removed
@@ -0,0 +1,62 @@
+import os, threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+import numpy as np
+
+VRAM_BUDGET = int(os.getenv("KERNELBOT_VRAM_BUDGET", str(4 << 30)))  # bytes of device memory that cached test inputs may occupy, per device
+
+# challenge ids are never reused (AUTOINCREMENT), so deleted ones only need to be remembered to free their buffers
+_invalidated: set[int] = set()
+_lock = threading.Lock()
+
+def invalidate(chal_id:int):
+  """Mark a deleted or replaced challenge stale, safe to call from the event loop while runners are busy."""
+  with _lock: _invalidated.add(chal_id)
+
+@dataclass
+class Resident:
+  inputs: list[list[tuple[Any, int]]]  # per test: (device buffer, nbytes) of every input
+  outputs: list[np.ndarray]            # expected outputs stay on the host
+  nbytes: int
+
+class TestCache:
+  """Keeps each challenge's test inputs on the device across submissions, evicting least recently used ones.
+  Keys are (challenge id, ...) tuples; only the runner that owns the allocator may call get/put."""
+  def __init__(self, alloc, upload:Callable[[Any, np.ndarray], None], budget:int=VRAM_BUDGET):
+    self.alloc, self.upload, self.budget = alloc, upload, budget
+    self.entries: OrderedDict[Hashable, Resident] = OrderedDict()
+    self.nbytes, self.hits, self.misses = 0, 0, 0
+
+  def _drop(self, key:Hashable):
+    ent = self.entries.pop(key)
+    self.nbytes -= ent.nbytes
+    for bufs in ent.inputs:
+      for buf, sz in bufs: self.alloc.free(buf, sz)
+
+  def _purge(self):
+    with _lock: stale = set(_invalidated)
+    for key in [k for k in self.entries if k[0] in stale]: self._drop(key)
+
+  def get(self, key:tuple) -> Optional[Resident]:
+    self._purge()
+    if (ent:=self.entries.get(key)) is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return ent
+
+  def put(self, key:tuple, tests:Iterable[tuple[list[np.ndarray], np.ndarray]], nbytes:int) -> Optional[Resident]:
+    """Upload a challenge's inputs one test at a time, returns None if they don't fit in the budget at all."""
+    if nbytes > self.budget or key[0] in _invalidated: return None
+    while self.nbytes + nbytes > self.budget: self._drop(next(iter(self.entries)))
+    bufs, outputs = [], []
+    for args, out in tests:
+      bufs.append([(self.alloc.alloc(a.nbytes), a.nbytes) for a in args])
+      for a, (buf, _) in zip(args, bufs[-1]): self.upload(buf, a)
+      outputs.append(out)
+    self.entries[key] = ent = Resident(bufs, outputs, nbytes)
+    self.nbytes += nbytes
+    return ent
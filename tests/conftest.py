@@ -0,0 +1,24 @@
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+  """An empty working directory, the test store and the kernel cache are relative to it."""
+  monkeypatch.chdir(tmp_path)
+  return tmp_path
+
+@pytest.fixture
+def dev():
+  from devices import DevicePool
+  return DevicePool.mock().backends[0]
+
+ADD = "def add(a, b, out): out.view(np.float32)[:] = a.view(np.float32) + b.view(np.float32)\n"
+
+@pytest.fixture
+def add_tests(workdir, dev):
+  """Digest of a small seeded challenge adding two float32 matrices."""
+  import run
+  digest, _ = run.make_tests(dev, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), [(32, 32), (32, 32)], (32, 32), "float32", "randn", 2)
+  return digest
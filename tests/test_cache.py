@@ -0,0 +1,41 @@
+import asyncio
+
+from cache import Cache
+
+def test_hits_expiry_and_eviction():
+  async def main():
+    cache, calls = Cache("t", max_entries=2, ttl=0.2), []
+    async def compute(v): calls.append(v); return v
+    assert await cache.get("a", lambda: compute(1)) == 1
+    assert await cache.get("a", lambda: compute(2)) == 1
+    await cache.get("b", lambda: compute(3))
+    await cache.get("c", lambda: compute(4))  # evicts a, the least recently used
+    assert list(cache.entries) == ["b", "c"] and cache.stats["evictions"] == 1
+    await asyncio.sleep(0.25)
+    assert await cache.get("b", lambda: compute(5)) == 5 and cache.stats["expirations"] == 1
+    assert calls == [1, 3, 4, 5] and cache.stats["hits"] == 1
+  asyncio.run(main())
+
+def test_invalidate_while_computing():
+  async def main():
+    cache, release = Cache("t", max_entries=8, ttl=60), asyncio.Event()
+    async def slow(): await release.wait(); return "stale"
+    async def fast(): return "fresh"
+    first, second = asyncio.ensure_future(cache.get("k", slow)), asyncio.ensure_future(cache.get("k", slow))
+    await asyncio.sleep(0)
+    assert len(cache.pending) == 1  # concurrent misses share one computation
+    cache.invalidate("k")
+    release.set()
+    assert await first == await second == "stale"
+    assert "k" not in cache.entries  # the result of a computation that started before the write isn't kept
+    assert await cache.get("k", fast) == "fresh"
+  asyncio.run(main())
+
+def test_challenge_updated(workdir):
+  import utils  # importing the database creates kernelbot.db in the working directory
+  async def main():
+    async def board(key): return key
+    for key in [(1, False, None), (1, True, None), (1, False, "fp"), (2, False, None)]: await utils.leaderboards.get(key, lambda: board(key))
+    utils.challenge_updated(1)  # every variant of the challenge's leaderboard goes, other challenges' stay
+    assert list(utils.leaderboards.entries) == [(2, False, None)]
+  asyncio.run(main())
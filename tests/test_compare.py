@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import compare, run
+from compare import Tolerance
+from conftest import ADD
+
+def test_rtol():
+  expected = np.array([1.0, 100.0, 0.0], dtype=np.float32)
+  assert compare.compare(expected * np.float32(1 + 5e-4), expected, Tolerance(rtol=1e-3)).ok
+  res = compare.compare(np.array([1.0, 100.2, 0.0], dtype=np.float32), expected, Tolerance(rtol=1e-3))
+  assert (res.bad, res.first) == (1, 1)
+  assert not compare.compare(np.array([1.0, 100.0, 1e-6], dtype=np.float32), expected, Tolerance(rtol=1e-3)).ok
+  assert compare.compare(np.array([1.0, 100.0, 1e-6], dtype=np.float32), expected, Tolerance(rtol=1e-3, atol=1e-5)).ok
+
+def test_ulps():
+  expected = np.array([1.0, -2.0, 3e-30], dtype=np.float32)
+  near = np.nextafter(np.nextafter(expected, np.inf), np.inf)
+  res = compare.compare(near, expected, Tolerance(ulps=2))
+  assert res.ok and res.max_ulps == 2
+  assert not compare.compare(np.nextafter(near, np.inf), expected, Tolerance(ulps=2)).ok
+  # across zero, and within atol for values near zero
+  assert compare.ulp_distance(np.array([-0.0], np.float32), np.array([0.0], np.float32))[0] == 1
+  assert compare.compare(np.array([1.0, -2.0, 0.0], dtype=np.float32), expected, Tolerance(ulps=2, atol=1e-20)).ok
+
+def test_custom_tolerance():
+  f32 = np.dtype(np.float32)
+  assert compare.custom_tolerance(f32) is None
+  assert compare.custom_tolerance(f32, rtol=1e-2) == Tolerance(rtol=1e-2, atol=1e-3)
+  # a ulps bound doesn't inherit the preset's atol and rtol
+  assert compare.custom_tolerance(f32, ulps=4) == Tolerance(ulps=4)
+  assert compare.custom_tolerance(f32, atol=1e-6, ulps=4) == Tolerance(atol=1e-6, ulps=4)
+  assert not compare.compare(np.array([1.0001], np.float32), np.array([1.0], np.float32), compare.custom_tolerance(f32, ulps=4)).ok
+
+@pytest.mark.parametrize("tol", [Tolerance(rtol=1e-3, atol=1e-3), Tolerance(ulps=4), Tolerance(ulps=4, atol=1e-3)])
+def test_nan(tol):
+  expected = np.array([1.0, np.nan, np.inf], dtype=np.float32)
+  assert compare.compare(expected.copy(), expected, tol).ok  # nan where expected is nan matches
+  res = compare.compare(np.array([np.nan, np.nan, np.inf], dtype=np.float32), expected, tol)
+  assert (res.bad, res.first) == (1, 0)
+  assert not compare.compare(np.array([1.0, 2.0, np.inf], dtype=np.float32), expected, tol).ok
+
+@pytest.mark.parametrize("tol", [Tolerance(rtol=1e-3, atol=1e-3), Tolerance(ulps=4)])
+def test_poisoned_output(tol):
+  # the output lease is filled with 0xff bytes, a nan for every float dtype, before each launch
+  expected = np.arange(8, dtype=np.float16)
+  assert compare.compare(np.frombuffer(b"\xff" * expected.nbytes, dtype=np.float16), expected, tol).bad == 8
+
+def test_chunks_and_threads():
+  rng = np.random.default_rng(0)
+  expected = rng.standard_normal(10_000).astype(np.float32)
+  out = expected.copy()
+  out[[17, 5000, 9999]] += 1
+  res = compare.compare(out, expected, threads=4, chunk=1000)
+  assert (res.bad, res.first, res.size) == (3, 17, 10_000)
+
+@pytest.mark.parametrize("tolerance", [None, {"ulps": 4}, {"rtol": 0.0, "atol": 0.0, "ulps": 4}])
+def test_noop_kernel_rejected(dev, add_tests, tolerance):
+  with pytest.raises(run.WrongAnswer):
+    run.judge(dev, "def add(a, b, out): pass\n", "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, tolerance=tolerance)
+  tm, _ = run.judge(dev, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, tolerance=tolerance)
+  assert tm > 0
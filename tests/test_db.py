@@ -0,0 +1,74 @@
+import hashlib, os, random, sqlite3
+
+def connect(fn:str) -> sqlite3.Connection:
+  import db  # importing the database creates kernelbot.db in the working directory
+  conn = sqlite3.connect(fn, isolation_level=None)
+  conn.execute("PRAGMA foreign_keys = ON;")
+  db.migrate(conn)
+  return conn
+
+# the schema before migrations existed, which init_db stamped as version 1
+V1_SCHEMA = [
+  "CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE, perms INTEGER NOT NULL DEFAULT 0);",
+  """CREATE TABLE challenges (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE, desc TEXT, creator_id INTEGER NOT NULL REFERENCES users(discord),
+     tests BLOB NOT NULL, flops INTEGER, timing REAL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""",
+  """CREATE TABLE submissions (id INTEGER PRIMARY KEY, name TEXT NOT NULL, type TEXT NOT NULL, source TEXT NOT NULL,
+     comp_id INTEGER NOT NULL REFERENCES challenges(id), user_id INTEGER NOT NULL REFERENCES users(discord), timing REAL NOT NULL,
+     transpose_a BOOLEAN DEFAULT 0, transpose_b BOOLEAN DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""",
+  "PRAGMA user_version = 1;",
+]
+
+def test_best_submissions_triggers(workdir):
+  conn, rng = connect("t.db"), random.Random(0)
+  conn.executemany("INSERT INTO challenges (name, creator_id, tests) VALUES (?, 1, 'x');", [("a",), ("b",)])
+  for step in range(2000):
+    ids = [i for i, in conn.execute("SELECT id FROM submissions;")]
+    op = rng.random()
+    if op < 0.6 or not ids:
+      conn.execute("INSERT INTO submissions (name, type, source, comp_id, user_id, timing) VALUES ('k', 'CUDA', '', ?, ?, ?);",
+                   (rng.randint(1, 2), rng.randrange(20), rng.randrange(50) / 10))  # plenty of ties
+    elif op < 0.8: conn.execute("DELETE FROM submissions WHERE id = ?;", (rng.choice(ids),))
+    elif op < 0.9: conn.execute("UPDATE submissions SET timing = ? WHERE id = ?;", (rng.randrange(50) / 10, rng.choice(ids)))
+    else: conn.execute("UPDATE submissions SET user_id = ?, comp_id = ? WHERE id = ?;", (rng.randrange(20), rng.randint(1, 2), rng.choice(ids)))
+    if step % 50: continue
+    want = conn.execute("""SELECT comp_id, user_id, id, timing FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY comp_id, user_id ORDER BY timing, id) AS rn
+                           FROM submissions) WHERE rn = 1 ORDER BY comp_id, user_id;""").fetchall()
+    assert conn.execute("SELECT comp_id, user_id, submission_id, timing FROM best_submissions ORDER BY comp_id, user_id;").fetchall() == want
+  # deleting a challenge cascades to its submissions and their best entries
+  conn.execute("DELETE FROM challenges WHERE id = 1;")
+  assert conn.execute("SELECT count(*) FROM best_submissions WHERE comp_id = 1;").fetchone()[0] == 0
+
+def test_migrate_from_v1(workdir):
+  import db, store
+  conn = sqlite3.connect("old.db", isolation_level=None)
+  for stmt in V1_SCHEMA: conn.execute(stmt)
+  conn.execute("INSERT INTO challenges (name, creator_id, tests) VALUES ('matmul', 1, ?);", (b"safetensors",))
+  conn.executemany("INSERT INTO submissions (name, type, source, comp_id, user_id, timing, transpose_b) VALUES ('k', 'CUDA', '', ?, 7, ?, ?);",
+                   [(1, 2.0, 0), (1, 1.0, 1), (2, 1.0, 0)])  # the last one's challenge was deleted
+  files = lambda: sorted(os.path.relpath(os.path.join(d, f)) for d, _, fs in os.walk(".") for f in fs)
+  before = files()
+
+  # a dry run goes through every step and leaves the database and the store as they were
+  assert [m.version for m, _ in db.migrate(conn, dry_run=True)] == list(range(2, db.SCHEMA_VERSION + 1))
+  assert conn.execute("PRAGMA user_version;").fetchone()[0] == 1 and files() == before
+  assert conn.execute("SELECT typeof(tests) FROM challenges;").fetchone()[0] == "blob"
+
+  db.migrate(conn)
+  assert conn.execute("PRAGMA user_version;").fetchone()[0] == db.SCHEMA_VERSION and not db.pending(conn)
+  digest = hashlib.sha256(b"safetensors").hexdigest()
+  assert conn.execute("SELECT tests, layouts FROM challenges;").fetchone() == (digest, '["row", "col"]')
+  with open(store.path(digest), "rb") as f: assert f.read() == b"safetensors"
+  assert conn.execute("SELECT id, layouts FROM submissions ORDER BY id;").fetchall() == [(1, None), (2, '["row","col"]')]
+  assert conn.execute("SELECT comp_id, user_id, submission_id FROM best_submissions;").fetchall() == [(1, 7, 2)]
+  assert not conn.execute("PRAGMA foreign_key_check;").fetchall()
+
+def test_move_test_store(workdir):
+  import db, store
+  conn = connect("t.db")
+  conn.execute("PRAGMA user_version = 11;")
+  os.makedirs(store.OLD_TESTS_DIR)
+  open(os.path.join(store.OLD_TESTS_DIR, "x.safetensors"), "w").close()
+  db.migrate(conn, dry_run=True)
+  assert os.path.isdir(store.OLD_TESTS_DIR) and not os.path.exists(store.TESTS_DIR)
+  db.migrate(conn)
+  assert os.listdir(store.TESTS_DIR) == ["x.safetensors"] and not os.path.exists(store.OLD_TESTS_DIR)
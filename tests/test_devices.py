@@ -0,0 +1,14 @@
+import ctypes
+import numpy as np
+
+import store
+from devices import host_address
+
+def test_host_address_read_only(workdir):
+  # test inputs are read-only views of memory mapped files, the cuda upload copies out of them by address
+  data = np.arange(1000, dtype=np.float32)
+  a = store._Mapped(store.path(store.save({"a": data})))["a"]
+  assert not a.flags.writeable
+  buf = (ctypes.c_char * a.nbytes)()
+  ctypes.memmove(buf, host_address(a) + 400, a.nbytes - 400)
+  assert np.array_equal(np.frombuffer(buf, np.float32)[:900], data[100:])
@@ -0,0 +1,31 @@
+import random, sqlite3
+
+def dump(path:str) -> tuple:
+  conn = sqlite3.connect(path)
+  try: return (conn.execute("SELECT * FROM challenges ORDER BY id;").fetchall(),
+               conn.execute("SELECT * FROM best_submissions ORDER BY challenge_id, user_id;").fetchall())
+  finally: conn.close()
+
+def test_incremental_matches_full(workdir, monkeypatch):
+  import db, db_export  # importing the database creates kernelbot.db in the working directory
+  full_exports, full_export = [], db_export.full_export
+  monkeypatch.setattr(db_export, "full_export", lambda conn, path: full_exports.append(path) or full_export(conn, path))
+  main, rng = sqlite3.connect("main.db", isolation_level=None), random.Random(0)
+  db.migrate(main)
+  main.executemany("INSERT INTO users (id, username) VALUES (?, ?);", [(u, f"user{u}") for u in range(5)])
+  for round in range(20):
+    for _ in range(rng.randrange(1, 8)):
+      ids = [i for i, in main.execute("SELECT id FROM submissions;")]
+      chals = [i for i, in main.execute("SELECT id FROM challenges;")]
+      op = rng.random()
+      if op < 0.1 or not chals: main.execute("INSERT INTO challenges (name, creator_id, tests) VALUES (?, 1, 'x');", (f"c{round}.{op}",))
+      elif op < 0.15: main.execute("DELETE FROM challenges WHERE id = ?;", (rng.choice(chals),))
+      elif op < 0.2: main.execute("UPDATE users SET username = ? WHERE id = ?;", (f"renamed{round}.{op}", rng.randrange(5)))
+      elif op < 0.3 and ids: main.execute("DELETE FROM submissions WHERE id = ?;", (rng.choice(ids),))
+      else: main.execute("INSERT INTO submissions (name, type, source, comp_id, user_id, timing) VALUES ('k', 'CUDA', '', ?, ?, ?);",
+                         (rng.choice(chals), rng.randrange(8), rng.randrange(1, 20) / 10))  # users 5-7 aren't registered
+    assert db_export.export_leaderboard_data("main.db", "incremental.db")
+    assert db_export.export_leaderboard_data("main.db", "full.db", full=True)
+    assert dump("incremental.db") == dump("full.db")
+  # only the first export of incremental.db was a full one, the others applied the changelog
+  assert full_exports.count(db_export.work_path("incremental.db")) == 1
@@ -0,0 +1,13 @@
+import os
+
+from helpers import evict_lru
+
+def test_evict_lru(workdir):
+  for i, name in enumerate(["a.bin", "b.bin", "c.bin", "d.txt"]):
+    with open(name, "wb") as f: f.write(b"x" * 100)
+    os.utime(name, (i, i))
+  os.utime("a.bin")  # just used
+  # b is the least recently used, c can't go, d isn't managed
+  assert evict_lru(".", ".bin", 250, keep=os.path.join(".", "c.bin")) == 1
+  assert sorted(os.listdir(".")) == ["a.bin", "c.bin", "d.txt"]
+  assert evict_lru(".", ".bin", 0) == 2 and os.listdir(".") == ["d.txt"]
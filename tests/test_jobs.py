@@ -0,0 +1,17 @@
+import asyncio, time
+
+from jobs import JobQueue, LocalSlot
+
+def test_wait_survives_failing_updates(dev):
+  async def main():
+    jobs = JobQueue([LocalSlot(dev)])
+    jobs.start()
+    calls = []
+    async def on_update(job):
+      calls.append(job)
+      raise RuntimeError("interaction token expired")
+    job = jobs.submit(lambda dev: time.sleep(0.3) or 42, user_id=1)
+    try: assert await jobs.wait(job, on_update, interval=0.05) == 42
+    finally: await jobs.shutdown()
+    assert len(calls) == 1  # updates stop after the first failure, the wait doesn't
+  asyncio.run(main())
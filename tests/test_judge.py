@@ -0,0 +1,41 @@
+import pytest
+
+import run
+from conftest import ADD
+
+# correct on the first launch with each input only, as if gated by a __device__ counter, then returns right away
+FIRST_ONLY = """
+seen = set()
+def add(a, b, out):
+  if (key:=a[:64].tobytes()) in seen: return
+  seen.add(key)
+  out.view(np.float32)[:] = a.view(np.float32) + b.view(np.float32)
+"""
+
+def test_judge(dev, add_tests):
+  tm, stats = run.judge(dev, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests)
+  assert tm > 0 and len(stats["tests"]) == 2 and stats["fingerprint"] == run.fingerprint(dev)
+  assert {"upload", "launch", "download", "verify", "benchmark"} <= stats["stages"].keys()
+
+def test_first_launch_only(dev, add_tests):
+  with pytest.raises(run.WrongAnswer):
+    run.judge(dev, FIRST_ONLY, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests)
+
+def test_compile_error(dev, add_tests):
+  with pytest.raises(run.CompileError):
+    run.judge(dev, "def add(a, b, out) pass\n", "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests)
+
+def test_cache_after_smallest(dev, add_tests):
+  # a wrong submission is rejected before the challenge's inputs are uploaded to stay on the device
+  with pytest.raises(run.WrongAnswer): run.judge(dev, "def add(a, b, out): pass\n", "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, chal_id=1)
+  assert not dev.tcache.entries
+  run.judge(dev, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, chal_id=1)
+  assert dev.tcache.hits == 0 and len(dev.tcache.entries) == 1
+  tm, stats = run.judge(dev, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, chal_id=1)
+  assert dev.tcache.hits == 1 and "device_copy" in stats["stages"]
+
+def test_nbytes_from_header(add_tests):
+  import store
+  f = store.TestFile(add_tests)
+  for ls in [(), ("col",), ("pad48", "col+pad48")]:
+    assert f.input_nbytes(ls) == sum(a.nbytes for i in range(f.num_tests) for a in f.test(i, ls)[0])
@@ -0,0 +1,26 @@
+import random
+
+def test_board_matches_sorted_list(workdir):
+  from ranking import Board, Entry  # importing the database creates kernelbot.db in the working directory
+  rng, board, subs = random.Random(0), Board(), []
+  for sub_id in range(3000):
+    user = rng.randrange(200)
+    if rng.random() < 0.05:
+      board.remove(user)
+      subs = [s for s in subs if s.user_id != user]
+      continue
+    e = Entry(user, sub_id, rng.choice([rng.random(), round(rng.random(), 2)]), f"k{sub_id}", "CUDA")  # plenty of ties
+    best = min((s for s in subs if s.user_id == user), key=lambda s: s.key, default=None)
+    assert board.submit(e) == (best is None or e.key < best.key)
+    subs.append(e)
+    if sub_id % 100: continue
+    bests = {}
+    for s in subs:
+      if s.user_id not in bests or s.key < bests[s.user_id].key: bests[s.user_id] = s
+    want = sorted(bests.values(), key=lambda s: s.key)
+    assert list(board) == want and len(board) == len(want) and board.top(10) == want[:10]
+    for i, s in enumerate(want):
+      assert board.index(s.user_id) == i and board.kth(i) == s
+      assert board.rank(s.user_id) == 1 + sum(o.timing < s.timing for o in want)
+      assert board.neighbors(s.user_id, 2) == (want[max(i - 2, 0):i], want[i + 1:i + 3])
+  assert board.rank(-1) == 0 and board.index(-1) == -1
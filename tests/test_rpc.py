@@ -0,0 +1,28 @@
+import asyncio
+
+from jobs import LocalSlot
+from rpc import RemoteRunner
+from runner import RunnerServer
+
+def test_token(dev):
+  async def main():
+    runner = RunnerServer([LocalSlot(dev)], dev.model, token="secret")
+    server = await asyncio.start_server(runner.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    good, bad = RemoteRunner("127.0.0.1", port, token="secret"), RemoteRunner("127.0.0.1", port, token="guess")
+    good.start()
+    bad.start()
+    try:
+      async with good._changed: await asyncio.wait_for(good._changed.wait_for(lambda: good.capacity), 5)
+      assert good.model == dev.model
+      # a wrong token is refused before any call is read
+      reader, writer = await asyncio.open_connection("127.0.0.1", port)
+      writer.write(b'{"id": 0, "op": "ping", "args": [], "size": 0}\n')
+      assert b'"kind": "auth"' in await reader.readline() and await reader.read() == b""
+      await asyncio.sleep(0.2)
+      assert bad.capacity == 0
+    finally:
+      await good.close()
+      await bad.close()
+      server.close()
+  asyncio.run(main())
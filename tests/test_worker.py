@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+import run, worker
+from conftest import ADD
+from jobs import JobQueue
+
+HANG = "def add(a, b, out):\n  while True: pass\n"
+HOG = "def add(a, b, out):\n  hog = [np.ones(1 << 24) for _ in range(8)]\n  import time; time.sleep(10)\n"  # 1GB of float64
+CRASH = "def add(a, b, out): __import__('os')._exit(3)\n"
+
+def test_failures_respawn(add_tests):
+  async def main():
+    slot = worker.ProcessSlot("mock", 0, job_timeout=30, kernel_timeout=2, max_rss=512 << 20)
+    jobs = JobQueue([slot])
+    jobs.start()
+    judge = lambda src: jobs.submit(run.judge, src, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, user_id=1).future
+    try:
+      assert (await judge(ADD))[0] > 0
+      with pytest.raises(worker.KernelTimeout): await judge(HANG)
+      with pytest.raises(worker.WorkerDied, match="host memory"): await judge(HOG)
+      with pytest.raises(worker.WorkerDied, match="crashed"): await judge(CRASH)
+      assert (await judge(ADD))[0] > 0  # on a fresh worker
+      assert slot.restarts == 3
+    finally: await jobs.shutdown()
+  asyncio.run(main())
+
+def test_job_timeout(add_tests):
+  async def main():
+    slot = worker.ProcessSlot("mock", 0, job_timeout=2, kernel_timeout=60)
+    jobs = JobQueue([slot])
+    jobs.start()
+    try:
+      with pytest.raises(worker.JobTimeout): await jobs.submit(run.judge, HANG, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, user_id=1).future
+      assert (await jobs.submit(run.judge, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, user_id=1).future)[0] > 0
+    finally: await jobs.shutdown()
+  asyncio.run(main())
+
+def test_died_idle(add_tests):
+  async def main():
+    slot = worker.ProcessSlot("mock", 0, job_timeout=30, kernel_timeout=2)
+    jobs = JobQueue([slot])
+    jobs.start()
+    judge = lambda: jobs.submit(run.judge, ADD, "CUDA", "add", (1, 1, 1), (1, 1, 1), add_tests, user_id=1).future
+    try:
+      assert (await judge())[0] > 0
+      slot.proc.kill()
+      await asyncio.to_thread(slot.proc.join)
+      with pytest.raises(worker.WorkerDied, match="idle"): await judge()
+      assert (await judge())[0] > 0
+      assert slot.restarts == 1
+    finally: await jobs.shutdown()
+  asyncio.run(main())
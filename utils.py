@@ -1,11 +1,14 @@
 from ast import literal_eval
-import discord, logging, functools, operator, inspect
+import discord, functools, inspect
 from discord.app_commands import Choice
-from typing import Iterable, TypeVar, Union, get_args, get_origin, get_type_hints
+from typing import Optional, get_args, get_origin, get_type_hints
 import datetime
 import os
 from db import db, Perm
-import functools
+from ranking import Board, rankings
+from cache import Cache
+from helpers import all_same, fmt_time, formatter, logger, prod  # re-exported for the cogs
+from run import ktypes
 
 def check_user(*perms:Perm):
     def dec(func):
@@ -39,16 +42,13 @@ def check_user(*perms:Perm):
         return wrapper
     return dec
 
-def init_logger():
-  formatter = logging.Formatter("[%(asctime)s] %(levelname)s %(message)s", datefmt="%b %d %H:%M:%S")
-  handler = logging.StreamHandler()
-  handler.setFormatter(formatter)
-  logger = logging.getLogger(__name__)
-  logger.setLevel(logging.INFO)
-  logger.addHandler(handler)
-  return logger, formatter
-
-logger, formatter = init_logger()
+async def try_edit(interaction:discord.Interaction, content:Optional[str]=None, delete:bool=False):
+  """Edit (or delete) the response after a long job, when the interaction token (valid for 15 minutes) may have
+  expired or discord may be failing, which must not keep the caller from recording the result."""
+  try:
+    if delete: await interaction.delete_original_response()
+    else: await interaction.edit_original_response(content=content)
+  except discord.HTTPException as e: logger.warning(f"Could not update the response to /{interaction.command.name if interaction.command else '?'}: {e}")
 
 def convert_literals(func):
   hints = get_type_hints(func)
@@ -84,23 +84,52 @@ def convert_literals(func):
   wrapper.__signature__ = sig.replace(parameters=new_params)
   return wrapper
 
-@functools.cache
-def active_chals() -> list[str]: return [t[0] for t in db.execute("SELECT name FROM challenges;").fetchall()]
+MAX_LEADERBOARDS = 256   # rendered leaderboards kept in memory
+LEADERBOARD_TTL = 300.0  # seconds, writes through the bot invalidate them right away
+CHALLENGES_TTL = 60.0
+
+leaderboards = Cache("leaderboards", MAX_LEADERBOARDS, LEADERBOARD_TTL)  # (challenge id, with_medals, fingerprint) -> message
+challenges = Cache("challenges", 1, CHALLENGES_TTL)                      # None -> {name: id}
+
+# write events, called by the cogs once their write committed
+def challenge_updated(comp_id:int):
+  """Submissions of a challenge were added, removed or rescored."""
+  for key in [k for k in (*leaderboards.entries, *leaderboards.pending) if k[0] == comp_id]: leaderboards.invalidate(key)
+def challenges_updated():
+  """A challenge was created or deleted."""
+  challenges.invalidate(None)
+
+async def challenge_ids() -> dict[str, int]:
+  return await challenges.get(None, lambda: db.read(lambda c: dict(c.execute("SELECT name, id FROM challenges;").fetchall())))
+
+async def active_chals() -> list[str]: return list(await challenge_ids())
+
+async def ktype_ac(_, curr): return [Choice(name=kt, value=kt) for kt in ktypes if curr.lower() in kt.lower()]
 
-async def challenge_ac(_, curr): return [Choice(name=chal, value=chal) for chal in active_chals() if curr.lower() in chal.lower()]
+async def challenge_ac(_, curr): return [Choice(name=chal, value=chal) for chal in await active_chals() if curr.lower() in chal.lower()]
 
-def format_submission_result(challenge_name: str, user_id: str, kernel_name: str, kernel_type: str, timing: float) -> str:
-  # Get the user's submissions for the challenge
-  best_time = db.execute("""
-    SELECT MIN(s.timing)
-    FROM submissions s
-    JOIN challenges c ON s.comp_id = c.id
-    WHERE c.name = ? AND s.user_id = ?
-  """, (challenge_name, user_id)).fetchone()[0]
+# one row per fingerprint timings were measured with, labelled with the device and toolchain it stands for
+FINGERPRINTS_QUERY = """
+  SELECT fingerprint, json_extract(stats, '$.method.device'), json_extract(stats, '$.method.toolchain'), count(*) FROM (
+    SELECT fingerprint, stats FROM submissions WHERE fingerprint IS NOT NULL
+    UNION ALL SELECT fingerprint, stats FROM rescores WHERE timing IS NOT NULL
+  ) GROUP BY fingerprint ORDER BY count(*) DESC
+"""
+async def fingerprint_ac(_, curr):
+  rows = await db.fetchall(FINGERPRINTS_QUERY)
+  return [Choice(name=f"{fp} ({dev}, {tc}, {n} timings)"[:100], value=fp) for fp, dev, tc, n in rows
+          if curr.lower() in f"{fp} {dev} {tc}".lower()][:25]
+
+def format_submission_result(board: Board, challenge_name: str, user_id: int, kernel_name: str, kernel_type: str, timing: float,
+                             stats: Optional[dict] = None) -> str:
+  best_time = board.best[user_id].timing
   
   message = f"# Submission for: `{challenge_name}`\n"
   message += f"Kernel: `{kernel_name} ({kernel_type})`\n"
   message += f"Time: {fmt_time(timing)}\n"
+  if stats:
+    for i, st in enumerate(stats["tests"]):
+      message += f"-# test {i}: median {fmt_time(st['median'])} of {st['n']} runs, 95% CI {fmt_time(st['ci_low'])} - {fmt_time(st['ci_high'])}\n"
   
   if timing <= best_time:
     message += "**This is your new personal best!** 🎉"
@@ -109,25 +138,6 @@ def format_submission_result(challenge_name: str, user_id: str, kernel_name: str
   
   return message
 
-def get_submission_position(challenge: str, user_id: int) -> int:
-    """Get position of the user in the leaderboard for this challenge"""
-    leaderboard = db.execute("""
-        WITH RankedSubmissions AS (
-            SELECT 
-                user_id, 
-                MIN(timing) as best_time,
-                ROW_NUMBER() OVER (ORDER BY MIN(timing) ASC) as position
-            FROM submissions
-            WHERE comp_id = (SELECT id FROM challenges WHERE name = ?)
-            GROUP BY user_id
-        )
-        SELECT position 
-        FROM RankedSubmissions
-        WHERE user_id = ?
-    """, (challenge, user_id)).fetchone()
-    
-    return leaderboard[0] if leaderboard else 0
-
 def get_ordinal(n: int) -> str:
     """Return number with ordinal suffix (1st, 2nd, 3rd, etc)"""
     if 11 <= (n % 100) <= 13:
@@ -136,33 +146,21 @@ def get_ordinal(n: int) -> str:
         suffix = ['th', 'st', 'nd', 'rd', 'th', 'th', 'th', 'th', 'th', 'th'][n % 10]
     return f"{n}{suffix}"
 
-@functools.cache
-def make_leaderboard(chal:str, with_medals:bool=True) -> str:
+async def make_leaderboard(chal:str, with_medals:bool=True, fingerprint:Optional[str]=None) -> str:
+  """Leaderboard of a challenge, only counting timings measured with fingerprint if given (see run.fingerprint)."""
+  if (comp_id:=(await challenge_ids()).get(chal)) is None: return f"# Challenge: `{chal}`\nNo submissions yet."
+  return await leaderboards.get((comp_id, with_medals, fingerprint), lambda: render_leaderboard(chal, comp_id, with_medals, fingerprint))
+
+async def render_leaderboard(chal:str, comp_id:int, with_medals:bool=True, fingerprint:Optional[str]=None) -> str:
   # Get best submission per user
-  resp = db.execute("""
-    WITH RankedSubmissions AS (
-      SELECT 
-        s.user_id, 
-        s.name, 
-        s.type, 
-        s.timing,
-        ROW_NUMBER() OVER (PARTITION BY s.user_id ORDER BY s.timing ASC) as rn
-      FROM submissions s
-      JOIN challenges c ON s.comp_id = c.id
-      WHERE c.name = ?
-    )
-    SELECT user_id, name, type, timing
-    FROM RankedSubmissions
-    WHERE rn = 1
-    ORDER BY timing ASC;
-  """, (chal,)).fetchall()
+  resp = [(e.user_id, e.name, e.type, e.timing) for e in (await rankings.board(comp_id, fingerprint)).top()]
   
-  header = f"# Challenge: `{chal}`\n"
+  header = f"# Challenge: `{chal}`\n" + (f"-# timings measured with `{fingerprint}`\n" if fingerprint else "")
   
   if not resp:
     return header + "No submissions yet."
       
-  rankings = []
+  lines = []
   for i, (uid, name, ktype, tm) in enumerate(resp):
     position = i + 1
     
@@ -173,13 +171,8 @@ def make_leaderboard(chal:str, with_medals:bool=True) -> str:
         medal = "🥈 "
       elif position == 3:
         medal = "🥉 "
-      rankings.append(f"{medal} `{name} ({ktype})` in {fmt_time(tm)} by <@{uid}>")
+      lines.append(f"{medal} `{name} ({ktype})` in {fmt_time(tm)} by <@{uid}>")
     else:
-      rankings.append(f"{position}. `{name} ({ktype})` in {fmt_time(tm)} by <@{uid}>")
+      lines.append(f"{position}. `{name} ({ktype})` in {fmt_time(tm)} by <@{uid}>")
   
-  return header + "\n".join(rankings)
-
-T = TypeVar("T")
-def all_same(items:list[T]): return all(x == items[0] for x in items)
-def prod(x:Iterable[T]) -> Union[T,int]: return functools.reduce(operator.mul, x, 1)
-def fmt_time(tm:float) -> str: return f"{tm*1e6:.2f} us" if tm < 1e-3 else f"{tm*1e3:.2f} ms" if tm < 1 else f"{tm:.2f} s"
+  return header + "\n".join(lines)
@@ -0,0 +1,158 @@
+import asyncio, json, multiprocessing, os, subprocess, sys, threading, time
+from typing import Any, Optional
+
+from devices import BACKEND, DevicePool, indices
+from jobs import Job, LocalSlot
+from helpers import logger
+
+JOB_TIMEOUT = float(os.getenv("KERNELBOT_JOB_TIMEOUT", "600"))    # wall-clock seconds a job may take, compilation included
+KERNEL_TIMEOUT = float(os.getenv("KERNELBOT_KERNEL_TIMEOUT", "10"))  # seconds a single launch may take
+MAX_RSS = int(os.getenv("KERNELBOT_MAX_RSS", str(32 << 30)))        # bytes of host memory a worker may use
+ISOLATE = os.getenv("KERNELBOT_ISOLATE", "1") == "1"               # judge in worker processes rather than threads of the bot
+SPAWN_TIMEOUT = 120.0   # seconds a new worker has to initialize its device
+POLL_INTERVAL = 0.5     # seconds between checks of a busy worker
+MAX_BACKOFF = 30.0      # seconds between attempts to start a worker that keeps failing, doubling from 1
+
+class JobTimeout(Exception): pass
+class KernelTimeout(Exception): pass
+class WorkerDied(Exception):
+  """The worker process executing a job crashed or was killed, eg. for using too much memory."""
+
+# runs in the worker process, which owns one device and executes one job at a time
+def _serve(kind:str, idx:int, conn, kernel_timeout:float):
+  import run, tcache
+  from devices import backend
+  dev = backend(kind, idx)
+  dev.flush_l2()  # creates the context and the flush buffer before the first job rather than during it
+  lock = threading.Lock()
+  def watchdog():
+    # a hung launch blocks the main thread in the driver, so this thread reports it and takes the process down
+    while True:
+      time.sleep(0.1)
+      if (st:=run.launch_started) is not None and time.monotonic() - st > kernel_timeout:
+        with lock: conn.send(("error", KernelTimeout(f"a kernel launch took longer than {kernel_timeout:g}s")))
+        os._exit(1)
+  threading.Thread(target=watchdog, name="watchdog", daemon=True).start()
+  conn.send(("ready", dev.name))
+  while True:
+    try: msg = conn.recv()
+    except EOFError: return
+    if msg[0] == "invalidate":
+      tcache.invalidate(msg[1])
+      continue
+    _, fn, args = msg
+    try: reply = ("ok", fn(dev, *args))
+    except Exception as e: reply = ("error", e)
+    with lock:
+      try: conn.send(reply)
+      except Exception as e: conn.send(("error", RuntimeError(f"{type(reply[1]).__name__}: {reply[1]}")))  # not picklable
+
+def rss(pid:int) -> int:
+  with open(f"/proc/{pid}/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+class ProcessSlot:
+  """Executes jobs on one device owned by a worker process. A job that runs too long, hangs in a launch, uses too much
+  memory or crashes the worker only fails itself: the worker is killed and a new one started right away, so the next
+  job finds a device that is already initialized."""
+  def __init__(self, kind:str, idx:int, job_timeout:float=JOB_TIMEOUT, kernel_timeout:float=KERNEL_TIMEOUT, max_rss:int=MAX_RSS):
+    self.kind, self.idx, self.name = kind, idx, f"{kind}:{idx}"
+    self.job_timeout, self.kernel_timeout, self.max_rss = job_timeout, kernel_timeout, max_rss
+    self.proc: Optional[multiprocessing.Process] = None
+    self.conn = None
+    self.restarts = 0
+    self._spawner: Optional[asyncio.Task] = None
+
+  @property
+  def online(self) -> bool: return self.conn is not None
+
+  def start(self):
+    self._ready = asyncio.Event()
+    self._spawner = asyncio.create_task(self._spawn(), name=f"spawn-{self.name}")
+
+  async def ready(self): await self._ready.wait()
+
+  async def _spawn(self):
+    backoff, ctx = 1.0, multiprocessing.get_context("spawn")  # a forked child would share the parent's CUDA state
+    while True:
+      conn, child = ctx.Pipe()
+      proc = ctx.Process(target=_serve, args=(self.kind, self.idx, child, self.kernel_timeout), name=f"worker-{self.name}", daemon=True)
+      proc.start()
+      child.close()
+      try:
+        st = time.monotonic()
+        await asyncio.wait_for(asyncio.to_thread(conn.recv), SPAWN_TIMEOUT)
+        logger.info(f"Worker {self.name} (pid {proc.pid}) ready in {time.monotonic() - st:.1f}s")
+        self.proc, self.conn = proc, conn
+        self._ready.set()
+        return
+      except (asyncio.TimeoutError, EOFError, OSError) as e:
+        logger.error(f"Worker {self.name} failed to start ({type(e).__name__}, exit code {proc.exitcode}), retrying in {backoff:.0f}s")
+        proc.kill()
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MAX_BACKOFF)
+
+  def _restart(self, reason:str):
+    logger.warning(f"Restarting worker {self.name}: {reason}")
+    self.restarts += 1
+    if self.proc is not None: self.proc.kill()
+    if self.conn is not None: self.conn.close()
+    self.proc, self.conn = None, None
+    self._ready.clear()
+    self._spawner = asyncio.create_task(self._spawn(), name=f"spawn-{self.name}")
+
+  async def execute(self, job:Job) -> Any:
+    proc, conn = self.proc, self.conn
+    try:
+      # the worker can die between jobs too, eg. killed by the OOM killer
+      if not proc.is_alive(): raise WorkerDied(f"the worker died while idle (exit code {proc.exitcode})")
+      try: conn.send(("job", job.fn, job.args))
+      except OSError: raise WorkerDied(f"the worker died while idle (exit code {proc.exitcode})") from None
+      reply = asyncio.ensure_future(asyncio.to_thread(conn.recv))
+      reply.add_done_callback(lambda f: f.cancelled() or f.exception())  # EOF once the worker is killed
+      deadline = time.monotonic() + self.job_timeout
+      while not (await asyncio.wait([reply], timeout=POLL_INTERVAL))[0]:
+        if time.monotonic() > deadline: raise JobTimeout(f"judging took longer than {self.job_timeout:g}s")
+        if (used:=rss(proc.pid)) > self.max_rss: raise WorkerDied(f"the worker used {used / 2**30:.1f}GB of host memory, "
+                                                                  f"more than the {self.max_rss / 2**30:.1f}GB limit")
+      try: kind, result = reply.result()
+      except (EOFError, OSError):
+        await asyncio.to_thread(proc.join, 1)
+        raise WorkerDied(f"the worker crashed (exit code {proc.exitcode})") from None
+    except (JobTimeout, WorkerDied) as e:
+      self._restart(str(e))
+      raise
+    if kind == "ok": return result
+    if isinstance(result, KernelTimeout): self._restart(str(result))  # the worker is exiting
+    raise result
+
+  def invalidate(self, chal_id:int):
+    if self.conn is not None: self.conn.send(("invalidate", chal_id))
+
+  async def close(self):
+    if self._spawner is not None: self._spawner.cancel()
+    if self.proc is not None:
+      self.proc.terminate()
+      await asyncio.to_thread(self.proc.join, 5)
+      if self.proc.is_alive(): self.proc.kill()
+
+PROBE = "import json, sys, devices; print(json.dumps(devices.indices(sys.argv[1])))"
+
+def probe(spec:str=BACKEND) -> tuple[str, list[int], str]:
+  """devices.indices in a short-lived interpreter, so finding the GPUs doesn't load the CUDA runtime (or cuInit) into
+  a process that only hands jobs to the workers."""
+  if not spec.startswith("cuda"): return indices(spec)
+  env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.getenv("PYTHONPATH")]))}
+  res = subprocess.run([sys.executable, "-c", PROBE, spec], capture_output=True, text=True, timeout=SPAWN_TIMEOUT, env=env)
+  if res.returncode != 0: raise RuntimeError((res.stderr.strip().splitlines() or [f"finding the {spec} devices failed"])[-1])
+  sys.stderr.write(res.stderr)  # eg. the devices it skipped
+  kind, idxs, model = json.loads(res.stdout.splitlines()[-1])
+  return kind, idxs, model
+
+def local_slots(spec:str=BACKEND, isolate:bool=ISOLATE) -> tuple[list, str]:
+  """(slots, device model) judging on this host's devices, in worker processes unless isolate is off, in which case
+  this process judges and initializes the devices itself."""
+  if isolate:
+    kind, idxs, model = probe(spec)
+    return [ProcessSlot(kind, i) for i in idxs], model
+  pool = DevicePool.from_spec(spec)
+  return [LocalSlot(b) for b in pool.backends], pool.model